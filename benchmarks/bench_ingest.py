@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2019 ARC Centre of Excellence for Climate Extremes
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Benchmark ingest of synthetic dumps by each of the make_*_DB parsers,
+recording rows per second and peak memory. Each parser is run in a fresh
+process so peak memory is not polluted by earlier runs, e.g.
+
+    python benchmarks/bench_ingest.py --jobs 20000 --folders 2000 --output ingest.json
+"""
+
+from __future__ import print_function
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import datetime
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from synthetic import write_dumps, add_scale_arguments
+
+def maxrss():
+    """Peak resident memory of this process in MB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+def run_parser(dumptype, files, dbdir):
+    """Ingest files with the parser for dumptype. Run in a child process"""
+    from ncimonitor import make_SU_DB, make_short_DB, make_gdata_DB, make_jobs_DB
+    from ncimonitor.IngestStats import stats
+
+    modules = { 'SU' : (make_SU_DB, make_SU_DB.parse_SU_file),
+                'short' : (make_short_DB, make_short_DB.parse_short_file),
+                'gdata' : (make_gdata_DB, make_gdata_DB.parse_gdata_file) }
+
+    baseline = maxrss()
+    stats.enabled = True
+    stats.reset()
+
+    start = time.time()
+    # The parsers are chatty
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        if dumptype == 'jobs':
+            dbfile = os.path.join(dbdir, 'jobs.db')
+            for f in files:
+                make_jobs_DB.parse_qstat_json_dump(f, dbfile)
+        else:
+            module, parse = modules[dumptype]
+            module.dbfileprefix = dbdir
+            for f in files:
+                parse(f)
+    elapsed = time.time() - start
+
+    rows = stats.counters.get('rows', 0)
+    return dict(parser=dumptype,
+                files=len(files),
+                bytes=sum(os.path.getsize(f) for f in files),
+                rows=rows,
+                seconds=elapsed,
+                rows_per_second=rows / elapsed if elapsed > 0 else None,
+                baseline_rss_mb=baseline,
+                peak_rss_mb=maxrss(),
+                phases=stats.asdict()['phases'])
+
+def main(args):
+    workdir = tempfile.mkdtemp(prefix='ncimonitor_bench_', dir=args.tmpdir)
+    try:
+        dumpdir = os.path.join(workdir, 'dumps')
+        print('Writing synthetic dumps to {}'.format(dumpdir))
+        files, rows = write_dumps(dumpdir, args.projects, args.users, args.folders, args.jobs, args.days)
+
+        results = []
+        for dumptype in args.parsers:
+            dbdir = os.path.join(workdir, 'db_{}'.format(dumptype))
+            os.makedirs(dbdir)
+            # Fresh process for each parser to measure its peak memory
+            with ProcessPoolExecutor(max_workers=1) as pool:
+                result = pool.submit(run_parser, dumptype, files[dumptype], dbdir).result()
+            results.append(result)
+            print('{parser:6s} {files:5d} files {rows:10d} rows {seconds:8.2f} s {rows_per_second:10.1f} rows/s '
+                  'peak {peak_rss_mb:8.1f} MB (baseline {baseline_rss_mb:.1f} MB)'.format(**result))
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir)
+
+    if args.output is not None:
+        record = dict(date=datetime.datetime.now().isoformat(),
+                      host=platform.node(),
+                      python=platform.python_version(),
+                      scale=dict(projects=len(args.projects), users=args.users, folders=args.folders,
+                                 jobs=args.jobs, days=args.days),
+                      results=results)
+        with open(args.output, 'w') as f:
+            json.dump(record, f, indent=1)
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Benchmark ingest of synthetic dumps")
+    add_scale_arguments(parser)
+    parser.add_argument("--parsers", help="Parsers to benchmark", nargs='+',
+                        choices=['SU', 'short', 'gdata', 'jobs'], default=['SU', 'short', 'gdata', 'jobs'])
+    parser.add_argument("-o","--output", help="Write results to this JSON file")
+    parser.add_argument("--tmpdir", help="Directory in which to write dumps and databases")
+    parser.add_argument("--keep", help="Keep dumps and databases", action='store_true')
+    return parser.parse_args(args)
+
+if __name__ == "__main__":
+    main(parse_args(sys.argv[1:]))
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2019 ARC Centre of Excellence for Climate Extremes
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Compare the SQLite and DuckDB/Parquet jobs backends on synthetic jobs
+databases of increasing size, e.g.
+
+    python benchmarks/bench_jobs_backends.py --scales small medium large
+
+Each SQLite database is built, converted with convert_jobs_DB and the same
+queries timed on both. Requires the duckdb package.
+"""
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from synthetic import build_jobs_db
+from bench_query import time_getters
+
+# name : (days, users per project, jobs)
+scales = { 'small' : (91, 10, 100000),
+           'medium' : (365, 50, 1000000),
+           'large' : (730, 200, 5000000) }
+
+projects = ('xx00', 'yy00', 'zz00')
+
+def getters(days):
+    startdate = datetime.date(2019, 1, 1)
+    month = (startdate + datetime.timedelta(days=days // 2), startdate + datetime.timedelta(days=days // 2 + 30))
+    return [ ('getnumrecords', lambda db: db.getnumrecords()),
+             ('getjobs_month', lambda db: db.getjobs(str(month[0]), str(month[1]))),
+             ('aggregate', lambda db: db.aggregate('waittime', 'queue', 'ncpusbin')),
+             ('aggregate_median', lambda db: db.aggregate('waittime', 'queue', 'ncpusbin', aggfunc='median')),
+             ('aggregate_users', lambda db: db.aggregate('walltime', 'project', 'username', aggfunc='sum')),
+             ('aggregate_month', lambda db: db.aggregate('cpuutil', 'queue', 'ncpusbin', startdate=month[0], enddate=month[1])),
+             ('getquantiles', lambda db: db.getquantiles('waittime', quantiles=(0.5, 0.9))) ]
+
+def dirsize(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, f)) for root, dirs, files in os.walk(path) for f in files)
+
+def main(args):
+    from ncimonitor.JobsDataset import JobsDataset, open_jobs
+    from ncimonitor.convert_jobs_DB import convert
+
+    workdir = tempfile.mkdtemp(prefix='ncimonitor_bench_', dir=args.tmpdir)
+    results = {}
+    try:
+        for scale in args.scales:
+            days, users, jobs = scales[scale]
+            print('{}: {} days, {} users, {} jobs'.format(scale, days, users, jobs))
+
+            sqlitefile = os.path.join(workdir, 'jobs_{}.db'.format(scale))
+            parquetdir = os.path.join(workdir, 'jobs_{}'.format(scale))
+            start = time.time()
+            db = build_jobs_db(sqlitefile, jobs, days=days, projects=projects, users=users)
+            # Sketches for getquantiles, as make_jobs_DB would keep them
+            for job in db.getjobs().itertuples():
+                db.addsketches(job.ctime[:10], job.queue, job.ncpus, job.project,
+                               waittime=job.waittime, walltime=job.walltime, cpuutil=job.cpuutil)
+            db.flushsketches()
+            print('  built SQLite database in {:.1f} s'.format(time.time() - start))
+
+            start = time.time()
+            convert(db, open_jobs('duckdb:///'+parquetdir))
+            convert_time = time.time() - start
+            print('  converted in {:.1f} s, {:.1f} MB SQLite, {:.1f} MB Parquet'.format(
+                      convert_time, dirsize(sqlitefile) / 1024.**2, dirsize(parquetdir) / 1024.**2))
+
+            results[scale] = dict(convert=convert_time, sqlite_bytes=dirsize(sqlitefile), parquet_bytes=dirsize(parquetdir))
+            for backend, url in (('sqlite', 'sqlite:///'+sqlitefile), ('duckdb', 'duckdb:///'+parquetdir)):
+                print(' ', backend)
+                results[scale][backend] = time_getters(lambda: open_jobs(url), getters(days), args.repeat)
+    finally:
+        shutil.rmtree(workdir)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(dict(date=datetime.datetime.now().isoformat(),
+                           scales=dict((scale, scales[scale]) for scale in args.scales),
+                           results=results), f, indent=1)
+    return 0
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Benchmark the SQLite and DuckDB/Parquet jobs backends")
+    parser.add_argument("--scales", help="Database sizes to benchmark", nargs='+',
+                        choices=sorted(scales), default=['small', 'medium'])
+    parser.add_argument("--repeat", help="Number of warm calls of each query", type=int, default=5)
+    parser.add_argument("-o","--output", help="Write results to this JSON file")
+    parser.add_argument("--tmpdir", help="Directory in which to build databases")
+    return parser.parse_args(args)
+
+if __name__ == "__main__":
+    sys.exit(main(parse_args(sys.argv[1:])))
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2019 ARC Centre of Excellence for Climate Extremes
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Time the ProjectDataset and JobsDataset getters against synthetic databases
+of increasing size, and check for regressions against a stored baseline, e.g.
+
+    python benchmarks/bench_query.py --output baseline.json
+    python benchmarks/bench_query.py --baseline baseline.json --threshold 0.25
+
+Cold times are for the first call on a newly opened dataset (new connection
+and empty SQLite page cache, though the OS file cache will be warm), warm
+times are the median of repeated calls on the same dataset. Exits with
+status 1 if any getter is slower than the baseline by more than threshold.
+"""
+
+from __future__ import print_function
+
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+from synthetic import build_usage_db, build_jobs_db
+
+# name : (days in quarter, users, folders per project, jobs)
+scales = { 'small' : (30, 10, 100, 10000),
+           'medium' : (91, 50, 1000, 100000),
+           'large' : (91, 200, 5000, 500000) }
+
+year = 2019; quarter = 'q1'
+
+def usage_getters():
+    return [ ('getusage', lambda db: db.getusage(year, quarter)),
+             ('getprojectsu', lambda db: db.getprojectsu(year, quarter)),
+             ('getstorage_short', lambda db: db.getstorage(year, quarter, storagept='short', datafield='size')),
+             ('getstorage_gdata_inodes', lambda db: db.getstorage(year, quarter, storagept='gdata', datafield='inodes')),
+             ('top_usage', lambda db: db.top_usage(year, quarter, 'short', count=10)) ]
+
+def jobs_getters():
+    return [ ('getjobs', lambda db: db.getjobs()),
+             ('aggregate', lambda db: db.aggregate('waittime', 'queue', 'ncpusbin')),
+             ('aggregate_median', lambda db: db.aggregate('waittime', 'queue', 'ncpusbin', aggfunc='median')) ]
+
+def timeit(func, *args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+def time_getters(opener, getters, repeat):
+    results = {}
+    for name, getter in getters:
+        # The getters print warnings when there is no data
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            db = opener()
+            cold = timeit(getter, db)
+            warm = sorted(timeit(getter, db) for _ in range(repeat))[repeat // 2]
+        results[name] = dict(cold=cold, warm=warm)
+        print('  {:24s} cold {:9.4f} s  warm {:9.4f} s'.format(name, cold, warm))
+    return results
+
+def compare(results, baseline, threshold, minimum):
+    """Return a list of descriptions of getters slower than baseline"""
+    regressions = []
+    for scale, getters in results.items():
+        for name, times in getters.items():
+            try:
+                reference = baseline['results'][scale][name]
+            except KeyError:
+                continue
+            for kind in ('cold', 'warm'):
+                if times[kind] > reference[kind] * (1. + threshold) and times[kind] - reference[kind] > minimum:
+                    regressions.append('{} {} {}: {:.4f} s vs baseline {:.4f} s'.format(
+                                           scale, name, kind, times[kind], reference[kind]))
+    return regressions
+
+def main(args):
+    from ncimonitor.UsageDataset import ProjectDataset
+    from ncimonitor.JobsDataset import JobsDataset
+
+    workdir = tempfile.mkdtemp(prefix='ncimonitor_bench_', dir=args.tmpdir)
+    results = {}
+    try:
+        for scale in args.scales:
+            days, users, folders, jobs = scales[scale]
+            print('{}: {} days, {} users, {} folders, {} jobs'.format(scale, days, users, folders, jobs))
+
+            usagedb = os.path.join(workdir, 'usage_xx00_{}_{}.db'.format(year, scale))
+            jobsdb = os.path.join(workdir, 'jobs_{}.db'.format(scale))
+            start = time.time()
+            build_usage_db(usagedb, 'xx00', year, quarter, days, users, folders)
+            build_jobs_db(jobsdb, jobs, days=days, projects=('xx00', 'yy00', 'zz00'), users=users)
+            print('  built databases in {:.1f} s'.format(time.time() - start))
+
+            results[scale] = time_getters(lambda: ProjectDataset('xx00', 'sqlite:///'+usagedb), usage_getters(), args.repeat)
+            results[scale].update(time_getters(lambda: JobsDataset('sqlite:///'+jobsdb), jobs_getters(), args.repeat))
+    finally:
+        shutil.rmtree(workdir)
+
+    record = dict(date=datetime.datetime.now().isoformat(),
+                  host=platform.node(),
+                  python=platform.python_version(),
+                  scales=dict((scale, scales[scale]) for scale in args.scales),
+                  results=results)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(record, f, indent=1)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold, args.minimum)
+        if regressions:
+            print('Regressions against {}:'.format(args.baseline))
+            for regression in regressions:
+                print('  ' + regression)
+            return 1
+        print('No regressions against {}'.format(args.baseline))
+    return 0
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Benchmark dataset getters on synthetic databases")
+    parser.add_argument("--scales", help="Database sizes to benchmark", nargs='+',
+                        choices=sorted(scales), default=['small', 'medium'])
+    parser.add_argument("--repeat", help="Number of warm calls of each getter", type=int, default=5)
+    parser.add_argument("-o","--output", help="Write results to this JSON file")
+    parser.add_argument("-b","--baseline", help="Compare against results in this JSON file")
+    parser.add_argument("--threshold", help="Fractional slow down counted as a regression", type=float, default=0.25)
+    parser.add_argument("--minimum", help="Ignore slow downs smaller than this many seconds", type=float, default=0.005)
+    parser.add_argument("--tmpdir", help="Directory in which to build databases")
+    return parser.parse_args(args)
+
+if __name__ == "__main__":
+    sys.exit(main(parse_args(sys.argv[1:])))
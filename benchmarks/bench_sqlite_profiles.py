@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2019 ARC Centre of Excellence for Climate Extremes
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Compare the SQLite tuning profiles by ingesting synthetic short dumps with
+each writer profile while another process repeatedly reads the latest scan,
+as nciusage does, e.g.
+
+    python benchmarks/bench_sqlite_profiles.py --folders 5000 --days 30 --output profiles.json
+
+Reports ingest rows per second, and the number, latency and failures of the
+concurrent reads.
+"""
+
+from __future__ import print_function
+
+import argparse
+import contextlib
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+from synthetic import write_dumps, add_scale_arguments
+
+def reader(dbfile, profile, started, stop, results):
+    """Repeatedly read the latest scan until stop is set. Run in a child process"""
+    from ncimonitor import UsageQuery
+    latencies = []; errors = 0
+    started.set()
+    while not stop.is_set():
+        if not os.path.exists(dbfile):
+            time.sleep(0.01)
+            continue
+        start = time.time()
+        try:
+            conn = UsageQuery.connect(dbfile, profile)
+            try:
+                UsageQuery.latest_storage(conn, 2019, 'q1', 'short')
+            finally:
+                conn.close()
+        except sqlite3.OperationalError:
+            errors += 1
+        else:
+            latencies.append(time.time() - start)
+    latencies.sort()
+    results.put(dict(reads=len(latencies),
+                     errors=errors,
+                     median_read=latencies[len(latencies) // 2] if latencies else None,
+                     max_read=latencies[-1] if latencies else None))
+
+def ingest(files, dbdir, profile):
+    from ncimonitor import make_short_DB
+    from ncimonitor.IngestStats import stats
+
+    make_short_DB.databases.clear()
+    make_short_DB.dbfileprefix = dbdir
+    make_short_DB.dbargs = dict(profile=profile)
+
+    stats.enabled = True
+    stats.reset()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for f in files:
+            make_short_DB.parse_short_file(f)
+    journal = None
+    for db in make_short_DB.databases.values():
+        journal = list(db.db.query('PRAGMA journal_mode'))[0]['journal_mode']
+        db.close()
+    make_short_DB.databases.clear()
+    return stats.asdict(), journal
+
+def run(files, dbdir, writer, readerprofile):
+    dbfile = os.path.join(dbdir, 'usage_xx00_2019.db')
+    started = multiprocessing.Event(); stop = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=reader, args=(dbfile, readerprofile, started, stop, results))
+    process.start()
+    started.wait()
+    try:
+        data, journal = ingest(files, dbdir, writer)
+    finally:
+        stop.set()
+        reads = results.get()
+        process.join()
+    result = dict(writer=writer, reader=readerprofile, journal_mode=journal,
+                  rows=data['counters'].get('rows', 0), seconds=data['elapsed'],
+                  rows_per_second=data['rows_per_second'],
+                  commit_seconds=data['phases'].get('commit', {}).get('seconds', 0.))
+    result.update(reads)
+    return result
+
+def main(args):
+    workdir = tempfile.mkdtemp(prefix='ncimonitor_bench_', dir=args.tmpdir)
+    results = []
+    try:
+        dumpdir = os.path.join(workdir, 'dumps')
+        print('Writing synthetic dumps to {}'.format(dumpdir))
+        files, rows = write_dumps(dumpdir, ['xx00'], args.users, args.folders, 0, args.days)
+        for writer in args.writers:
+            dbdir = os.path.join(workdir, 'db_{}'.format(writer))
+            os.makedirs(dbdir)
+            result = run(files['short'], dbdir, writer, args.reader)
+            results.append(result)
+            print('{writer:13s} journal {journal_mode:7s} {rows:8d} rows {rows_per_second:10.1f} rows/s '
+                  'commit {commit_seconds:7.3f} s | {reads:6d} reads {errors:4d} errors'.format(**result),
+                  end='')
+            if result['median_read'] is not None:
+                print(' median {:.4f} s max {:.4f} s'.format(result['median_read'], result['max_read']))
+            else:
+                print()
+    finally:
+        shutil.rmtree(workdir)
+
+    if args.output is not None:
+        record = dict(date=datetime.datetime.now().isoformat(),
+                      host=platform.node(),
+                      python=platform.python_version(),
+                      sqlite=sqlite3.sqlite_version,
+                      scale=dict(users=args.users, folders=args.folders, days=args.days),
+                      results=results)
+        with open(args.output, 'w') as f:
+            json.dump(record, f, indent=1)
+
+def parse_args(args):
+    from ncimonitor.DBcommon import sqlite_profiles
+    parser = argparse.ArgumentParser(description="Compare SQLite tuning profiles for ingest and concurrent reads")
+    add_scale_arguments(parser)
+    parser.add_argument("--writers", help="Profiles to ingest with", nargs='+',
+                        choices=list(sqlite_profiles) + ['none'], default=['none', 'online-write', 'bulk-load'])
+    parser.add_argument("--reader", help="Profile for the concurrent reader",
+                        choices=list(sqlite_profiles) + ['none'], default='read-only')
+    parser.add_argument("-o","--output", help="Write results to this JSON file")
+    parser.add_argument("--tmpdir", help="Directory in which to write dumps and databases")
+    return parser.parse_args(args)
+
+if __name__ == "__main__":
+    main(parse_args(sys.argv[1:]))
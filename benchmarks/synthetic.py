@@ -0,0 +1,409 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2019 ARC Centre of Excellence for Climate Extremes
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Generate synthetic NCI accounting dumps in the formats read by parse_SU_file,
+parse_short_file, parse_gdata_file and parse_qstat_json_dump, so ingest and
+queries can be benchmarked without real data.
+"""
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+
+from ncimonitor.DBcommon import datetoyearquarter, yearquartertodates
+
+separator = '%' * 72
+
+queues = [ ('normal', 1.0), ('express', 3.0), ('copyq', 1.0), ('hugemem', 1.25) ]
+
+def usernames(nusers):
+    return ['{}{}{:03d}'.format(chr(97 + i % 26), chr(97 + (i // 26) % 26), i) for i in range(nusers)]
+
+def dumpdate(date):
+    """Date line as written by the accounting scripts. UTC so strptime %Z always parses it"""
+    return date.strftime('%a %b %d %H:%M:%S UTC %Y')
+
+def pbsdate(date):
+    return date.strftime('%a %b %d %H:%M:%S %Y')
+
+def hms(seconds):
+    seconds = int(seconds)
+    return '{:02d}:{:02d}:{:02d}'.format(seconds // 3600, (seconds // 60) % 60, seconds % 60)
+
+def size_string(nbytes):
+    for unit in ['B', 'KB', 'MB', 'GB', 'TB', 'PB']:
+        if nbytes < 1024. or unit == 'PB':
+            return '{:.2f}{}'.format(nbytes, unit)
+        nbytes /= 1024.
+
+def write_SU_dump(filename, project, date, nusers=10, seed=0):
+    """
+    Write an SU usage report for project as of date. Usage grows linearly
+    through the quarter. Returns the number of data rows
+    """
+    rng = random.Random(seed)
+    year, quarter = datetoyearquarter(date)
+    startdate, enddate = yearquartertodates(year, quarter)
+    fraction = ((date.date() if isinstance(date, datetime.datetime) else date) - startdate).days / 91.
+    grant = 1000. * (1 + rng.randint(0, 20))
+    nrows = 0
+    with open(filename, 'w') as f:
+        print(separator, file=f)
+        print(dumpdate(date), file=f)
+        print('', file=f)
+        print('Usage Report: Project={} Compute Period={}.{} ({}-{})'.format(project, year, quarter,
+                  startdate.strftime('%d/%m/%Y'), enddate.strftime('%d/%m/%Y')), file=f)
+        print('', file=f)
+        print('Total Grant:  {:.2f} KSU'.format(grant), file=f)
+        print('Total Used:   {:.2f} KSU'.format(grant * fraction), file=f)
+        print('', file=f)
+        print('System        Queue    Charge    CPU Hours    Walltime Hours    SU    Jobs  Avail  Grant', file=f)
+        print('-' * 88, file=f)
+        for queue, weight in queues:
+            su = 1000. * grant * fraction * rng.random() / len(queues)
+            print('raijin        {:<8s} {:6.2f} {:12.2f} {:12.2f} {:12.2f} {:6d} {:6d} {:6d}'.format(
+                      queue, weight, su / weight, su / weight, su, rng.randint(0, 1000), 0, 0), file=f)
+            nrows += 1
+        print('', file=f)
+        print('Batch Queue Usage per User (all queues)', file=f)
+        print('-' * 60, file=f)
+        print('User      CPU Hours    Walltime Hours    SU    Jobs', file=f)
+        print('-' * 60, file=f)
+        for user in usernames(nusers):
+            su = 1000. * grant * fraction * rng.random() / nusers
+            print('{:<10s} {:12.2f} {:12.2f} {:12.2f} {:6d}'.format(user, su, su, su, rng.randint(0, 100)), file=f)
+            nrows += 1
+        print('', file=f)
+        print('System    StoragePt    Grant     Used     Avail    iGrant    iUsed    iAvail', file=f)
+        print('-' * 80, file=f)
+        for system, storagept, grant in (('raijin', 'short', 10.), ('global', 'gdata1', 100.), ('dmf', 'massdata', 50.)):
+            print('{:<9s} {:<10s} {:.2f}TB {:.2f}TB {:.2f}TB {:.2f}K {:.2f}K {:.2f}K'.format(
+                      system, storagept, grant, grant / 2, grant / 2, grant * 100, grant * 50, grant * 50), file=f)
+            nrows += 1
+        print('', file=f)
+    return nrows
+
+def folder_usage(rng, project, users, nfolders, day):
+    """(folder, user, size, inodes) for each folder. Most folders are unchanged from day to day"""
+    rows = []
+    for i in range(nfolders):
+        user = users[i % len(users)]
+        frng = random.Random('{}{}'.format(project, i))
+        size = frng.uniform(1e6, 1e12)
+        inodes = frng.randint(1, 1000000)
+        # A few folders grow each day
+        if i % 10 == 0:
+            size *= 1 + 0.01 * day
+            inodes += 100 * day
+        rows.append(('/{}/{}/folder{:05d}'.format(project, user, i), user, size, inodes))
+    return rows
+
+def write_storage_dump(filename, project, date, storagename, nusers=10, nfolders=100, day=0, seed=0):
+    """
+    Write a short or gdata file usage dump for project as of date. Returns
+    the number of data rows
+    """
+    rng = random.Random(seed)
+    users = usernames(nusers)
+    nrows = 0
+    with open(filename, 'w') as f:
+        print(separator, file=f)
+        print(dumpdate(date), file=f)
+        print(separator, file=f)
+        print('{} usage for project {}:'.format(storagename, project), file=f)
+        print('', file=f)
+        print('{:<40s} {:<10s} {:>12s} {:>10s} {}'.format('Folder', 'User', 'Size', 'Inodes', 'Scandate'), file=f)
+        print('-' * 88, file=f)
+        for folder, user, size, inodes in folder_usage(rng, project, users, nfolders, day):
+            print('{:<40s} {:<10s} {:>12s} {:>10d} {}'.format(folder, user, size_string(size), inodes, date.strftime('%Y-%m-%d')), file=f)
+            nrows += 1
+        print('', file=f)
+    return nrows
+
+def write_short_dump(filename, project, date, nusers=10, nfolders=100, day=0, seed=0):
+    return write_storage_dump(filename, project, date, '/short', nusers, nfolders, day, seed)
+
+def write_gdata_dump(filename, project, date, nusers=10, nfolders=100, day=0, seed=0):
+    if 'gdata' not in os.path.basename(filename):
+        raise ValueError('gdata dump filenames must contain the storage point, e.g. gdata1')
+    return write_storage_dump(filename, project, date, '/g/data1', nusers, nfolders, day, seed)
+
+def simulate_jobs(njobs, startdate, enddate, projects, nusers=10, seed=0):
+    """
+    A population of jobs created uniformly between startdate and enddate, each
+    with a wait time and run time, from which qstat dumps can be drawn
+    """
+    rng = random.Random(seed)
+    users = usernames(nusers)
+    span = (enddate - startdate).total_seconds()
+    jobs = []
+    for i in range(njobs):
+        ctime = startdate + datetime.timedelta(seconds=int(rng.uniform(0, span)))
+        queue = rng.choice(queues)[0]
+        ncpus = rng.choice([1, 1, 1, 2, 4, 8, 16, 16, 32, 48, 64, 128, 256, 512, 1024, 2048])
+        maxwalltime = rng.choice([600, 3600, 3 * 3600, 10 * 3600, 48 * 3600])
+        jobs.append(dict(jobid='{}.r-man2'.format(1000000 + i),
+                         number=i,
+                         user=users[rng.randrange(len(users))],
+                         project=rng.choice(projects),
+                         queue=queue,
+                         ncpus=ncpus,
+                         ctime=ctime,
+                         stime=ctime + datetime.timedelta(seconds=int(rng.expovariate(1. / 1800))),
+                         walltime=int(rng.uniform(0.1, 1.) * maxwalltime),
+                         maxwalltime=maxwalltime,
+                         mem=rng.randint(1, 4 * ncpus) * 1024**3,
+                         cpuutil=rng.uniform(0.2, 1.),
+                         exitstatus=rng.choice([0, 0, 0, 0, 1, 271])))
+    return jobs
+
+def qstat_job(job, when):
+    """Job as reported by qstat -f -F json at time when, or None if not visible"""
+    if job['ctime'] > when:
+        return None
+    endtime = job['stime'] + datetime.timedelta(seconds=job['walltime'])
+    # Finished jobs are reported for a day after they end
+    if endtime < when - datetime.timedelta(days=1):
+        return None
+    info = { 'Job_Name' : 'job_{}'.format(job['jobid'].split('.')[0]),
+             'Job_Owner' : '{}@raijin{}'.format(job['user'], 1 + job['number'] % 7),
+             'queue' : job['queue'],
+             'server' : 'r-man2',
+             'project' : job['project'],
+             'ctime' : pbsdate(job['ctime']),
+             'qtime' : pbsdate(job['ctime']),
+             'Checkpoint' : 'u',
+             'Error_Path' : 'raijin1:/home/{}/job.e'.format(job['user']),
+             'Output_Path' : 'raijin1:/home/{}/job.o'.format(job['user']),
+             'Hold_Types' : 'n',
+             'Join_Path' : 'n',
+             'Keep_Files' : 'n',
+             'Mail_Points' : 'a',
+             'Priority' : 0,
+             'Rerunable' : 'False',
+             'Resource_List' : { 'jobfs' : '104857600b',
+                                 'jobprio' : 0,
+                                 'mem' : '{}gb'.format(job['mem'] // 1024**3),
+                                 'ncpus' : job['ncpus'],
+                                 'nodect' : max(1, job['ncpus'] // 16),
+                                 'place' : 'free',
+                                 'select' : '{}:ncpus=16'.format(max(1, job['ncpus'] // 16)),
+                                 'walltime' : hms(job['maxwalltime']) },
+             'Submit_arguments' : ' -q {} job.sh'.format(job['queue']),
+             'executable' : '<jsdl-hpcpa:Executable>/bin/bash</jsdl-hpcpa:Executable>',
+             'argument_list' : '<jsdl-hpcpa:Argument>job.sh</jsdl-hpcpa:Argument>',
+             # The environment is by far the largest part of each job
+             'Variable_List' : dict([('PBS_O_HOME', '/home/{}'.format(job['user'])),
+                                     ('PBS_O_QUEUE', job['queue']),
+                                     ('PBS_O_PATH', ':'.join('/apps/pkg{}/bin'.format(i) for i in range(40)))] +
+                                    [('MODULE_{}'.format(i), 'x' * 60) for i in range(60)]),
+             'comment' : 'Job run at {}'.format(pbsdate(job['stime'])) }
+    if when < job['stime']:
+        info['job_state'] = 'Q'
+        info['mtime'] = pbsdate(job['ctime'])
+    else:
+        used = min(when, endtime) - job['stime']
+        walltime = int(used.total_seconds())
+        info['stime'] = pbsdate(job['stime'])
+        info['exec_host'] = 'r{}/0*16'.format(job['number'] % 4000)
+        info['resources_used'] = { 'cpupercent' : int(100 * job['cpuutil'] * job['ncpus']),
+                                   'cput' : hms(walltime * job['ncpus'] * job['cpuutil']),
+                                   'mem' : '{}kb'.format(job['mem'] // 2048),
+                                   'ncpus' : job['ncpus'],
+                                   'vmem' : '{}kb'.format(job['mem'] // 1024),
+                                   'walltime' : hms(walltime) }
+        if when < endtime:
+            info['job_state'] = 'R'
+            info['mtime'] = pbsdate(job['stime'])
+        else:
+            info['job_state'] = 'F'
+            info['mtime'] = pbsdate(endtime)
+            info['Exit_status'] = job['exitstatus']
+    return info
+
+def write_qstat_dump(filename, jobs, when):
+    """
+    Write a qstat json dump of the simulated jobs visible at time when.
+    Returns the number of jobs written
+    """
+    data = { 'timestamp' : int((when - datetime.datetime(1970, 1, 1)).total_seconds()),
+             'pbs_version' : '19.2.4',
+             'pbs_server' : 'r-man2',
+             'Jobs' : {} }
+    for job in jobs:
+        info = qstat_job(job, when)
+        if info is not None:
+            data['Jobs'][job['jobid']] = info
+    with open(filename, 'w') as f:
+        json.dump(data, f, indent=4)
+    return len(data['Jobs'])
+
+def write_dumps(outdir, projects=('xx00',), users=10, folders=100, jobs=1000, days=7,
+                startdate=datetime.datetime(2019, 1, 1, 6)):
+    """
+    Write a daily SU, short and gdata dump for each project and a daily qstat
+    dump for each of days days. Returns a dict of the files written for each
+    dump type, and the number of rows in them
+    """
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    files = { 'SU' : [], 'short' : [], 'gdata' : [], 'jobs' : [] }
+    rows = dict((key, 0) for key in files)
+    population = simulate_jobs(jobs, startdate - datetime.timedelta(days=1), startdate + datetime.timedelta(days=days),
+                               list(projects), users)
+    for day in range(days):
+        date = startdate + datetime.timedelta(days=day)
+        stamp = date.strftime('%Y%m%d')
+        for i, project in enumerate(projects):
+            filename = os.path.join(outdir, 'SU_{}_{}.dump'.format(project, stamp))
+            rows['SU'] += write_SU_dump(filename, project, date, users, seed=i)
+            files['SU'].append(filename)
+            filename = os.path.join(outdir, 'short_{}_{}.dump'.format(project, stamp))
+            rows['short'] += write_short_dump(filename, project, date, users, folders, day, seed=i)
+            files['short'].append(filename)
+            filename = os.path.join(outdir, 'gdata1_{}_{}.dump'.format(project, stamp))
+            rows['gdata'] += write_gdata_dump(filename, project, date, users, folders, day, seed=i)
+            files['gdata'].append(filename)
+        filename = os.path.join(outdir, 'qstat_{}.json'.format(stamp))
+        rows['jobs'] += write_qstat_dump(filename, population, date)
+        files['jobs'].append(filename)
+    return files, rows
+
+def build_usage_db(dbfile, project='xx00', year=2019, quarter='q1', days=91, users=10, folders=100, seed=0):
+    """
+    Build a usage database directly with bulk inserts, with daily SU usage
+    and short and gdata scans for days days of the quarter
+    """
+    from ncimonitor.UsageDataset import ProjectDataset
+
+    rng = random.Random(seed)
+    startdate, enddate = yearquartertodates(year, quarter)
+    dates = [startdate + datetime.timedelta(days=d) for d in range(min(days, (enddate - startdate).days + 1))]
+    names = usernames(users)
+
+    db = ProjectDataset(project, 'sqlite:///'+dbfile)
+    db.addquarter(year, quarter, startdate, enddate)
+    db.addgrant(year, quarter, 1000. * users)
+    db.addsystemstorage('raijin', 'short', year, quarter, 10 * 1024.**4, 1e6)
+    db.addsystemstorage('global', 'gdata1', year, quarter, 100 * 1024.**4, 1e7)
+    for queue, weight in queues:
+        db.addsystemqueue('raijin', queue, weight)
+    for user in names:
+        db.adduser(user, 'User {}'.format(user))
+    userids = dict((user, db.getuser(user)['id']) for user in names)
+    queueids = [db.getqueue('raijin', queue)['id'] for queue, _ in queues]
+
+    with db.db as tx:
+        useruse = []; projectuse = []
+        for i, date in enumerate(dates):
+            for user in names:
+                su = 100. * i * (1 + userids[user] % 5)
+                useruse.append(dict(date=date, user=userids[user], usage_cpu=su, usage_wall=su, usage_su=su))
+            for queueid in queueids:
+                su = 1000. * i
+                projectuse.append(dict(date=date, systemqueue=queueid, usage_cpu=su, usage_wall=su, usage_su=su))
+        tx['UserUsage'].insert_many(useruse)
+        tx['ProjectUsage'].insert_many(projectuse)
+
+        for table in ('ShortUsage', 'GdataUsage'):
+            rows = []
+            for day, date in enumerate(dates):
+                for folder, user, size, inodes in folder_usage(rng, project, names, folders, day):
+                    row = dict(user=userids[user], folder=folder, scandate=date.isoformat(), inodes=float(inodes), size=float(size))
+                    if table == 'GdataUsage':
+                        row['storagepoint'] = 'gdata1'
+                    rows.append(row)
+            tx[table].insert_many(rows)
+
+    # Same indexes as created by the upserts in ProjectDataset
+    db.db['UserUsage'].create_index(['date', 'user'])
+    db.db['ProjectUsage'].create_index(['date', 'systemqueue'])
+    db.db['ShortUsage'].create_index(['scandate', 'folder', 'user'])
+    db.db['GdataUsage'].create_index(['scandate', 'storagepoint', 'folder', 'user'])
+
+    return db
+
+def build_jobs_db(dbfile, jobs=1000, startdate=datetime.datetime(2019, 1, 1), days=91, projects=('xx00',), users=10, seed=0):
+    """
+    Build a jobs database of finished jobs directly with bulk inserts
+    """
+    from ncimonitor.JobsDataset import JobsDataset
+
+    db = JobsDataset('sqlite:///'+dbfile)
+    population = simulate_jobs(jobs, startdate, startdate + datetime.timedelta(days=days), list(projects), users, seed)
+
+    ids = {}
+    for job in population:
+        for table, field, value in (('User', 'username', job['user']), ('Queue', 'queue', job['queue']),
+                                    ('Project', 'project', job['project'])):
+            if (table, value) not in ids:
+                if table == 'User':
+                    db.adduser(value, 'User {}'.format(value))
+                else:
+                    db.db[table].upsert({field: value}, [field])
+                ids[(table, value)] = db.db[table].find_one(**{field: value})['id']
+    db.addstate('F'); db.addexe('/bin/bash')
+    state = db.db['JobState'].find_one(status='F')['id']
+    exe = db.db['Executable'].find_one(path='/bin/bash')['id']
+
+    rows = []
+    for job in population:
+        waittime = (job['stime'] - job['ctime']).total_seconds()
+        cputime = job['walltime'] * job['ncpus'] * job['cpuutil']
+        rows.append(dict(year=job['ctime'].year, jobid=job['jobid'].split('.')[0],
+                         project=ids[('Project', job['project'])], queue=ids[('Queue', job['queue'])],
+                         user=ids[('User', job['user'])], status=state, jobname='job', exe=exe,
+                         ctime=job['ctime'], mtime=waittime + job['walltime'], qtime=0., stime=waittime,
+                         waitime=waittime, maxwalltime=float(job['maxwalltime']), maxmem=job['mem'],
+                         ncpus=job['ncpus'], walltime=float(job['walltime']), mem=job['mem'] // 2,
+                         cputime=cputime, cpuutil=job['cpuutil'], exitstatus=job['exitstatus']))
+    years = sorted(set(row['year'] for row in rows))
+    with db.db as tx:
+        for year in years:
+            tx[db.jobstable(year)].insert_many([row for row in rows if row['year'] == year])
+    for year in years:
+        db.db[db.jobstable(year)].create_index(['year', 'jobid'])
+
+    return db
+
+def add_scale_arguments(parser):
+    parser.add_argument("-P","--projects", help="Project names", nargs='+', default=['xx00'])
+    parser.add_argument("--users", help="Number of users per project", type=int, default=10)
+    parser.add_argument("--folders", help="Number of folders per project", type=int, default=100)
+    parser.add_argument("--jobs", help="Number of jobs in total", type=int, default=1000)
+    parser.add_argument("--days", help="Number of daily dumps", type=int, default=7)
+
+def main(args):
+    files, rows = write_dumps(args.outdir, args.projects, args.users, args.folders, args.jobs, args.days)
+    for key in files:
+        print('{:6s} {:6d} files {:10d} rows'.format(key, len(files[key]), rows[key]))
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Generate synthetic NCI accounting dumps")
+    parser.add_argument("outdir", help="Directory in which to write dumps")
+    add_scale_arguments(parser)
+    return parser.parse_args(args)
+
+if __name__ == "__main__":
+    main(parse_args(sys.argv[1:]))
@@ -20,21 +20,40 @@ limitations under the License.
 
 from __future__ import print_function
 
-import sys
 import os
 import shutil
 import re
 import gzip
+import io
+import datetime
+from collections import OrderedDict
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 unit_base = { 'B' : 1024, 'SU' : 1000 }
 
+# Aliases for groups of projects
+project_groups = { 'clex' : ['w35', 'w40', 'w42', 'w48', 'w97', 'v45'],
+                   'mom' : ['v45', 'e14', 'x77', 'g40'] }
+
+def expand_projects(projects):
+    """Expand any group aliases in a list of projects, removing duplicates"""
+    expanded = []
+    for p in projects:
+        for project in project_groups.get(p, [p]):
+            if project not in expanded:
+                expanded.append(project)
+    return expanded
+
 def extract_num_unit(s):
     # Match a number (possibly floating point 100.00 style) and a unit
     try:
-        size, unit = re.findall('(\d+.\d+|\d+)\s*(\D*)$',s)[0]
-    except:
-        print('Failed to match size string: ',s)
-        sys.exit()
+        size, unit = re.findall(r'(\d+.\d+|\d+)\s*(\D*)$',s)[0]
+    except IndexError:
+        raise ValueError('Failed to match size string: {}'.format(s))
     return float(size), unit
 
 def pretty_size(n,pow=0,b=1024,u='B',pre=['']+[p for p in'KMGTPEZY']):
@@ -71,21 +90,68 @@ def mkdir(path):
         if not os.path.isdir(path):
             raise
 
-def archive(filepath,archive_dir='archive'):
-    """Move dumpfile into archive directory, and compress it"""
+# File extension and default (fast) compression level of archive codecs
+codecs = { 'gzip' : ('.gz', 6), 'zstd' : ('.zst', 3) }
+
+def default_codec():
+    return 'zstd' if zstandard is not None else 'gzip'
+
+def is_compressed(filepath):
+    return any(filepath.endswith(ext) for ext, level in codecs.values())
+
+def open_dump(filepath):
+    """
+    Open a dump file for reading as a text stream, decompressing on the fly
+    if it is a gzip (.gz) or zstandard (.zst) archive
+    """
+    if filepath.endswith(codecs['gzip'][0]):
+        return gzip.open(filepath, 'rt')
+    if filepath.endswith(codecs['zstd'][0]):
+        if zstandard is None:
+            raise IOError("Reading {} requires the zstandard package".format(filepath))
+        stream = zstandard.ZstdDecompressor().stream_reader(open(filepath, 'rb'), closefd=True)
+        return io.TextIOWrapper(stream)
+    return open(filepath)
+
+def compress(filepath, outfile, codec='gzip', level=None):
+    """Stream filepath into compressed outfile"""
+    if level is None:
+        level = codecs[codec][1]
+    with open(filepath, 'rb') as f_in:
+        if codec == 'zstd':
+            if zstandard is None:
+                raise IOError("zstd compression requires the zstandard package")
+            with open(outfile, 'wb') as f_out:
+                zstandard.ZstdCompressor(level=level).copy_stream(f_in, f_out)
+        else:
+            with gzip.open(outfile, 'wb', compresslevel=level) as f_out:
+                shutil.copyfileobj(f_in, f_out, 1024*1024)
+
+def archive(filepath,archive_dir='archive',codec=None,level=None):
+    """
+    Move dumpfile into archive directory, and compress it. archive_dir is
+    relative to the directory containing the dumpfile. Dumps which are already
+    compressed, e.g. archives being re-ingested, are left where they are
+    """
+    if is_compressed(filepath):
+        return
+
+    if codec is None:
+        codec = default_codec()
+
+    (dir, filename) = os.path.split(filepath)
+    archive_path = os.path.join(dir,archive_dir)
 
     # Make sure we have a directory to archive to
     try:
-        mkdir(archive_dir)
+        mkdir(archive_path)
     except:
         print("Error making archive directory")
         return
 
     try:
-        (dir, filename) = os.path.split(filepath)
-        outfile = os.path.join(dir,archive_dir,filename)+'.gz'
-        with open(filename, 'rb') as f_in, gzip.open(outfile, 'wb') as f_out:
-            shutil.copyfileobj(f_in, f_out)
+        outfile = os.path.join(archive_path,filename)+codecs[codec][0]
+        compress(filepath, outfile, codec, level)
     except Exception as e:
         print("Error archiving ",filepath)
         print(e)
@@ -95,8 +161,94 @@ def archive(filepath,archive_dir='archive'):
         except:
             print("Error removing ",filepath)
 
+dumpseparator = "%%%%%%%%%%%%%%%%%"
+
+# Stop looking for a dump header after this many lines
+sniff_lines = 20
+
+def sniff(filepath):
+    """
+    Return (dumptype, project, date) of a dump file, where dumptype is one
+    of 'SU', 'short', 'gdata' or 'jobs', or None if it is not a dump. Project
+    and date are None for qstat json dumps
+    """
+    try:
+        with open_dump(filepath) as f:
+            date = None
+            for i, line in enumerate(f):
+                if i == 0 and line.lstrip().startswith('{'):
+                    return 'jobs', None, None
+                if i > sniff_lines:
+                    break
+                if line.startswith(dumpseparator) and date is None:
+                    date = datetime.datetime.strptime(next(f).strip(os.linesep), "%a %b %d %H:%M:%S %Z %Y")
+                    line = next(f)
+                    if line.startswith(dumpseparator):
+                        # Storage dumps have the project in the line after the date
+                        project = next(f).split()[4].strip(':')
+                        if 'gdata' in os.path.basename(filepath):
+                            return 'gdata', project, date
+                        return 'short', project, date
+                elif line.startswith("Usage Report:"):
+                    project = line.split()[2].split('=')[1]
+                    return 'SU', project, date
+    except (IOError, EOFError, IndexError, ValueError, StopIteration) as e:
+        print("Skipping {}: {}".format(filepath, e))
+    return None
+
+# Named SQLite tuning profiles, as PRAGMAs run on every new connection
+sqlite_profiles = OrderedDict([
+    # Building new databases, e.g. rebuild_DB. Nothing is synced to disk and
+    # the rollback journal is kept in memory, as a failed build is thrown away
+    ('bulk-load', [('journal_mode', 'MEMORY'), ('synchronous', 'OFF'), ('cache_size', -262144),
+                   ('temp_store', 'MEMORY'), ('mmap_size', 0)]),
+    # Ingest into databases which are being read. WAL lets readers carry on
+    # during writes, and NORMAL sync is safe with WAL. The writer returns the
+    # database to a rollback journal when it closes, see DatasetBase.reset_journal
+    ('online-write', [('journal_mode', 'WAL'), ('synchronous', 'NORMAL'), ('cache_size', -65536),
+                      ('temp_store', 'MEMORY'), ('mmap_size', 268435456), ('busy_timeout', 10000)]),
+    # Reports. Memory mapped reads and a large cache, and wait rather than fail
+    # while a writer holds a lock
+    ('read-only', [('query_only', 'ON'), ('cache_size', -65536),
+                   ('temp_store', 'MEMORY'), ('mmap_size', 268435456), ('busy_timeout', 10000)]),
+    ])
+
+# Profiles used to write to a database, rather than only read it
+writing_profiles = ('bulk-load', 'online-write')
+
+def sqlite_pragmas(profile):
+    """PRAGMA statements for a named tuning profile. No tuning if profile is None or 'none'"""
+    if profile is None or profile == 'none':
+        return []
+    if profile not in sqlite_profiles:
+        raise ValueError('Incorrect value of profile: {} Valid values are {}'.format(profile, ', '.join(sqlite_profiles)))
+    return ['PRAGMA {}={}'.format(name, value) for name, value in sqlite_profiles[profile]]
+
+def add_tuning_argument(parser, default):
+    """Add an option to select an SQLite tuning profile"""
+    parser.add_argument("--tuning", help="SQLite tuning profile (default: {})".format(default),
+                        choices=list(sqlite_profiles) + ['none'], default=default)
+
+def add_archive_arguments(parser):
+    """Add the archive compression options to a make_*_DB argument parser"""
+    parser.add_argument("--codec", help="Compression used when archiving dumps (default: zstd if available, otherwise gzip)",
+                        choices=sorted(codecs), default=None)
+    parser.add_argument("--level", help="Compression level used when archiving dumps", type=int, default=None)
+    parser.add_argument("--noarchive", help="Do not archive dump files after reading them", action='store_true')
+
 def datetoyearquarter(date):
     year = date.year
     # Convert month into year and quarter
     quarter = 'q{}'.format(int(((date.month) - 1) / 3) + 1)
     return year, quarter
+
+def yearquartertodates(year, quarter):
+    """Return the first and last day of a quarter, e.g. (2019, 'q1')"""
+    year = int(year)
+    month = 3 * (int(str(quarter).lower().strip('q')) - 1) + 1
+    startdate = datetime.date(year, month, 1)
+    if month == 10:
+        enddate = datetime.date(year + 1, 1, 1)
+    else:
+        enddate = datetime.date(year, month + 3, 1)
+    return startdate, enddate - datetime.timedelta(days=1)
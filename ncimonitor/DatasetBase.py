@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2019 ARC Centre of Excellence for Climate Extremes
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import print_function
+
+from collections import OrderedDict
+import os
+import sqlite3
+import sys
+
+import dataset
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+from .DBcommon import sqlite_pragmas, writing_profiles
+from .IngestStats import stats
+from .UserDirectory import users
+
+def connect(dbfile, profile=None):
+    """
+    Open dbfile with dataset, applying the named SQLite tuning profile (see
+    DBcommon.sqlite_profiles) to each new connection
+    """
+    db = dataset.connect(dbfile)
+    statements = sqlite_pragmas(profile)
+    if len(statements) > 0 and db.engine.dialect.name == 'sqlite':
+        def pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for statement in statements:
+                cursor.execute(statement)
+            cursor.close()
+        event.listen(db.engine, 'connect', pragmas)
+    return db
+
+def reset_journal(dbfile):
+    """
+    Return dbfile from WAL, as set by the online-write profile, to a rollback
+    journal. The journal mode is kept in the file, and a WAL database cannot
+    be opened read only (see UsageQuery.connect) by users without write access
+    to its directory once the -wal and -shm files are removed
+    """
+    if not dbfile or dbfile == ':memory:' or not os.path.exists(dbfile):
+        return
+    conn = sqlite3.connect(dbfile)
+    try:
+        if conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal':
+            conn.execute('PRAGMA journal_mode=DELETE')
+    except sqlite3.Error as e:
+        # Still open elsewhere, it is reset when the next writer closes
+        print("Could not reset journal of {}: {}".format(dbfile, e), file=sys.stderr)
+    finally:
+        conn.close()
+
+def commitall(databases):
+    """
+    Commit the transactions of a dict of datasets, as kept by the make_*_DB
+    parsers, and save the users looked up while adding them
+    """
+    for db in databases.values():
+        db.commit()
+    users.flush()
+
+def rollbackall(databases):
+    for db in databases.values():
+        db.rollback()
+
+class DatasetBase(object):
+    """
+    Row lookups and writes shared by ProjectDataset and JobsDataset.
+
+    In bulk mode rows for the tables in facttables are not written as they
+    are added, but held in memory keyed on their unique keys, so a later row
+    replaces an earlier one as an upsert would. flush() writes them with
+    insert_many and then creates the key indexes, which is much quicker than
+    upserting row by row into an indexed table. Rows are flushed automatically
+    once bulk_rows are buffered. Bulk mode is intended for building new
+    databases, see rebuild_DB
+
+    The tables in schema are created by begin(), before the transaction is
+    opened, rather than by dataset as rows are first added. Schema changes
+    inside a transaction are not safe when another thread, such as a
+    Pipeline writer, uses the database
+    """
+
+    # Tables which are buffered in bulk mode, including their partitions, which
+    # are named {table}_{suffix}. Other tables are always written immediately,
+    # as their ids are looked up when adding rows
+    facttables = ()
+
+    # Tables written when adding rows, as (keys, columns) with an example
+    # value of each column, from which dataset chooses its type as it would
+    # from the first row added
+    schema = OrderedDict()
+
+    # Tables in schema which are only created as partitions, {table}_{suffix}
+    partitioned = ()
+
+    bulk_rows = 200000
+
+    def _init_bulk(self, bulk=False):
+        self.bulk = bulk
+        # Buffered rows for each table, keyed on the values of their keys
+        self.pending = OrderedDict()
+        self.pendingkeys = {}
+        self.npending = 0
+        # Keys of rows already written by flush, which must be updated
+        self.flushed = {}
+        # Tables known to match schema
+        self.created = set()
+
+    def createtables(self, partitions=()):
+        """
+        Create the tables in schema, and any of the partitions given, with
+        their columns and key indexes, if they are missing. Key indexes of
+        the tables buffered in bulk mode are created when they are flushed
+        """
+        for name in [table for table in self.schema if table not in self.partitioned] + list(partitions):
+            self.createtable(name)
+
+    def createtable(self, name):
+        """Create table name in schema, or a partition of one, as createtables does"""
+        if name in self.created:
+            return
+        keys, columns = self.schema[name.split('_')[0]]
+        with stats.timer('schema'):
+            table = self.db.create_table(name)
+            for column, example in columns.items():
+                if not table.has_column(column):
+                    table.create_column_by_example(column, example)
+            if not (self.bulk and name.split('_')[0] in self.facttables):
+                table.create_index(keys)
+        self.created.add(name)
+
+    def _lookup(self, table, **kwargs):
+        with stats.timer('lookup'):
+            if table in self.pending and set(kwargs) == set(self.pendingkeys[table]):
+                row = self.pending[table].get(tuple(kwargs[key] for key in self.pendingkeys[table]))
+                if row is not None:
+                    return row
+            return self.db[table].find_one(**kwargs)
+
+    def _upsert(self, table, data, keys, phase='upsert'):
+        if not self.bulk or table.split('_')[0] not in self.facttables:
+            with stats.timer(phase):
+                return self.db[table].upsert(data, keys)
+        with stats.timer('buffer'):
+            rows = self.pending.setdefault(table, OrderedDict())
+            self.pendingkeys[table] = keys
+            rows[tuple(data[key] for key in keys)] = data
+            self.npending += 1
+        if self.npending >= self.bulk_rows:
+            self.flush()
+        return True
+
+    def numpending(self, table):
+        """Number of buffered rows of table which are not yet in the database"""
+        flushed = self.flushed.get(table, ())
+        return sum(1 for key in self.pending.get(table, ()) if key not in flushed)
+
+    def flush(self):
+        """Write rows buffered in bulk mode, then index them"""
+        if len(self.pending) == 0:
+            return
+        with stats.timer('flush'):
+            for table, rows in self.pending.items():
+                keys = self.pendingkeys[table]
+                flushed = self.flushed.setdefault(table, set())
+                new = [row for key, row in rows.items() if key not in flushed]
+                with self.db as tx:
+                    for key, row in rows.items():
+                        if key in flushed:
+                            tx[table].update(row, keys)
+                    tx[table].insert_many(new)
+                self.db[table].create_index(keys)
+                flushed.update(rows)
+        self.pending = OrderedDict()
+        self.npending = 0
+
+    def begin(self, partitions=()):
+        """
+        Start a transaction, unless one is already open, so rows added before
+        commit() are written together rather than committed one at a time.
+        The tables, and any partitions given, are created first
+        """
+        if not self.db.in_transaction:
+            self.createtables(partitions)
+            self.db.begin()
+
+    def commit(self):
+        if self.db.in_transaction:
+            with stats.timer('commit'):
+                self.db.commit()
+
+    def rollback(self):
+        if self.db.in_transaction:
+            self.db.rollback()
+
+    def close(self):
+        """
+        Commit, flush any buffered rows and close the database connection.
+        A database opened to write is returned to a rollback journal
+        """
+        self.commit()
+        self.flush()
+        url = make_url(self.db.url)
+        self.db.close()
+        if self.profile in writing_profiles and url.get_backend_name() == 'sqlite':
+            reset_journal(url.database)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2019 ARC Centre of Excellence for Climate Extremes
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Forecast SU consumption to the end of a quarter from the quarter to date
+usage in the SU reports. Every series, e.g. each project, or each user of
+every project, is a column of a single date x series frame and all of them
+are forecast at once with array operations.
+"""
+
+from __future__ import print_function
+
+import numpy as np
+import pandas as pd
+
+def burnrate(usage, startdate, window=14):
+    """
+    Burn rate of each column of usage, a DataFrame of quarter to date usage
+    indexed by date. Missing values are NaN. The rate is the least squares
+    slope over the last window days of each column, or the average rate since
+    startdate if there are fewer than two values in the window. Returns arrays
+    of the last usage, the day of the quarter of the last usage and the rate
+    per day
+    """
+    values = usage.values.astype(float)
+    days = np.asarray((pd.DatetimeIndex(usage.index) - pd.Timestamp(startdate)).days, dtype=float)[:, None]
+    valid = ~np.isnan(values)
+
+    # Last value of each column
+    lastrow = np.where(valid.any(axis=0), len(values) - 1 - np.argmax(valid[::-1], axis=0), 0)
+    columns = np.arange(values.shape[1])
+    last = np.where(valid.any(axis=0), values[lastrow, columns], np.nan)
+    lastday = np.where(valid.any(axis=0), days[lastrow, 0], np.nan)
+
+    inwindow = valid & (days > lastday - window)
+    n = inwindow.sum(axis=0)
+    y = np.where(inwindow, values, 0.)
+    t = np.where(inwindow, days, 0.)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        tmean = t.sum(axis=0) / n
+        ymean = y.sum(axis=0) / n
+        dt = np.where(inwindow, days - tmean, 0.)
+        var = (dt**2).sum(axis=0)
+        slope = (dt * (y - ymean)).sum(axis=0) / var
+        average = last / (lastday + 1)
+    rate = np.where((n >= 2) & (var > 0), slope, average)
+    # Usage is cumulative, so a falling total is a correction, not negative use
+    return last, lastday, np.clip(rate, 0., None)
+
+def forecast(usage, grant, startdate, enddate, window=14):
+    """
+    Forecast each column of usage (see burnrate) to enddate. grant is the
+    grant each column is compared to, a scalar or one value per column.
+    Returns a DataFrame, indexed by the columns of usage, of the usage to date,
+    the date of that usage, burn rate per day, projected usage at enddate, the
+    date the grant is, or would be, used up at the current rate (NaT if not
+    this quarter) and risk, the projected usage as a fraction of grant
+    """
+    startdate = pd.Timestamp(startdate)
+    enddate = pd.Timestamp(enddate)
+    grant = np.broadcast_to(np.asarray(grant, dtype=float), (usage.shape[1],))
+    quarterdays = (enddate - startdate).days
+
+    last, lastday, rate = burnrate(usage, startdate, window)
+    projected = last + rate * (quarterdays - lastday)
+
+    # Day of the quarter the grant runs out, either already or in future
+    values = usage.values.astype(float)
+    days = np.asarray((pd.DatetimeIndex(usage.index) - startdate).days, dtype=float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        over = values >= grant
+        usedup = np.where(over.any(axis=0), days[np.argmax(over, axis=0)], np.nan)
+        future = np.where(rate > 0, lastday + np.ceil((grant - last) / rate), np.nan)
+        exhaustion = np.where(np.isnan(usedup), future, usedup)
+        exhaustion[~(exhaustion <= quarterdays)] = np.nan
+        risk = projected / grant
+
+    return pd.DataFrame({ 'usage' : last,
+                          'date' : startdate + pd.to_timedelta(lastday, unit='D'),
+                          'rate' : rate,
+                          'projected' : projected,
+                          'grant' : grant,
+                          'exhaustion' : startdate + pd.to_timedelta(exhaustion, unit='D'),
+                          'risk' : risk },
+                        index=usage.columns)
+
+def rank(forecasts):
+    """Sort forecasts by risk, highest first, with no grant last"""
+    return forecasts.sort_values(['risk', 'projected'], ascending=False, na_position='last')
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2019 ARC Centre of Excellence for Climate Extremes
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import print_function
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import cProfile
+import json
+import threading
+import time
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        return False
+
+_nulltimer = _NullTimer()
+
+class _Timer(object):
+    def __init__(self, stats, phase):
+        self.stats = stats
+        self.phase = phase
+
+    def __enter__(self):
+        self.stats._stack().append([self.phase, time.time(), 0.])
+        return self
+
+    def __exit__(self, *exc):
+        self.stats._stop()
+        return False
+
+class IngestStats(object):
+    """
+    Counters and per-phase timers for database ingest. Timers can be nested,
+    and the time recorded against a phase excludes time spent in phases nested
+    inside it, so phase times add up to the total. Does nothing unless enabled
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.timers = OrderedDict()
+            self.counters = OrderedDict()
+            self.starttime = time.time()
+
+    def timer(self, phase):
+        if not self.enabled:
+            return _nulltimer
+        return _Timer(self, phase)
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def _stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def _stop(self):
+        stack = self._stack()
+        phase, start, childtime = stack.pop()
+        elapsed = time.time() - start
+        if stack:
+            stack[-1][2] += elapsed
+        with self.lock:
+            calls, seconds = self.timers.get(phase, (0, 0.))
+            self.timers[phase] = (calls + 1, seconds + elapsed - childtime)
+
+    def asdict(self):
+        with self.lock:
+            elapsed = time.time() - self.starttime
+            rows = self.counters.get('rows', 0)
+            return OrderedDict([
+                ('elapsed', elapsed),
+                ('rows_per_second', rows / elapsed if elapsed > 0 else None),
+                ('counters', OrderedDict(self.counters)),
+                ('phases', OrderedDict((phase, OrderedDict([('calls', calls), ('seconds', seconds)]))
+                                       for phase, (calls, seconds) in self.timers.items())),
+                ])
+
+    def summary(self):
+        data = self.asdict()
+        lines = ['Ingest statistics: {:.2f} s elapsed'.format(data['elapsed'])]
+        for name, value in data['counters'].items():
+            lines.append('  {:<12s} {:>14,d}'.format(name, int(value)))
+        if data['rows_per_second'] is not None and 'rows' in data['counters']:
+            lines.append('  {:<12s} {:>14,.1f}'.format('rows/s', data['rows_per_second']))
+        if 'bytes' in data['counters'] and data['elapsed'] > 0:
+            lines.append('  {:<12s} {:>14,.1f}'.format('MB/s', data['counters']['bytes'] / 1024.**2 / data['elapsed']))
+        lines.append('  {:<12s} {:>10s} {:>10s} {:>6s}'.format('phase', 'calls', 'seconds', '%'))
+        for phase, timer in data['phases'].items():
+            lines.append('  {:<12s} {:>10d} {:>10.3f} {:>6.1f}'.format(phase, timer['calls'], timer['seconds'],
+                                                                      100. * timer['seconds'] / data['elapsed']))
+        return '\n'.join(lines)
+
+    def write_json(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.asdict(), f, indent=1)
+
+# Shared by the datasets and the make_*_DB parsers
+stats = IngestStats()
+
+def add_arguments(parser):
+    """Add the instrumentation options to a make_*_DB argument parser"""
+    parser.add_argument("--stats", help="Print time spent in each phase of ingest", action='store_true')
+    parser.add_argument("--profile", help="Write cProfile statistics to this file")
+    parser.add_argument("--metrics", help="Write ingest statistics as JSON to this file")
+
+@contextmanager
+def instrument(args):
+    """
+    Enable ingest statistics and profiling as requested by the options added
+    with add_arguments
+    """
+    stats.enabled = getattr(args, 'stats', False) or getattr(args, 'metrics', None) is not None
+    stats.reset()
+    profiler = None
+    if getattr(args, 'profile', None) is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        yield stats
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        if getattr(args, 'metrics', None) is not None:
+            stats.write_json(args.metrics)
+        if getattr(args, 'stats', False):
+            print(stats.summary())
+        stats.enabled = False
@@ -20,60 +20,244 @@ limitations under the License.
 
 from __future__ import print_function
 
-from dataset import connect
+from collections import OrderedDict
 import datetime
-from pwd import getpwnam
+import re
 import pandas as pd
 import sqlalchemy
 
+from .DatasetBase import DatasetBase, connect
+from .IngestStats import stats
+from .QuantileSketch import DDSketch
+from .UserDirectory import users
+
 class NotInDatabase(Exception):
     pass
 
-class JobsDataset(object):
-
-    def __init__(self, dbfile=None):
+def jobs_url(database):
+    """URL of a jobs database given as a URL or the path of an SQLite file"""
+    if '://' in database:
+        return database
+    return 'sqlite:///' + database
+
+def open_jobs(dbfile=None, **kwargs):
+    """
+    Open the jobs dataset at dbfile, a JobsDataset for an SQLite URL or a
+    ParquetJobsDataset for a duckdb:/// URL, see ParquetJobs
+    """
+    if dbfile is not None and dbfile.startswith('duckdb://'):
+        from .ParquetJobs import ParquetJobsDataset
+        return ParquetJobsDataset(dbfile, **kwargs)
+    return JobsDataset(dbfile, **kwargs)
+
+class JobsDataset(DatasetBase):
+    """
+    Jobs are stored in a table for each year of their creation time,
+    Jobs_{year}, so queries of a date range only read the years they cover.
+    Older databases have a single Jobs table, which is read along with the
+    yearly tables, and moved into them when jobs are next added
+    """
+
+    facttables = ('Jobs', 'JobIndex', 'JobDaily')
+
+    # Columns of the jobs tables, in the order they are created by addjob
+    jobcolumns = ('year', 'jobid', 'project', 'queue', 'user', 'status', 'jobname', 'exe',
+                  'ctime', 'mtime', 'qtime', 'stime', 'waitime', 'maxwalltime', 'maxmem',
+                  'ncpus', 'walltime', 'mem', 'cputime', 'cpuutil', 'exitstatus')
+
+    schema = OrderedDict([
+        ('Project', (['project'], OrderedDict(project=''))),
+        ('Queue', (['queue'], OrderedDict(queue=''))),
+        ('JobState', (['status'], OrderedDict(status=''))),
+        ('Executable', (['path'], OrderedDict(path=''))),
+        ('User', (['username', 'fullname'], OrderedDict(username='', fullname=''))),
+        # Created for each year as Jobs_{year}. project, queue, user, status
+        # and exe are ids, and times other than ctime are seconds from ctime
+        ('Jobs', (['year', 'jobid'], OrderedDict(year=0, jobid='', project=0, queue=0, user=0, status=0, jobname='', exe=0,
+                                                 ctime=datetime.datetime.min, mtime=0., qtime=0., stime=0., waitime=0.,
+                                                 maxwalltime=0., maxmem=0, ncpus=0, walltime=0., mem=0, cputime=0.,
+                                                 cpuutil=0., exitstatus=0))),
+        ('JobIndex', (['jobid', 'year'], OrderedDict(jobid='', year=0, mtime=0., status=''))),
+        ('JobSketch', (['day', 'queue', 'ncpusbin', 'project', 'variable'],
+                       OrderedDict(day=datetime.date.min, queue='', ncpusbin='', project='', variable='', count=0, sketch=''))),
+        ])
+
+    partitioned = ('Jobs',)
+
+    def __init__(self, dbfile=None, bulk=False, profile=None):
         if dbfile is None:
             dbfile = 'sqlite:///jobs.db'
         self.dbfile = dbfile
-        self.db = connect(dbfile)
+        self.profile = profile
+        self.db = connect(dbfile, profile)
+        self._init_bulk(bulk)
+        # Quantile sketches updated by addjob, not yet written to the database
+        self.sketches = {}
+        # Changes to the daily rollups made by addjob, not yet written to the database
+        self.rollups = {}
+        self.migrated = False
+        # (mtime, status) of jobs read by loadindex, keyed on (year, jobid)
+        self.jobindex = {}
+        self.schema = OrderedDict(self.schema)
+        self.schema['JobDaily'] = (list(self.rollupkeys),
+                                   OrderedDict([(key, '' if key in ('day', 'ncpusbin') else 0) for key in self.rollupkeys] +
+                                               [(column, 0.) for column in self.rollupcolumns()]))
+
+    def close(self):
+        self.flushsketches()
+        self.flushrollups()
+        super(JobsDataset, self).close()
+
+    def rollback(self):
+        # Discard everything from the jobs rolled back, so they are counted
+        # once when they are added again
+        self.sketches = {}
+        self.rollups = {}
+        self.jobindex = {}
+        super(JobsDataset, self).rollback()
+
+    def createtables(self, partitions=()):
+        """
+        Move jobs out of the single Jobs table of older databases, and build
+        the daily rollups if they were not kept, before creating the tables
+        """
+        if not self.migrated:
+            self.migrate()
+            # Databases from before the daily rollups were kept
+            if 'JobDaily' not in self.db.tables:
+                self.buildrollups()
+            self.migrated = True
+        super(JobsDataset, self).createtables(partitions)
+
+    def jobstable(self, year):
+        return 'Jobs_{}'.format(int(year))
+
+    def partitions(self):
+        """Years which have a jobs table"""
+        years = []
+        for table in self.db.tables:
+            match = re.match(r'Jobs_(\d{4})$', table)
+            if match:
+                years.append(int(match.group(1)))
+        return sorted(years)
+
+    def haslegacy(self):
+        """True if there is a single Jobs table from an older database"""
+        return 'Jobs' in self.db.tables
+
+    def migrate(self):
+        """Move jobs from the single Jobs table of older databases into yearly tables"""
+        if not self.haslegacy():
+            return
+        columns = ', '.join(self.jobcolumns)
+        years = [record['year'] for record in self.db.query('SELECT DISTINCT year FROM Jobs')]
+        # Create the tables as addjob would, before the transaction which moves the jobs
+        for year in years:
+            self.createtable(self.jobstable(year))
+        with self.db as tx:
+            for year in years:
+                tx.query("""INSERT INTO {table} ({columns}) SELECT {columns} FROM Jobs
+                         WHERE year = :year ORDER BY id""".format(table=self.jobstable(year), columns=columns),
+                         year=year)
+            tx.query('DROP TABLE Jobs')
+        for year in years:
+            self.db[self.jobstable(year)].create_index(['year', 'jobid'])
+        print("Moved jobs into yearly tables for {}".format(', '.join(str(year) for year in years)))
+
+    def jobsource(self, startdate=None, enddate=None):
+        """
+        SQL for all the jobs which could have ctime between startdate and
+        enddate, aliased to Jobs, reading only the yearly tables which overlap
+        those dates. Returns None if there are no jobs tables
+        """
+        first = None if startdate is None else self.dateyear(startdate)
+        last = None if enddate is None else self.dateyear(enddate)
+        years = [year for year in self.partitions()
+                 if (first is None or year >= first) and (last is None or year <= last)]
+        columns = ', '.join(self.jobcolumns)
+        selects = ['SELECT {} FROM {}'.format(columns, self.jobstable(year)) for year in years]
+        if self.haslegacy():
+            where = ['1']
+            if first is not None:
+                where.append('year >= {:d}'.format(first))
+            if last is not None:
+                where.append('year <= {:d}'.format(last))
+            selects.append('SELECT {} FROM Jobs WHERE {}'.format(columns, ' AND '.join(where)))
+        elif len(years) == 1:
+            return '{} AS Jobs'.format(self.jobstable(years[0]))
+        if len(selects) == 0:
+            return None
+        return '({}) AS Jobs'.format(' UNION ALL '.join(selects))
+
+    def dateyear(self, date):
+        """Year of a date, datetime or date string"""
+        if hasattr(date, 'year'):
+            return date.year
+        return int(str(date)[:4])
 
     def getnumrecords(self):
-        q = None
-        try:
-            qstring = 'SELECT count(*) as count FROM Jobs'
-            q = self.db.query(qstring)
-        except sqlalchemy.exc.OperationalError:
-            pass
-        if q is None:
-            return 0
-        for record in q:
-            return record['count']
+        count = 0
+        tables = [self.jobstable(year) for year in self.partitions()]
+        if self.haslegacy():
+            tables.append('Jobs')
+        for table in tables:
+            for record in self.db.query('SELECT count(*) as count FROM {}'.format(table)):
+                count += record['count']
+        # Include jobs buffered in bulk mode
+        return count + sum(self.numpending(table) for table in self.pending if table.startswith('Jobs_'))
+
+    # Number of jobids in each query of the JobIndex table
+    indexchunk = 500
+
+    def loadindex(self, jobids):
+        """
+        Read the stored mtime and status of jobids from the JobIndex table,
+        a compact copy of those fields of every job, for unchanged()
+        """
+        self.jobindex = {}
+        jobids = list(jobids)
+        if 'JobIndex' in self.db.tables:
+            for i in range(0, len(jobids), self.indexchunk):
+                params = dict(('jobid{}'.format(n), jobid) for n, jobid in enumerate(jobids[i:i+self.indexchunk]))
+                qstring = "SELECT year, jobid, mtime, status FROM JobIndex WHERE jobid IN ({})".format(
+                    ', '.join(':{}'.format(name) for name in params))
+                for record in self.db.query(qstring, **params):
+                    self.jobindex[(record['year'], record['jobid'])] = (record['mtime'], record['status'])
+        # Entries buffered in bulk mode
+        jobids = set(jobids)
+        for record in self.pending.get('JobIndex', {}).values():
+            if record['jobid'] in jobids:
+                self.jobindex[(record['year'], record['jobid'])] = (record['mtime'], record['status'])
+
+    def unchanged(self, year, jobid, mtime, status):
+        """
+        True if this finished job was read by loadindex and is stored with the
+        same mtime, so does not need to be added again
+        """
+        return status == 'F' and self.jobindex.get((year, jobid)) == (mtime, status)
 
     def addproject(self, project):
         data = dict(project=project)
-        return self.db['Project'].upsert(data, list(data.keys()))
+        return self._upsert('Project', data, list(data.keys()), phase='lookup')
 
     def addqueue(self, queuename):
         data = dict(queue=queuename)
-        return self.db['Queue'].upsert(data, list(data.keys()))
+        return self._upsert('Queue', data, list(data.keys()), phase='lookup')
 
     def addstate(self, status):
         data = dict(status=status)
-        return self.db['JobState'].upsert(data, list(data.keys()))
+        return self._upsert('JobState', data, list(data.keys()), phase='lookup')
 
     def addexe(self, exepath):
         data = dict(path=exepath)
-        return self.db['Executable'].upsert(data, list(data.keys()))
+        return self._upsert('Executable', data, list(data.keys()), phase='lookup')
 
     def adduser(self, username, fullname=None):
-        if self.db['User'].find_one(username=username) is None:
+        if self._lookup('User', username=username) is None:
             if fullname is None:
-                try:
-                    fullname = getpwnam(username).pw_gecos
-                except KeyError:
-                    fullname = username
+                fullname = users.fullname(username) or username
             data = dict(username=username, fullname=fullname)
-            self.db['User'].upsert(data, list(data.keys()))
+            self._upsert('User', data, list(data.keys()), phase='lookup')
 
     def addjob(self, year, queuename, jobid, project, username,
                status, jobname, jobprio, exe, arguments,
@@ -81,17 +265,30 @@ class JobsDataset(object):
                maxwalltime, maxmem, ncpus,
                walltime, mem, cputime, cpuutil, exitstatus):
 
+        # Already done by begin(), unless jobs are added without it
+        if not self.migrated:
+            self.createtables()
+
         self.adduser(username)
         self.addqueue(queuename)
         self.addproject(project)
         self.addstate(status)
         self.addexe(exe)
 
-        user = self.db['User'].find_one(username=username)
-        queue = self.db['Queue'].find_one(queue=queuename)
-        proj = self.db['Project'].find_one(project=project)
-        stat = self.db['JobState'].find_one(status=status)
-        exe = self.db['Executable'].find_one(path=exe)
+        user = self._lookup('User', username=username)
+        queue = self._lookup('Queue', queue=queuename)
+        proj = self._lookup('Project', project=project)
+        stat = self._lookup('JobState', status=status)
+        exe = self._lookup('Executable', path=exe)
+
+        previous = self._lookup(self.jobstable(year), year=year, jobid=jobid)
+
+        # The same job appears in many dumps, so only add it to the sketches
+        # the first time it is seen as finished
+        if status == 'F':
+            if previous is None or previous['status'] != stat['id']:
+                self.addsketches(ctime.date(), queuename, ncpus, project,
+                                 waittime=waitime, walltime=walltime, cpuutil=cpuutil)
 
         data = dict(year=year, 
                     jobid=jobid,
@@ -116,7 +313,17 @@ class JobsDataset(object):
                     exitstatus=exitstatus
                     )
 
-        return self.db['Jobs'].upsert(data, ['year','jobid'])
+        # Replace the contribution of the stored version of the job to the
+        # daily rollups, which may have a different state or usage
+        if previous is not None:
+            self.addrollup(previous, -1)
+        self.addrollup(data)
+
+        self._upsert(self.jobstable(year), data, ['year','jobid'])
+
+        # jobid first, as loadindex selects by jobid
+        self.jobindex[(year, jobid)] = (mtime, status)
+        return self._upsert('JobIndex', dict(jobid=jobid, year=year, mtime=mtime, status=status), ['jobid', 'year'])
 
     # Default bin definitions are those use by NCI
     ncibins = [0, 2, 16, 128, 1024, float("inf")]
@@ -127,24 +334,34 @@ class JobsDataset(object):
         Returns most useful fields as a pandas dataframe
         """
 
-        qstring = """SELECT User.username, User.fullname, Project.project, Queue.queue, JobState.status, ctime, jobname, waitime, maxwalltime, 
-        maxmem, ncpus, mem, cputime, cpuutil, exitstatus from Jobs
+        # Unless start and end date specified return all records
+        if startdate is None or enddate is None:
+            startdate = enddate = None
+
+        source = self.jobsource(startdate, enddate)
+        if source is None:
+            print("No data available")
+            return None
+
+        qstring = """SELECT User.username, User.fullname, Project.project, Queue.queue, JobState.status, ctime, jobname, waitime, maxwalltime, walltime,
+        maxmem, ncpus, mem, cputime, cpuutil, exitstatus from {source}
         LEFT JOIN Project ON Jobs.project = Project.id
         LEFT JOIN User ON Jobs.user = User.id
         LEFT JOIN Queue ON Jobs.queue = Queue.id
         LEFT JOIN JobState ON Jobs.status = JobState.id
         """
 
+        where = []
         # Setting status None will return all jobs regardless of status
         if status is not None:
-            qstring += """WHERE JobState.status = \'{status}\'"""
-
-        # Unless start and end date specified return all records
-        if startdate is not None and enddate is not None:
-            qstring += """WHERE ctime between \'{start}\' AND \'{end}\'"""
+            where.append("""JobState.status = \'{status}\'""")
+        if startdate is not None:
+            where.append("""ctime between \'{start}\' AND \'{end}\'""")
+        if len(where) > 0:
+            qstring += "WHERE " + " AND ".join(where)
 
         try:
-            df = pd.read_sql_query(qstring.format(start=startdate,end=enddate,status=status), self.db.executable)
+            df = pd.read_sql_query(qstring.format(source=source,start=startdate,end=enddate,status=status), self.db.executable)
         except:
             print("No data available")
             return None
@@ -157,6 +374,457 @@ class JobsDataset(object):
             
         return df
 
+    # Fields which can be aggregated, using the names returned by getjobs
+    aggvars = { 'waittime' : 'Jobs.waitime',
+                'maxwalltime' : 'Jobs.maxwalltime',
+                'maxmem' : 'Jobs.maxmem',
+                'ncpus' : 'Jobs.ncpus',
+                'walltime' : 'Jobs.walltime',
+                'mem' : 'Jobs.mem',
+                'cputime' : 'Jobs.cputime',
+                'cpuutil' : 'Jobs.cpuutil',
+                'exitstatus' : 'Jobs.exitstatus' }
+
+    # Fields by which jobs can be grouped. ncpusbin is constructed from the
+    # bin definitions passed to aggregate
+    groupvars = { 'username' : 'User.username',
+                  'fullname' : 'User.fullname',
+                  'project' : 'Project.project',
+                  'queue' : 'Queue.queue',
+                  'status' : 'JobState.status',
+                  'jobname' : 'Jobs.jobname',
+                  'ncpus' : 'Jobs.ncpus',
+                  'exitstatus' : 'Jobs.exitstatus' }
+
+    aggfuncs = ('mean', 'median', 'count', 'sum')
+
+    def ncpusbin_sql(self, ncpubins=ncibins, ncpulabels=ncilabels):
+        """
+        SQL CASE expression equivalent to pd.cut(ncpus, ncpubins, labels=ncpulabels)
+        """
+        cases = []
+        for lower, upper, label in zip(ncpubins[:-1], ncpubins[1:], ncpulabels):
+            if upper == float("inf"):
+                cases.append("WHEN Jobs.ncpus > {} THEN '{}'".format(lower, label))
+            else:
+                cases.append("WHEN Jobs.ncpus > {} AND Jobs.ncpus <= {} THEN '{}'".format(lower, upper, label))
+        return "CASE {} ELSE NULL END".format(' '.join(cases))
+
+    def aggregate(self, plotvar='waittime', groupvar='queue', splitvar='ncpusbin', aggfunc='mean',
+                  startdate=None, enddate=None, status='F', projects=None, users=None,
+                  ncpubins=ncibins, ncpulabels=ncilabels):
+        """
+        Aggregate plotvar grouped by groupvar and splitvar in the database, and
+        return the result as a pandas dataframe indexed by groupvar with a column
+        for each value of splitvar, i.e. the same as
+
+            pd.pivot_table(getjobs(), values=plotvar, index=groupvar, columns=splitvar, aggfunc=aggfunc)
+
+        Jobs can be restricted to those with ctime between startdate and enddate
+        (inclusive), those belonging to a list of projects or users, and to a
+        given status (None for all jobs)
+        """
+
+        if plotvar not in self.aggvars:
+            raise ValueError('Incorrect value of plotvar: {} Valid values are {}'.format(plotvar, ', '.join(self.aggvars)))
+
+        if aggfunc not in self.aggfuncs:
+            raise ValueError('Incorrect value of aggfunc: {} Valid values are {}'.format(aggfunc, ', '.join(self.aggfuncs)))
+
+        dims = self.dimensions(groupvar, splitvar, ncpubins, ncpulabels)
+        names = ['groupvar', 'splitvar'][:len(dims)]
+
+        value = self.aggvars[plotvar]
+        where = ['{} IS NOT NULL'.format(dim) for dim in dims]
+        params = {}
+
+        if status is not None:
+            where.append('JobState.status = :status')
+            params['status'] = status
+        if startdate is not None:
+            where.append('Jobs.ctime >= :startdate')
+            params['startdate'] = self.date2date(startdate).isoformat()
+        if enddate is not None:
+            where.append('Jobs.ctime < :enddate')
+            params['enddate'] = (self.date2date(enddate) + datetime.timedelta(days=1)).isoformat()
+        for field, column, values in (('project', 'Project.project', projects), ('user', 'User.username', users)):
+            if values is None:
+                continue
+            values = list(values)
+            for i, v in enumerate(values):
+                params['{}{}'.format(field, i)] = v
+            where.append('{} IN ({})'.format(column, ', '.join(':{}{}'.format(field, i) for i in range(len(values)))))
+
+        selection = ', '.join('{} AS {}'.format(dim, name) for dim, name in zip(dims, names))
+
+        source = self.jobsource(startdate, enddate)
+        if source is None:
+            print("No data available")
+            return None
+
+        fromclause = """FROM """ + source + """
+        LEFT JOIN Project ON Jobs.project = Project.id
+        LEFT JOIN User ON Jobs.user = User.id
+        LEFT JOIN Queue ON Jobs.queue = Queue.id
+        LEFT JOIN JobState ON Jobs.status = JobState.id
+        WHERE {}""".format(' AND '.join(where) if where else '1')
+
+        if aggfunc == 'median':
+            # No median aggregate in SQLite, so rank the values in each group and
+            # average the middle one (odd count) or two (even count) values
+            qstring = """WITH Ranked AS (
+            SELECT {selection}, {value} AS value,
+            ROW_NUMBER() OVER (PARTITION BY {partition} ORDER BY {value}) AS rank,
+            COUNT(*) OVER (PARTITION BY {partition}) AS num
+            {fromclause} AND {value} IS NOT NULL)
+            SELECT {names}, AVG(value) AS value FROM Ranked
+            WHERE rank IN ((num + 1) / 2, (num + 2) / 2)
+            GROUP BY {names}"""
+        else:
+            agg = {'mean': 'AVG', 'count': 'COUNT', 'sum': 'SUM'}[aggfunc]
+            qstring = """SELECT {selection}, """ + agg + """({value}) AS value
+            {fromclause}
+            GROUP BY {names}"""
+
+        qstring = qstring.format(selection=selection, value=value, partition=', '.join(dims),
+                                 fromclause=fromclause, names=', '.join(names))
+
+        try:
+            df = pd.read_sql_query(sqlalchemy.text(qstring), self.db.executable, params=params)
+        except sqlalchemy.exc.OperationalError:
+            print("No data available")
+            return None
+
+        return self.unstack(df, plotvar, groupvar, splitvar, ncpulabels)
+
+    def dimensions(self, groupvar, splitvar, ncpubins=ncibins, ncpulabels=ncilabels):
+        """SQL expressions for the aggregate grouping variables"""
+        dims = []
+        for var in [groupvar] + ([] if splitvar is None else [splitvar]):
+            if var == 'ncpusbin':
+                dims.append(self.ncpusbin_sql(ncpubins, ncpulabels))
+            elif var in self.groupvars:
+                dims.append(self.groupvars[var])
+            else:
+                raise ValueError('Incorrect value of grouping variable: {} Valid values are ncpusbin, {}'.format(var, ', '.join(self.groupvars)))
+        return dims
+
+    def unstack(self, df, plotvar, groupvar, splitvar, ncpulabels=ncilabels):
+        """
+        Reshape aggregated rows of groupvar, splitvar and value into a series
+        indexed by groupvar, or a dataframe with a column for each splitvar
+        """
+        if splitvar is None:
+            return df.set_index('groupvar')['value'].rename_axis(groupvar).rename(plotvar)
+
+        df = df.pivot(index='groupvar', columns='splitvar', values='value')
+        df = df.rename_axis(index=groupvar, columns=splitvar)
+
+        # Order bins by size rather than alphabetically
+        if groupvar == 'ncpusbin':
+            df = df.reindex([l for l in ncpulabels if l in df.index])
+        if splitvar == 'ncpusbin':
+            df = df.reindex(columns=[l for l in ncpulabels if l in df.columns])
+
+        return df
+
+    # Job variables for which quantile sketches are kept
+    sketchvars = ('waittime', 'walltime', 'cpuutil')
+
+    def ncpusbin(self, ncpus, ncpubins=ncibins, ncpulabels=ncilabels):
+        """
+        Return the label of the bin containing ncpus, as pd.cut
+        """
+        if ncpus is None:
+            return None
+        for lower, upper, label in zip(ncpubins[:-1], ncpubins[1:], ncpulabels):
+            if lower < ncpus <= upper:
+                return label
+        return None
+
+    def addsketches(self, day, queuename, ncpus, project, **values):
+        """
+        Add values to the in-memory quantile sketches for this day, queue, ncpus
+        bin and project. Negative values are used to flag missing data, so are
+        skipped. Call flushsketches to save them to the database
+        """
+        ncpusbin = self.ncpusbin(ncpus)
+        for variable, value in values.items():
+            if value is None or value < 0:
+                continue
+            key = (day, queuename, ncpusbin, project, variable)
+            if key not in self.sketches:
+                self.sketches[key] = DDSketch()
+            self.sketches[key].add(value)
+
+    def flushsketches(self):
+        """
+        Merge in-memory quantile sketches with those in the database
+        """
+        if len(self.sketches) == 0:
+            return
+        keys = ['day', 'queue', 'ncpusbin', 'project', 'variable']
+        with stats.timer('sketches'), self.db as tx:
+            table = tx['JobSketch']
+            for key, sketch in self.sketches.items():
+                data = dict(zip(keys, key))
+                if table.exists:
+                    record = table.find_one(**data)
+                    if record is not None:
+                        sketch.merge(DDSketch.from_json(record['sketch']))
+                data['count'] = sketch.count
+                data['sketch'] = sketch.to_json()
+                table.upsert(data, keys)
+        self.sketches = {}
+
+    def getquantiles(self, variable='waittime', quantiles=(0.5, 0.9, 0.99), by=('queue', 'ncpusbin'),
+                     startdate=None, enddate=None, projects=None):
+        """
+        Return quantiles of variable for finished jobs with ctime between startdate
+        and enddate (inclusive) by merging the stored daily sketches. Returns a
+        pandas dataframe indexed by the by fields, with the number of jobs and a
+        column for each quantile
+        """
+
+        if variable not in self.sketchvars:
+            raise ValueError('Incorrect value of variable: {} Valid values are {}'.format(variable, ', '.join(self.sketchvars)))
+
+        by = list(by)
+        for field in by:
+            if field not in ('day', 'queue', 'ncpusbin', 'project'):
+                raise ValueError('Cannot group sketches by {} Valid values are day, queue, ncpusbin or project'.format(field))
+
+        if 'JobSketch' not in self.db:
+            print("No data available")
+            return None
+
+        qstring = "SELECT * FROM JobSketch WHERE variable = :variable"
+        params = dict(variable=variable)
+        if startdate is not None:
+            qstring += " AND day >= :startdate"
+            params['startdate'] = self.date2date(startdate).isoformat()
+        if enddate is not None:
+            qstring += " AND day <= :enddate"
+            params['enddate'] = self.date2date(enddate).isoformat()
+
+        merged = {}
+        for record in self.db.query(qstring, **params):
+            if projects is not None and record['project'] not in projects:
+                continue
+            key = tuple(record[field] for field in by)
+            sketch = DDSketch.from_json(record['sketch'])
+            if key in merged:
+                merged[key].merge(sketch)
+            else:
+                merged[key] = sketch
+
+        rows = []
+        for key in sorted(merged, key=lambda k: tuple(str(v) for v in k)):
+            sketch = merged[key]
+            rows.append(list(key) + [sketch.count] + [sketch.quantile(q) for q in quantiles])
+
+        df = pd.DataFrame(rows, columns=by + ['count'] + list(quantiles))
+        return df.set_index(by)
+
+    # Job variables summed in the daily rollups, and SQL for their values in a
+    # jobs table. coretime is walltime * ncpus, to which SU are proportional
+    rollupvars = OrderedDict([('waittime', 'Jobs.waitime'),
+                              ('walltime', 'Jobs.walltime'),
+                              ('cputime', 'Jobs.cputime'),
+                              ('mem', 'Jobs.mem'),
+                              ('coretime', 'CASE WHEN Jobs.walltime >= 0 THEN Jobs.walltime * Jobs.ncpus END')])
+
+    # Keys of the JobDaily table. project, user, queue and status are ids, as
+    # in the jobs tables
+    rollupkeys = ('day', 'project', 'user', 'queue', 'ncpusbin', 'status')
+
+    def rollupcolumns(self):
+        """
+        Columns of the JobDaily table: the number of jobs, then the number of
+        jobs with a value, the sum and the sum of squares of each variable,
+        and the sum of waittime * coretime for SU weighted wait times
+        """
+        columns = ['jobs']
+        for variable in self.rollupvars:
+            columns += ['{}_count'.format(variable), '{}_sum'.format(variable), '{}_sumsq'.format(variable)]
+        return columns + ['waittime_coretime']
+
+    def rollupsums(self):
+        """SQL for the rollup columns aggregated over jobs"""
+        sums = ['COUNT(*) AS jobs']
+        for variable, value in self.rollupvars.items():
+            # Negative values flag missing data
+            # As DOUBLE, as sums of squares of integers overflow
+            valid = 'CASE WHEN {0} >= 0 THEN CAST({0} AS DOUBLE) END'.format(value)
+            sums += ['COUNT({}) AS {}_count'.format(valid, variable),
+                     'COALESCE(SUM({}), 0) AS {}_sum'.format(valid, variable),
+                     'COALESCE(SUM(({0}) * ({0})), 0) AS {1}_sumsq'.format(valid, variable)]
+        sums.append('COALESCE(SUM(CASE WHEN {wait} >= 0 AND {core} >= 0 THEN CAST({wait} AS DOUBLE) * {core} END), 0) AS waittime_coretime'.format(
+            wait=self.rollupvars['waittime'], core=self.rollupvars['coretime']))
+        return sums
+
+    def addrollup(self, job, sign=1):
+        """
+        Add (sign=1) or subtract (sign=-1) a row of a jobs table to the
+        in-memory changes to the daily rollups, keyed on the day of its
+        creation time. Call flushrollups to save them to the database
+        """
+        key = (str(job['ctime'])[:10], job['project'], job['user'], job['queue'],
+               self.ncpusbin(job['ncpus']), job['status'])
+        if key not in self.rollups:
+            self.rollups[key] = OrderedDict((column, 0.) for column in self.rollupcolumns())
+        totals = self.rollups[key]
+        totals['jobs'] += sign
+
+        walltime = job['walltime']
+        values = dict(waittime=job['waitime'], walltime=walltime, cputime=job['cputime'], mem=job['mem'],
+                      coretime=None if walltime is None or walltime < 0 or job['ncpus'] is None else walltime * job['ncpus'])
+        for variable, value in values.items():
+            if value is None or value < 0:
+                continue
+            totals['{}_count'.format(variable)] += sign
+            totals['{}_sum'.format(variable)] += sign * value
+            totals['{}_sumsq'.format(variable)] += sign * value * value
+        if values['coretime'] is not None and values['waittime'] is not None and values['waittime'] >= 0:
+            totals['waittime_coretime'] += sign * values['waittime'] * values['coretime']
+
+    def flushrollups(self):
+        """
+        Add the in-memory changes to the daily rollups to the JobDaily table
+        """
+        if len(self.rollups) == 0:
+            return
+        columns = self.rollupcolumns()
+        with stats.timer('rollups'), self.db as tx:
+            table = tx['JobDaily']
+            # Read the stored rollups of the days changed, rather than one
+            # key at a time, then replace those which changed
+            stored = {}
+            if table.exists:
+                days = sorted(set(key[0] for key in self.rollups))
+                for i in range(0, len(days), self.indexchunk):
+                    for record in table.find(day=days[i:i+self.indexchunk]):
+                        stored[tuple(record[key] for key in self.rollupkeys)] = record
+            rows = []; replaced = []
+            for key, totals in self.rollups.items():
+                record = stored.get(key)
+                if record is not None:
+                    replaced.append(record['id'])
+                    for column in columns:
+                        totals[column] += record[column]
+                if totals['jobs'] > 0:
+                    row = OrderedDict(zip(self.rollupkeys, key))
+                    row.update(totals)
+                    rows.append(row)
+            for i in range(0, len(replaced), self.indexchunk):
+                table.delete(id=replaced[i:i+self.indexchunk])
+            table.insert_many(rows)
+        if 'JobDaily' in self.db.tables:
+            self.db['JobDaily'].create_index(list(self.rollupkeys))
+        self.rollups = {}
+
+    def buildrollups(self):
+        """
+        Replace the JobDaily table with rollups of all the stored jobs
+        """
+        source = self.jobsource()
+        if source is None:
+            return
+        qstring = """SELECT substr(Jobs.ctime, 1, 10) AS day, Jobs.project, Jobs.user, Jobs.queue,
+        {ncpusbin} AS ncpusbin, Jobs.status, {sums} FROM {source}
+        GROUP BY 1, 2, 3, 4, 5, 6""".format(ncpusbin=self.ncpusbin_sql(), sums=', '.join(self.rollupsums()), source=source)
+        self.createtable('JobDaily')
+        with stats.timer('rollups'), self.db as tx:
+            tx.query('DELETE FROM JobDaily')
+            tx['JobDaily'].insert_many([dict(record) for record in tx.query(qstring)])
+        if 'JobDaily' in self.db.tables:
+            self.db['JobDaily'].create_index(list(self.rollupkeys))
+
+    # Fields by which the daily rollups can be grouped
+    dailyfields = { 'day' : 'JobDaily.day',
+                    'project' : 'Project.project',
+                    'username' : 'User.username',
+                    'queue' : 'Queue.queue',
+                    'ncpusbin' : 'JobDaily.ncpusbin',
+                    'status' : 'JobState.status' }
+
+    def getdaily(self, by=('day', 'queue'), startdate=None, enddate=None, status='F', projects=None, users=None):
+        """
+        Return statistics of jobs with ctime between startdate and enddate
+        (inclusive) from the daily rollups, without reading the jobs tables.
+        Returns a pandas dataframe indexed by the by fields, see dailystats.
+        Jobs can be restricted to a status (None for all jobs) and lists of
+        projects or users
+        """
+        by = self.dailyby(by)
+
+        if 'JobDaily' not in self.db.tables:
+            print("No data available")
+            return None
+
+        where = []
+        params = {}
+        if status is not None:
+            where.append('JobState.status = :status')
+            params['status'] = status
+        if startdate is not None:
+            where.append('JobDaily.day >= :startdate')
+            params['startdate'] = self.date2date(startdate).isoformat()
+        if enddate is not None:
+            where.append('JobDaily.day <= :enddate')
+            params['enddate'] = self.date2date(enddate).isoformat()
+        for field, column, values in (('project', 'Project.project', projects), ('user', 'User.username', users)):
+            if values is None:
+                continue
+            values = list(values)
+            for i, v in enumerate(values):
+                params['{}{}'.format(field, i)] = v
+            where.append('{} IN ({})'.format(column, ', '.join(':{}{}'.format(field, i) for i in range(len(values)))))
+
+        qstring = """SELECT {selection}, {sums} FROM JobDaily
+        LEFT JOIN Project ON JobDaily.project = Project.id
+        LEFT JOIN User ON JobDaily.user = User.id
+        LEFT JOIN Queue ON JobDaily.queue = Queue.id
+        LEFT JOIN JobState ON JobDaily.status = JobState.id
+        WHERE {where}
+        GROUP BY {names}""".format(
+            selection=', '.join('{} AS {}'.format(self.dailyfields[field], field) for field in by),
+            sums=', '.join('SUM(JobDaily.{0}) AS {0}'.format(column) for column in self.rollupcolumns()),
+            where=' AND '.join(where) if where else '1', names=', '.join(self.dailyfields[field] for field in by))
+
+        df = pd.read_sql_query(sqlalchemy.text(qstring), self.db.executable, params=params)
+        return self.dailystats(df, by)
+
+    def dailyby(self, by):
+        by = list(by)
+        for field in by:
+            if field not in self.dailyfields:
+                raise ValueError('Cannot group daily rollups by {} Valid values are {}'.format(field, ', '.join(sorted(self.dailyfields))))
+        return by
+
+    def dailystats(self, df, by):
+        """
+        Statistics from summed rollup columns: the number of jobs, then the
+        mean, (sample) standard deviation and sum of each of rollupvars, the
+        CPU efficiency, total cputime / total coretime, and the wait time
+        weighted by coretime, i.e. by SU
+        """
+        df = df.set_index(by).sort_index().astype(float)
+        result = pd.DataFrame(index=df.index)
+        result['jobs'] = df['jobs'].astype(int)
+        for variable in self.rollupvars:
+            count = df['{}_count'.format(variable)]
+            total = df['{}_sum'.format(variable)]
+            sumsq = df['{}_sumsq'.format(variable)]
+            result['{}_mean'.format(variable)] = total / count.where(count > 0)
+            variance = (sumsq - total * total / count.where(count > 0)) / (count - 1).where(count > 1)
+            result['{}_std'.format(variable)] = variance.clip(lower=0) ** 0.5
+            result['{}_sum'.format(variable)] = total
+        coretime = df['coretime_sum'].where(df['coretime_sum'] > 0)
+        result['cpuefficiency'] = df['cputime_sum'] / coretime
+        result['weightedwaittime'] = df['waittime_coretime'] / coretime
+        return result
+
     def getuser(self, username=None):
         return self.db['User'].find_one(username=username)
 
@@ -0,0 +1,480 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2019 ARC Centre of Excellence for Climate Extremes
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Jobs stored as Parquet files and queried with DuckDB, a columnar engine which
+scans and aggregates millions of jobs much faster than SQLite. Opened by
+open_jobs with a URL of the form
+
+    duckdb:///path/to/directory
+
+Each year of jobs is a directory, Jobs_{year}, holding base.parquet, all its
+jobs sorted by ctime, and a delta-{version}.parquet for every commit since.
+Parquet files cannot be updated, so a job which changes is written again in
+a later delta, and queries read the latest version of each job. Once a year
+has maxdeltas deltas they are merged into a new base file. Jobs are stored
+with the names of their user, project, queue and so on rather than ids, as
+columnar compression makes repeated strings cheap. Requires the duckdb
+package.
+"""
+
+from __future__ import print_function
+
+from collections import OrderedDict
+import datetime
+import glob
+import os
+import re
+import time
+import pandas as pd
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+from .JobsDataset import JobsDataset
+from .IngestStats import stats
+from .UserDirectory import users
+
+scheme = 'duckdb:///'
+
+def quote(path):
+    return "'{}'".format(path.replace("'", "''"))
+
+class ParquetJobsDataset(JobsDataset):
+
+    # Type of each column of the Parquet files
+    schema = OrderedDict([('year', 'INTEGER'), ('jobid', 'VARCHAR'), ('project', 'VARCHAR'),
+                          ('queue', 'VARCHAR'), ('username', 'VARCHAR'), ('fullname', 'VARCHAR'),
+                          ('status', 'VARCHAR'), ('jobname', 'VARCHAR'), ('exe', 'VARCHAR'),
+                          ('ctime', 'TIMESTAMP'), ('mtime', 'DOUBLE'), ('qtime', 'DOUBLE'),
+                          ('stime', 'DOUBLE'), ('waitime', 'DOUBLE'), ('maxwalltime', 'DOUBLE'),
+                          ('maxmem', 'BIGINT'), ('ncpus', 'INTEGER'), ('walltime', 'DOUBLE'),
+                          ('mem', 'BIGINT'), ('cputime', 'DOUBLE'), ('cpuutil', 'DOUBLE'),
+                          ('exitstatus', 'INTEGER'), ('version', 'BIGINT')])
+
+    # Names are stored in the jobs, so no joins are needed to group by them
+    groupvars = { 'username' : 'Jobs.username',
+                  'fullname' : 'Jobs.fullname',
+                  'project' : 'Jobs.project',
+                  'queue' : 'Jobs.queue',
+                  'status' : 'Jobs.status',
+                  'jobname' : 'Jobs.jobname',
+                  'ncpus' : 'Jobs.ncpus',
+                  'exitstatus' : 'Jobs.exitstatus' }
+
+    # Number of deltas of a year before they are merged into its base file
+    maxdeltas = 8
+
+    def __init__(self, dbfile=None, bulk=False, profile=None):
+        if duckdb is None:
+            raise ImportError("Reading {} requires the duckdb package".format(dbfile))
+        if dbfile is None:
+            dbfile = scheme + 'jobs'
+        if not dbfile.startswith(scheme):
+            raise ValueError('Incorrect value of dbfile: {} Must start with {}'.format(dbfile, scheme))
+        self.dbfile = dbfile
+        self.path = dbfile[len(scheme):]
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        # Queries run in an in-memory database which reads the Parquet files
+        self.con = duckdb.connect()
+        # Jobs added since the last commit, keyed on (year, jobid). Writes are
+        # always buffered, so bulk and profile are accepted for compatibility
+        self.pending = OrderedDict()
+        self.bulk = bulk
+        self.version = 0
+        self.jobindex = {}
+
+    def close(self):
+        self.commit()
+        self.con.close()
+
+    def begin(self, partitions=()):
+        pass
+
+    def commit(self):
+        """Write the jobs added since the last commit as a new delta of each year"""
+        if len(self.pending) == 0:
+            return
+        with stats.timer('commit'):
+            self.write(pd.DataFrame(list(self.pending.values()), columns=list(self.schema)[:-1]))
+        self.pending = OrderedDict()
+
+    def rollback(self):
+        self.pending = OrderedDict()
+
+    def flush(self):
+        self.commit()
+
+    def flushsketches(self):
+        """Quantiles are calculated exactly from the jobs, so there are no sketches"""
+        pass
+
+    def flushrollups(self):
+        """Daily statistics are calculated from the jobs, so there are no rollups"""
+        pass
+
+    def buildrollups(self):
+        pass
+
+    def nextversion(self):
+        self.version = max(self.version + 1, int(time.time() * 1000000))
+        return self.version
+
+    def yeardir(self, year):
+        return os.path.join(self.path, self.jobstable(year))
+
+    def partitions(self):
+        years = []
+        for path in glob.glob(os.path.join(self.path, 'Jobs_*')):
+            match = re.match(r'Jobs_(\d{4})$', os.path.basename(path))
+            if match and len(self.files(int(match.group(1)))) > 0:
+                years.append(int(match.group(1)))
+        return sorted(years)
+
+    def files(self, year):
+        """Parquet files of year, the base file first"""
+        base = os.path.join(self.yeardir(year), 'base.parquet')
+        deltas = sorted(glob.glob(os.path.join(self.yeardir(year), 'delta-*.parquet')))
+        return ([base] if os.path.exists(base) else []) + deltas
+
+    def haslegacy(self):
+        return False
+
+    def migrate(self):
+        pass
+
+    def casts(self, relation):
+        """Select the jobs columns of relation as their stored types"""
+        return 'SELECT {} FROM {}'.format(', '.join('CAST({0} AS {1}) AS {0}'.format(column, dtype)
+                                                    for column, dtype in self.schema.items()), relation)
+
+    def write(self, jobs):
+        """
+        Write a dataframe of jobs, with the columns of schema other than
+        version, as a new delta file of each year they belong to
+        """
+        jobs = jobs.assign(version=self.nextversion())
+        for year, rows in jobs.groupby('year'):
+            directory = self.yeardir(year)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            filename = os.path.join(directory, 'delta-{:020d}.parquet'.format(self.version))
+            self.copy(rows, filename, order=False)
+            if sum(1 for f in self.files(year) if os.path.basename(f).startswith('delta-')) >= self.maxdeltas:
+                self.compact([year])
+
+    def copy(self, rows, filename, order=True):
+        """Write a dataframe, or SQL query, of jobs to a Parquet file, atomically"""
+        if isinstance(rows, pd.DataFrame):
+            self.con.register('newjobs', rows)
+            query = self.casts('newjobs')
+        else:
+            query = rows
+        if order:
+            query += ' ORDER BY ctime'
+        tmpfile = '{}.{}.tmp'.format(filename, os.getpid())
+        self.con.execute('COPY ({}) TO {} (FORMAT PARQUET)'.format(query, quote(tmpfile)))
+        if isinstance(rows, pd.DataFrame):
+            self.con.unregister('newjobs')
+        os.replace(tmpfile, filename)
+
+    def latest(self, relation):
+        """The latest version of each job in relation"""
+        return 'SELECT * FROM {} QUALIFY row_number() OVER (PARTITION BY year, jobid ORDER BY version DESC) = 1'.format(relation)
+
+    def compact(self, years=None):
+        """Merge the base and deltas of years (default all) into a new base file"""
+        if years is None:
+            years = self.partitions()
+        for year in years:
+            files = self.files(year)
+            if len(files) == 0 or files == [os.path.join(self.yeardir(year), 'base.parquet')]:
+                continue
+            with stats.timer('compact'):
+                self.copy(self.latest('read_parquet([{}])'.format(', '.join(quote(f) for f in files))),
+                          os.path.join(self.yeardir(year), 'base.parquet'))
+                for filename in files:
+                    if os.path.basename(filename).startswith('delta-'):
+                        os.remove(filename)
+
+    def jobsource(self, startdate=None, enddate=None):
+        """
+        SQL for the latest version of all the jobs which could have ctime
+        between startdate and enddate, including those not yet committed,
+        aliased to Jobs. Returns None if there are no jobs
+        """
+        first = None if startdate is None else self.dateyear(startdate)
+        last = None if enddate is None else self.dateyear(enddate)
+        years = [year for year in self.partitions()
+                 if (first is None or year >= first) and (last is None or year <= last)]
+        files = [filename for year in years for filename in self.files(year)]
+
+        selects = []
+        if len(files) > 0:
+            selects.append('SELECT * FROM read_parquet([{}])'.format(', '.join(quote(f) for f in files)))
+        if len(self.pending) > 0:
+            pending = pd.DataFrame(list(self.pending.values()), columns=list(self.schema)[:-1])
+            # Newer than any committed version
+            self.con.register('pendingjobs', pending.assign(version=2**62))
+            selects.append(self.casts('pendingjobs'))
+        if len(selects) == 0:
+            return None
+
+        source = ' UNION ALL BY NAME '.join(selects)
+        # Only a single compacted file per year has no old versions of jobs
+        if len(selects) > 1 or len(files) > len(years):
+            source = self.latest('({})'.format(source))
+        return '({}) AS Jobs'.format(source)
+
+    def query(self, qstring, params=None):
+        return self.con.execute(qstring, params or []).df()
+
+    def getnumrecords(self):
+        source = self.jobsource()
+        if source is None:
+            return 0
+        return int(self.con.execute('SELECT count(*) FROM {}'.format(source)).fetchone()[0])
+
+    def loadindex(self, jobids):
+        self.jobindex = {}
+        source = self.jobsource()
+        if source is None:
+            return
+        self.con.register('jobids', pd.DataFrame({'jobid': list(jobids)}, dtype=object))
+        for year, jobid, mtime, status in self.con.execute(
+                'SELECT year, Jobs.jobid, mtime, status FROM {} JOIN jobids ON Jobs.jobid = jobids.jobid'.format(source)).fetchall():
+            self.jobindex[(year, jobid)] = (mtime, status)
+        self.con.unregister('jobids')
+
+    def adduser(self, username, fullname=None):
+        pass
+
+    def addjob(self, year, queuename, jobid, project, username,
+               status, jobname, jobprio, exe, arguments,
+               ctime, mtime, qtime, stime, waitime,
+               maxwalltime, maxmem, ncpus,
+               walltime, mem, cputime, cpuutil, exitstatus):
+
+        with stats.timer('buffer'):
+            self.pending[(year, jobid)] = (year, jobid, project, queuename, username,
+                                           users.fullname(username) or username, status, jobname, exe,
+                                           ctime, mtime, qtime, stime, waitime, maxwalltime, maxmem,
+                                           ncpus, walltime, mem, cputime, cpuutil, exitstatus)
+        self.jobindex[(year, jobid)] = (mtime, status)
+        return True
+
+    def getjobs(self, startdate=None, enddate=None, status='F', ncpubins=JobsDataset.ncibins, ncpulabels=JobsDataset.ncilabels):
+        """
+        Returns most useful fields as a pandas dataframe
+        """
+
+        # Unless start and end date specified return all records
+        if startdate is None or enddate is None:
+            startdate = enddate = None
+
+        source = self.jobsource(startdate, enddate)
+        if source is None:
+            print("No data available")
+            return None
+
+        qstring = """SELECT username, fullname, project, queue, status, ctime, jobname, waitime, maxwalltime, walltime,
+        maxmem, ncpus, mem, cputime, cpuutil, exitstatus FROM {}""".format(source)
+
+        where = []; params = []
+        if status is not None:
+            where.append("status = ?")
+            params.append(status)
+        if startdate is not None:
+            where.append("ctime BETWEEN CAST(? AS TIMESTAMP) AND CAST(? AS TIMESTAMP)")
+            params += [str(startdate), str(enddate)]
+        if len(where) > 0:
+            qstring += " WHERE " + " AND ".join(where)
+
+        df = self.query(qstring, params)
+
+        if ncpubins is not None and ncpulabels is not None:
+            df = df.assign(ncpusbin = pd.cut(df.ncpus, ncpubins, labels=ncpulabels))
+
+        df.rename(columns={'waitime':'waittime'}, inplace=True)
+
+        return df
+
+    def aggregate(self, plotvar='waittime', groupvar='queue', splitvar='ncpusbin', aggfunc='mean',
+                  startdate=None, enddate=None, status='F', projects=None, users=None,
+                  ncpubins=JobsDataset.ncibins, ncpulabels=JobsDataset.ncilabels):
+        """
+        Aggregate plotvar grouped by groupvar and splitvar, as JobsDataset.aggregate
+        """
+
+        if plotvar not in self.aggvars:
+            raise ValueError('Incorrect value of plotvar: {} Valid values are {}'.format(plotvar, ', '.join(self.aggvars)))
+
+        if aggfunc not in self.aggfuncs:
+            raise ValueError('Incorrect value of aggfunc: {} Valid values are {}'.format(aggfunc, ', '.join(self.aggfuncs)))
+
+        dims = self.dimensions(groupvar, splitvar, ncpubins, ncpulabels)
+        names = ['groupvar', 'splitvar'][:len(dims)]
+
+        where = ['{} IS NOT NULL'.format(dim) for dim in dims]
+        params = []
+        if status is not None:
+            where.append('Jobs.status = ?')
+            params.append(status)
+        if startdate is not None:
+            where.append('Jobs.ctime >= CAST(? AS TIMESTAMP)')
+            params.append(self.date2date(startdate).isoformat())
+        if enddate is not None:
+            where.append('Jobs.ctime < CAST(? AS TIMESTAMP)')
+            params.append((self.date2date(enddate) + datetime.timedelta(days=1)).isoformat())
+        for column, values in (('Jobs.project', projects), ('Jobs.username', users)):
+            if values is None:
+                continue
+            values = list(values)
+            where.append('{} IN ({})'.format(column, ', '.join('?' for v in values)))
+            params += values
+
+        source = self.jobsource(startdate, enddate)
+        if source is None:
+            print("No data available")
+            return None
+
+        agg = {'mean': 'AVG', 'median': 'MEDIAN', 'count': 'COUNT', 'sum': 'SUM'}[aggfunc]
+        qstring = """SELECT {selection}, {agg}({value}) AS value FROM {source}
+        WHERE {where} GROUP BY {names}""".format(
+            selection=', '.join('{} AS {}'.format(dim, name) for dim, name in zip(dims, names)),
+            agg=agg, value=self.aggvars[plotvar], source=source,
+            where=' AND '.join(where), names=', '.join(names))
+
+        df = self.query(qstring, params)
+
+        return self.unstack(df.sort_values(names), plotvar, groupvar, splitvar, ncpulabels)
+
+    def getquantiles(self, variable='waittime', quantiles=(0.5, 0.9, 0.99), by=('queue', 'ncpusbin'),
+                     startdate=None, enddate=None, projects=None):
+        """
+        Return exact quantiles of variable for finished jobs, with the same
+        arguments and result as JobsDataset.getquantiles
+        """
+
+        if variable not in self.sketchvars:
+            raise ValueError('Incorrect value of variable: {} Valid values are {}'.format(variable, ', '.join(self.sketchvars)))
+
+        fields = { 'day' : 'CAST(Jobs.ctime AS DATE)',
+                   'queue' : 'Jobs.queue',
+                   'ncpusbin' : self.ncpusbin_sql(),
+                   'project' : 'Jobs.project' }
+        by = list(by)
+        for field in by:
+            if field not in fields:
+                raise ValueError('Cannot group sketches by {} Valid values are day, queue, ncpusbin or project'.format(field))
+
+        source = self.jobsource(startdate, enddate)
+        if source is None:
+            print("No data available")
+            return None
+
+        # Negative values flag missing data
+        value = self.aggvars[variable]
+        where = ["Jobs.status = 'F'", '{} >= 0'.format(value)]
+        params = []
+        if startdate is not None:
+            where.append('CAST(Jobs.ctime AS DATE) >= CAST(? AS DATE)')
+            params.append(self.date2date(startdate).isoformat())
+        if enddate is not None:
+            where.append('CAST(Jobs.ctime AS DATE) <= CAST(? AS DATE)')
+            params.append(self.date2date(enddate).isoformat())
+        if projects is not None:
+            projects = list(projects)
+            where.append('Jobs.project IN ({})'.format(', '.join('?' for p in projects)))
+            params += projects
+
+        names = ['by{}'.format(i) for i in range(len(by))]
+        qstring = """SELECT {selection}, COUNT({value}) AS count, {quantiles} FROM {source}
+        WHERE {where} GROUP BY ALL ORDER BY ALL""".format(
+            selection=', '.join('{} AS {}'.format(fields[field], name) for field, name in zip(by, names)),
+            value=value, source=source, where=' AND '.join(where),
+            quantiles=', '.join('quantile_disc({}, {}) AS q{}'.format(value, float(q), i) for i, q in enumerate(quantiles)))
+
+        df = self.query(qstring, params)
+        df.columns = by + ['count'] + list(quantiles)
+        if 'day' in by:
+            df['day'] = df['day'].dt.date.astype(str)
+        return df.set_index(by)
+
+    def getdaily(self, by=('day', 'queue'), startdate=None, enddate=None, status='F', projects=None, users=None):
+        """
+        Daily job statistics, with the same arguments and result as
+        JobsDataset.getdaily, calculated from the jobs
+        """
+        fields = { 'day' : "strftime(Jobs.ctime, '%Y-%m-%d')",
+                   'project' : 'Jobs.project',
+                   'username' : 'Jobs.username',
+                   'queue' : 'Jobs.queue',
+                   'ncpusbin' : self.ncpusbin_sql(),
+                   'status' : 'Jobs.status' }
+        by = self.dailyby(by)
+
+        source = self.jobsource(startdate, enddate)
+        if source is None:
+            print("No data available")
+            return None
+
+        where = []
+        params = []
+        if status is not None:
+            where.append('Jobs.status = ?')
+            params.append(status)
+        if startdate is not None:
+            where.append('CAST(Jobs.ctime AS DATE) >= CAST(? AS DATE)')
+            params.append(self.date2date(startdate).isoformat())
+        if enddate is not None:
+            where.append('CAST(Jobs.ctime AS DATE) <= CAST(? AS DATE)')
+            params.append(self.date2date(enddate).isoformat())
+        for column, values in (('Jobs.project', projects), ('Jobs.username', users)):
+            if values is None:
+                continue
+            values = list(values)
+            where.append('{} IN ({})'.format(column, ', '.join('?' for v in values)))
+            params += values
+
+        qstring = """SELECT {selection}, {sums} FROM {source}
+        WHERE {where} GROUP BY ALL""".format(
+            selection=', '.join('{} AS {}'.format(fields[field], field) for field in by),
+            sums=', '.join(self.rollupsums()), source=source,
+            where=' AND '.join(where) if where else 'true')
+
+        return self.dailystats(self.query(qstring, params), by)
+
+    def getuser(self, username=None):
+        source = self.jobsource()
+        if source is None:
+            return None
+        record = self.con.execute('SELECT username, fullname FROM {} WHERE username = ? LIMIT 1'.format(source), [username]).fetchone()
+        if record is None:
+            return None
+        return dict(username=record[0], fullname=record[1])
+
+    def getusers(self):
+        source = self.jobsource()
+        if source is None:
+            return
+        for record in self.con.execute('SELECT DISTINCT username FROM {} ORDER BY username'.format(source)).fetchall():
+            yield record[0]
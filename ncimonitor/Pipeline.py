@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2019 ARC Centre of Excellence for Climate Extremes
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Database writes for the make_*_DB parsers. The parsers pass every database
+call to a writer, which either makes it immediately (Inline) or queues it to
+a dedicated writer thread (Writer), so parsing the next lines of a dump
+overlaps writing the previous ones. The queue is bounded, so a parser which
+gets ahead of the database blocks rather than buffering the whole dump.
+
+All the calls on a database, including begin and commit, must go through the
+same writer, as transactions belong to the thread which makes them.
+
+Databases are opened in the writer, and their tables are created by begin
+before its transaction is opened (see DatasetBase.createtables), so the
+schema is never changed inside a transaction while the parser is running.
+"""
+
+from __future__ import print_function
+
+from concurrent import futures
+import queue
+import threading
+
+class Inline(object):
+    """Make database calls immediately in the calling thread"""
+
+    def call(self, func, *args, **kwargs):
+        func(*args, **kwargs)
+
+    def sync(self, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+    def close(self):
+        pass
+
+    def abort(self, cleanup=None, *args):
+        if cleanup is not None:
+            cleanup(*args)
+
+class Writer(object):
+    """
+    Make database calls in a writer thread. Calls are sent in batches of
+    batchsize through a queue of at most maxsize batches. If a call fails the
+    writer skips everything queued after it, and the exception is raised in
+    the parser by its next call
+    """
+
+    def __init__(self, maxsize=16, batchsize=500):
+        self.queue = queue.Queue(maxsize)
+        self.batchsize = batchsize
+        self.batch = []
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name='ncimonitor-writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            batch, always = item
+            if self.error is not None and not always:
+                continue
+            try:
+                for func, args, kwargs in batch:
+                    func(*args, **kwargs)
+            except BaseException as e:
+                self.error = e
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def _put(self, item, check=True):
+        # Time out regularly to notice a failed writer
+        while True:
+            if check:
+                self._check()
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _send(self):
+        if len(self.batch) > 0:
+            batch, self.batch = self.batch, []
+            self._put((batch, False))
+
+    def call(self, func, *args, **kwargs):
+        """Queue func(*args, **kwargs) to be called in the writer thread"""
+        self._check()
+        self.batch.append((func, args, kwargs))
+        if len(self.batch) >= self.batchsize:
+            self._send()
+
+    def _future(self, func, *args, **kwargs):
+        result = futures.Future()
+        def call():
+            try:
+                result.set_result(func(*args, **kwargs))
+            except BaseException as e:
+                result.set_exception(e)
+                raise
+        return result, call
+
+    def sync(self, func, *args, **kwargs):
+        """Call func in the writer thread once all queued calls are made, and return its result"""
+        result, call = self._future(func, *args, **kwargs)
+        self.call(call)
+        self._send()
+        while True:
+            self._check()
+            try:
+                return result.result(timeout=0.1)
+            except futures.TimeoutError:
+                pass
+
+    def abort(self, cleanup=None, *args):
+        """
+        Discard queued calls and call cleanup(*args) in the writer thread, e.g.
+        to roll back. Used when parsing fails. The writer can be used again
+        afterwards
+        """
+        self.batch = []
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
+        # Wait for the writer to finish any batch it is part way through
+        result, call = self._future(lambda: None)
+        self._put(([(call, (), {})], True), check=False)
+        result.result()
+        self.error = None
+        if cleanup is not None:
+            self.sync(cleanup, *args)
+
+    def close(self):
+        """Wait for all queued calls and stop the writer thread"""
+        try:
+            self._send()
+        finally:
+            self._put(None, check=False)
+            self.thread.join()
+        self._check()
+
+def add_arguments(parser):
+    """Add the pipeline options to a make_*_DB argument parser"""
+    parser.add_argument("--pipeline", help="Write to the database in a separate thread while parsing", action='store_true')
+    parser.add_argument("--queue", help="Maximum batches of writes queued in --pipeline mode", type=int, default=16)
+
+def writer(args):
+    """Writer configured by the options added with add_arguments"""
+    if args.pipeline:
+        return Writer(maxsize=args.queue)
+    return Inline()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2019 ARC Centre of Excellence for Climate Extremes
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import print_function
+
+import json
+import math
+
+class DDSketch(object):
+    """
+    Mergeable quantile sketch with relative error guarantees for non-negative
+    values, after Masson, Rim and Lee (2019) "DDSketch: A fast and fully-mergeable
+    quantile sketch with relative-error guarantees".
+
+    Values are counted in logarithmically sized buckets, so any quantile is
+    returned to within relative_accuracy of the true value, and two sketches
+    are merged by adding their bucket counts.
+
+    >>> sketch = DDSketch()
+    >>> for v in range(1, 1001): sketch.add(v)
+    >>> abs(sketch.quantile(0.5) - 500) < 500 * 0.01
+    True
+    """
+
+    # Values smaller than this are counted as zero
+    min_value = 1.e-9
+
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1. + relative_accuracy) / (1. - relative_accuracy)
+        self.loggamma = math.log(self.gamma)
+        self.bins = {}
+        self.zerocount = 0
+        self.count = 0
+        self.min = None
+        self.max = None
+
+    def key(self, value):
+        return int(math.ceil(math.log(value) / self.loggamma))
+
+    def add(self, value, count=1):
+        if value < 0:
+            raise ValueError('DDSketch only supports non-negative values: {}'.format(value))
+        if value < self.min_value:
+            self.zerocount += count
+        else:
+            key = self.key(value)
+            self.bins[key] = self.bins.get(key, 0) + count
+        self.count += count
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError('Cannot merge sketches with different relative accuracy')
+        if other.count == 0:
+            return self
+        for key, count in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0) + count
+        self.zerocount += other.zerocount
+        self.count += other.count
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        return self
+
+    def quantile(self, q):
+        """
+        Return an estimate of quantile q (0 <= q <= 1), or None if the
+        sketch is empty
+        """
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        if rank < self.zerocount:
+            return 0.
+        total = self.zerocount
+        for key in sorted(self.bins):
+            total += self.bins[key]
+            if total > rank:
+                break
+        value = 2. * self.gamma**key / (self.gamma + 1.)
+        # Bucket midpoint can lie outside the observed range
+        return min(max(value, self.min), self.max)
+
+    def to_json(self):
+        return json.dumps({ 'a' : self.relative_accuracy,
+                            'n' : self.count,
+                            'z' : self.zerocount,
+                            'min' : self.min,
+                            'max' : self.max,
+                            'b' : self.bins }, separators=(',',':'))
+
+    @classmethod
+    def from_json(cls, text):
+        data = json.loads(text)
+        sketch = cls(data['a'])
+        sketch.count = data['n']
+        sketch.zerocount = data['z']
+        sketch.min = data['min']
+        sketch.max = data['max']
+        sketch.bins = { int(k) : v for k, v in data['b'].items() }
+        return sketch
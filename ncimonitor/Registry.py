@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2019 ARC Centre of Excellence for Climate Extremes
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Open datasets shared by all the parsers and command line tools of a process,
+so a database is opened once, with one engine and one set of file handles,
+however many modules use it. Datasets are keyed on their database URL and
+reference counted. One which is no longer used stays open in the pool for
+the next user until more than maxidle are idle, when the least recently used
+is closed, and one closed while in use is closed when its last user releases
+it. A dataset is opened once, so opening it again with different arguments,
+e.g. another profile, is an error. The parsers keep their datasets in a
+Handles, e.g.
+
+    databases = registry.handles()
+    db = databases.open(url, ProjectDataset, project, url)
+
+Connections cannot be shared with a child process, so a registry used after
+a fork, e.g. in a multiprocessing worker, forgets the datasets of its parent
+rather than using or closing them.
+"""
+
+from __future__ import print_function
+
+from collections import OrderedDict
+import contextlib
+import inspect
+import os
+import threading
+
+def key(url):
+    """Registry key of a database URL, with SQLite files given by absolute path"""
+    prefix = 'sqlite:///'
+    if url.startswith(prefix) and url != prefix + ':memory:':
+        return prefix + os.path.abspath(url[len(prefix):])
+    return url
+
+def arguments(factory, args, kwargs):
+    """The arguments of a call of factory, with any defaults filled in"""
+    try:
+        bound = inspect.signature(factory).bind(*args, **kwargs)
+    except (TypeError, ValueError):
+        return factory, args, kwargs
+    bound.apply_defaults()
+    return factory, bound.args, bound.kwargs
+
+class Registry(object):
+
+    # Number of unused datasets kept open
+    maxidle = 16
+
+    def __init__(self, maxidle=None):
+        if maxidle is not None:
+            self.maxidle = maxidle
+        self.lock = threading.RLock()
+        self.pid = os.getpid()
+        # [dataset, references, arguments, closing] for each key, least
+        # recently used first
+        self.entries = OrderedDict()
+
+    def _checkpid(self):
+        if os.getpid() != self.pid:
+            self.entries = OrderedDict()
+            self.pid = os.getpid()
+
+    def acquire(self, url, factory, *args, **kwargs):
+        """
+        Dataset for url, opened with factory(*args, **kwargs) unless it is
+        already open, when the arguments must be those it was opened with.
+        Each call must be matched by a release
+        """
+        with self.lock:
+            self._checkpid()
+            k = key(url)
+            if k not in self.entries:
+                self.entries[k] = [factory(*args, **kwargs), 0, arguments(factory, args, kwargs), False]
+            self.check(url, factory, *args, **kwargs)
+            entry = self.entries.pop(k)
+            entry[1] += 1
+            self.entries[k] = entry
+            return entry[0]
+
+    def release(self, dataset):
+        """
+        Stop using dataset. It is kept open for reuse, without committing,
+        until it is closed or too many datasets are idle
+        """
+        with self.lock:
+            self._checkpid()
+            for k, entry in list(self.entries.items()):
+                if entry[0] is dataset:
+                    entry[1] = max(entry[1] - 1, 0)
+                    if entry[1] == 0 and entry[3]:
+                        self._close(k)
+                    break
+            idle = [k for k, entry in self.entries.items() if entry[1] == 0]
+            for k in idle[:max(len(idle) - self.maxidle, 0)]:
+                self._close(k)
+
+    def check(self, url, factory, *args, **kwargs):
+        """Raise ValueError unless the dataset for url was opened with these arguments"""
+        with self.lock:
+            self._checkpid()
+            entry = self.entries.get(key(url))
+            if entry is not None and entry[2] != arguments(factory, args, kwargs):
+                raise ValueError('Dataset for {} is already open with different arguments'.format(url))
+
+    def get(self, url):
+        """The open dataset for url, or None"""
+        with self.lock:
+            self._checkpid()
+            entry = self.entries.get(key(url))
+            return None if entry is None else entry[0]
+
+    def references(self, url):
+        with self.lock:
+            self._checkpid()
+            entry = self.entries.get(key(url))
+            return 0 if entry is None else entry[1]
+
+    def close(self, url):
+        """
+        Close the dataset for url, which commits it, now if it is not in use,
+        otherwise when its last user releases it
+        """
+        with self.lock:
+            self._checkpid()
+            entry = self.entries.get(key(url))
+            if entry is None:
+                return
+            if entry[1] > 0:
+                entry[3] = True
+            else:
+                self._close(key(url))
+
+    def _close(self, k):
+        with self.lock:
+            entry = self.entries.pop(k, None)
+        if entry is not None:
+            entry[0].close()
+
+    def closeall(self):
+        """Close all the datasets, whether or not they are in use, e.g. at exit"""
+        with self.lock:
+            self._checkpid()
+            keys = list(self.entries)
+        for k in keys:
+            self._close(k)
+
+    def datasets(self):
+        with self.lock:
+            self._checkpid()
+            return [entry[0] for entry in self.entries.values()]
+
+    @contextlib.contextmanager
+    def dataset(self, url, factory, *args, **kwargs):
+        """Acquire a dataset for the duration of a with block"""
+        dataset = self.acquire(url, factory, *args, **kwargs)
+        try:
+            yield dataset
+        finally:
+            self.release(dataset)
+
+    def handles(self):
+        return Handles(self)
+
+class Handles(object):
+    """
+    The datasets used by one module, e.g. a make_*_DB parser, acquired from a
+    registry the first time they are opened. Has values() so can be passed to
+    DatasetBase.commitall and rollbackall
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.datasets = OrderedDict()
+
+    def open(self, url, factory, *args, **kwargs):
+        dataset = self.datasets.get(key(url))
+        # May have been closed by another module
+        if dataset is None or self.registry.get(url) is not dataset:
+            dataset = self.registry.acquire(url, factory, *args, **kwargs)
+            self.datasets[key(url)] = dataset
+        else:
+            self.registry.check(url, factory, *args, **kwargs)
+        return dataset
+
+    def values(self):
+        return [dataset for k, dataset in self.datasets.items() if self.registry.get(k) is dataset]
+
+    def __len__(self):
+        return len(self.values())
+
+    def clear(self):
+        """Release all the datasets, leaving them open in the registry"""
+        for dataset in self.values():
+            self.registry.release(dataset)
+        self.datasets = OrderedDict()
+
+    def close(self):
+        """
+        Release all the datasets, closing each when no other module uses it
+        """
+        for k, dataset in self.datasets.items():
+            if self.registry.get(k) is dataset:
+                self.registry.release(dataset)
+                self.registry.close(k)
+        self.datasets = OrderedDict()
+
+registry = Registry()
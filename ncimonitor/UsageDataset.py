@@ -20,68 +20,318 @@ limitations under the License.
 
 from __future__ import print_function
 
-from dataset import connect
+from collections import OrderedDict
 import datetime
-from pwd import getpwnam
+import numpy as np
 import pandas as pd
+import sqlalchemy
+
+from .DatasetBase import DatasetBase, connect
+from .DBcommon import datetoyearquarter
+from . import UsageSummary
+from .UserDirectory import users
+
+def densepivot(dates, names, values, startdate=None):
+    """
+    Scatter (date, name, value) records into a dense date x name DataFrame,
+    as pivot_table(index='Date', columns='Name', fill_value=0) does, but
+    without building intermediate frames. Dates are YYYY-MM-DD strings, and
+    there should be one record for each date and name. If startdate is given
+    the frame has a row for every day from startdate to the last date, and
+    rows without records are filled from the next date with records
+    """
+    # Hash based, and much quicker than np.unique for strings
+    daterow, dateidx = pd.factorize(np.asarray(dates, dtype=object), sort=True)
+    namecol, nameidx = pd.factorize(np.asarray(names, dtype=object), sort=True)
+    if startdate is None:
+        index = pd.to_datetime(dateidx, format="%Y-%m-%d")
+        index.name = 'Date'
+        matrix = np.zeros((len(dateidx), len(nameidx)))
+        matrix[daterow, namecol] = values
+    else:
+        index = pd.date_range(startdate, str(dateidx[-1]))
+        days = (dateidx.astype('datetime64[D]') - np.datetime64(str(startdate), 'D')).astype(int)
+        matrix = np.zeros((len(index), len(nameidx)))
+        matrix[days[daterow], namecol] = values
+        # Backfill each missing day from the next day with records
+        filled = np.zeros(len(index), dtype=bool)
+        filled[days] = True
+        nextrow = np.where(filled, np.arange(len(index)), len(index))
+        nextrow = np.minimum.accumulate(nextrow[::-1])[::-1]
+        missing = ~filled
+        matrix[missing] = matrix[nextrow[missing]]
+    return pd.DataFrame(matrix, index=index, columns=pd.Index(list(nameidx), name='Name'))
 
 class NotInDatabase(Exception):
     pass
 
-class ProjectDataset(object):
-
-    def __init__(self, project, dbfile=None):
+class ProjectDataset(DatasetBase):
+
+    facttables = ('UserUsage', 'ProjectUsage', 'ShortUsage', 'GdataUsage')
+
+    storagekeys = { 'ShortUsage' : ['scandate', 'folder', 'user'],
+                    'GdataUsage' : ['scandate', 'storagepoint', 'folder', 'user'] }
+
+    # Years and scan dates of storage rows are strings, as read from the dumps
+    schema = OrderedDict([
+        ('Metadata', (['key'], OrderedDict(key='', value=''))),
+        ('User', (['username', 'fullname'], OrderedDict(username='', fullname=''))),
+        ('Quarter', (['year', 'quarter'],
+                     OrderedDict(year='', quarter='', start_date=datetime.date.min, end_date=datetime.date.min))),
+        ('Grant', (['year', 'quarter'], OrderedDict(year='', quarter='', total_grant=0.))),
+        ('SystemQueue', (['system', 'queue'], OrderedDict(system='', queue='', chargeweight=0.))),
+        ('SystemStorage', (['system', 'storagepoint', 'year', 'quarter'],
+                           OrderedDict(system='', storagepoint='', year='', quarter='', grant=0., igrant=0.))),
+        ('UserUsage', (['date', 'user'],
+                       OrderedDict(date=datetime.date.min, user=0, usage_cpu=0., usage_wall=0., usage_su=0.))),
+        ('ProjectUsage', (['date', 'systemqueue'],
+                          OrderedDict(date=datetime.date.min, systemqueue=0, usage_cpu=0., usage_wall=0., usage_su=0.))),
+        ('ShortUsage', (storagekeys['ShortUsage'],
+                        OrderedDict(user=0, folder='', scandate='', inodes=0., size=0.))),
+        ('GdataUsage', (storagekeys['GdataUsage'],
+                        OrderedDict(user=0, storagepoint='', folder='', scandate='', inodes=0., size=0.))),
+        ('ScanDate', (['tablename', 'storagepoint', 'scandate'],
+                      OrderedDict(tablename='', storagepoint='', scandate=datetime.date.min, keyframe=False))),
+        ])
+
+    # Maximum days between keyframes of delta encoded storage scans. The first
+    # scan of each quarter is always a keyframe
+    keyframe_days = 28
+
+    def __init__(self, project, dbfile=None, bulk=False, profile=None, delta=False, summary=False):
         self.project = project
         if dbfile is None:
             dbfile = "usage_{}.db".format(project)
         self.dbfile = dbfile
-        self.db = connect(dbfile)
+        self.profile = profile
+        self.db = connect(dbfile, profile)
+        self._init_bulk(bulk)
+        self._init_storagemode(delta)
+        # Write UsageSummary files of the quarters changed by each commit
+        self.summary = summary
+        self.changed = set()
+
+    def _init_storagemode(self, delta):
+        """
+        Storage scans are stored in full, or delta encoded, when a row is only
+        written if a folder has changed since the previous scan, except in
+        keyframe scans. Folders which disappear get a row of zeros. The mode is
+        fixed once there are scans in the database
+        """
+        record = self.db['Metadata'].find_one(key='storage_mode')
+        self.storagemode = 'full' if record is None else record['value']
+        if delta and self.storagemode != 'delta':
+            if all(self.db[table].find_one() is None for table in self.storagekeys):
+                self.db['Metadata'].upsert(dict(key='storage_mode', value='delta'), ['key'])
+                self.storagemode = 'delta'
+            else:
+                print("{} already has full storage scans, not using delta storage".format(self.dbfile))
+        # Delta encoded scans being added, and the state of their folders
+        self.scans = {}
 
     def adduser(self, username, fullname=None):
-        if self.db['User'].find_one(username=username) is None:
+        if self._lookup('User', username=username) is None:
             if fullname is None:
-                try:
-                    fullname = getpwnam(username).pw_gecos
-                except KeyError:
-                    fullname = username
+                fullname = users.fullname(username) or username
             data = dict(username=username, fullname=fullname)
-            self.db['User'].upsert(data, list(data.keys()))
+            self._upsert('User', data, list(data.keys()), phase='lookup')
 
     def addquarter(self, year, quarter, startdate, enddate):
+        self.changed.add((int(year), quarter))
         data = dict(year=year, quarter=quarter, start_date=startdate, end_date=enddate)
-        return self.db['Quarter'].upsert(data, ['year', 'quarter'])
+        return self._upsert('Quarter', data, ['year', 'quarter'])
 
     def addgrant(self, year, quarter, totalgrant):
         data = dict(year=year, quarter=quarter, total_grant=totalgrant)
-        return self.db['Grant'].upsert(data, ['year', 'quarter'])
+        return self._upsert('Grant', data, ['year', 'quarter'])
 
     def adduserusage(self, date, username, usecpu, usewall, usesu):
-        user = self.db['User'].find_one(username=username)
+        user = self._lookup('User', username=username)
         data = dict(date=date, user=user['id'], usage_cpu=float(usecpu), usage_wall=float(usewall), usage_su=float(usesu))
-        return self.db['UserUsage'].upsert(data, ['date','user'])
+        return self._upsert('UserUsage', data, ['date','user'])
 
     def addsystemqueue(self, systemname, queuename, weight):
         data = dict(system=systemname,queue=queuename,chargeweight=float(weight))
-        return self.db['SystemQueue'].upsert(data, ['system', 'queue'])
+        return self._upsert('SystemQueue', data, ['system', 'queue'])
 
     def addsystemstorage(self, systemname, storagepoint, year, quarter, grant, igrant):
+        self.changed.add((int(year), quarter))
         data = dict(system=systemname,storagepoint=storagepoint,year=year,quarter=quarter,grant=float(grant),igrant=float(igrant))
-        return self.db['SystemStorage'].upsert(data, ['system', 'storagepoint', 'year', 'quarter'])
+        return self._upsert('SystemStorage', data, ['system', 'storagepoint', 'year', 'quarter'])
 
     def addprojectusage(self, date, systemname, queuename, cputime, walltime, su):
-        systemqueue = self.db['SystemQueue'].find_one(system=systemname,queue=queuename)
+        systemqueue = self._lookup('SystemQueue', system=systemname,queue=queuename)
         data = dict(date=date,systemqueue=systemqueue['id'],usage_cpu=float(cputime),usage_wall=float(walltime),usage_su=float(su))
-        return self.db['ProjectUsage'].upsert(data, ['date', 'systemqueue'])
+        return self._upsert('ProjectUsage', data, ['date', 'systemqueue'])
 
     def addshortusage(self, folder, username, size, inodes, scandate):
-        user = self.db['User'].find_one(username=username)
+        user = self._lookup('User', username=username)
         data = dict(user=user['id'], folder=folder, scandate=scandate, inodes=float(inodes), size=float(size))
-        return self.db['ShortUsage'].upsert(data, ['scandate', 'folder', 'user'])
+        return self._addscan('ShortUsage', data)
 
     def addgdatausage(self, storagepoint, folder, username, size, inodes, scandate):
-        user = self.db['User'].find_one(username=username)
+        user = self._lookup('User', username=username)
         data = dict(user=user['id'], storagepoint=storagepoint, folder=folder, scandate=scandate, inodes=float(inodes), size=float(size))
-        return self.db['GdataUsage'].upsert(data, ['scandate', 'storagepoint', 'folder', 'user'])
+        return self._addscan('GdataUsage', data)
+
+    def _addscan(self, table, data):
+        self.changed.add(datetoyearquarter(self.date2date(data['scandate'])))
+        if self.storagemode != 'delta':
+            return self._upsert(table, data, self.storagekeys[table])
+        scan = self._scan(table, data.get('storagepoint', ''), self.date2date(data['scandate']))
+        key = (data['folder'], data['user'])
+        value = (data['size'], data['inodes'])
+        scan['seen'].add(key)
+        if scan['keyframe'] or scan['state'].get(key) != value:
+            self._upsert(table, data, self.storagekeys[table])
+        scan['state'][key] = value
+        return True
+
+    def _scan(self, table, storagepoint, scandate):
+        """Start, or continue, adding a delta encoded scan"""
+        scan = self.scans.get((table, storagepoint))
+        if scan is not None:
+            if scan['scandate'] == scandate:
+                scan['ended'] = False
+                return scan
+            self._endscan(table, storagepoint)
+
+        lastscan = self.db['ScanDate'].find_one(tablename=table, storagepoint=storagepoint, order_by='-scandate')
+        if lastscan is not None:
+            lastscan = self.date2date(lastscan['scandate'])
+        lastkeyframe = self.db['ScanDate'].find_one(tablename=table, storagepoint=storagepoint, keyframe=True,
+                                                    scandate={'<=': scandate}, order_by='-scandate')
+        if lastkeyframe is not None:
+            lastkeyframe = self.date2date(lastkeyframe['scandate'])
+
+        # Scans out of order, or added again, are written in full
+        keyframe = (lastkeyframe is None or
+                    (lastscan is not None and scandate <= lastscan) or
+                    datetoyearquarter(lastkeyframe) != datetoyearquarter(scandate) or
+                    (scandate - lastkeyframe).days >= self.keyframe_days)
+
+        if keyframe:
+            state = {}
+        elif scan is not None:
+            state = scan['state']
+        else:
+            state = self._scanstate(table, storagepoint, lastkeyframe, lastscan)
+
+        self._upsert('ScanDate', dict(tablename=table, storagepoint=storagepoint, scandate=scandate, keyframe=keyframe),
+                     ['tablename', 'storagepoint', 'scandate'])
+
+        scan = dict(scandate=scandate, keyframe=keyframe, state=state, seen=set(), ended=False)
+        self.scans[(table, storagepoint)] = scan
+        return scan
+
+    def _endscan(self, table, storagepoint):
+        """Add rows of zeros for folders missing from a delta encoded scan"""
+        scan = self.scans[(table, storagepoint)]
+        if scan['ended']:
+            return
+        for key in [key for key in scan['state'] if key not in scan['seen']]:
+            if not scan['keyframe']:
+                folder, user = key
+                data = dict(user=user, folder=folder, scandate=scan['scandate'], inodes=0., size=0.)
+                if table == 'GdataUsage':
+                    data['storagepoint'] = storagepoint
+                self._upsert(table, data, self.storagekeys[table])
+            del scan['state'][key]
+        scan['ended'] = True
+
+    def _scanstate(self, table, storagepoint, startdate, enddate):
+        """(size, inodes) of each (folder, user) at the scan on enddate of a delta encoded table"""
+        where = "scandate BETWEEN :startdate AND :enddate"
+        if table == 'GdataUsage':
+            where += " AND storagepoint = :storagepoint"
+        qstring = """SELECT {table}.folder, {table}.user, size, inodes FROM {table}
+        JOIN (SELECT folder, user, MAX(scandate) AS last FROM {table} WHERE {where} GROUP BY folder, user) AS latest
+        ON {table}.folder = latest.folder AND {table}.user = latest.user AND {table}.scandate = latest.last
+        WHERE {where}""".format(table=table, where=where)
+        state = {}
+        for record in self.db.query(qstring, startdate=str(startdate), enddate=str(enddate), storagepoint=storagepoint):
+            if record['size'] != 0 or record['inodes'] != 0:
+                state[(record['folder'], record['user'])] = (record['size'], record['inodes'])
+        return state
+
+    def commit(self):
+        # Each dump file has complete scans
+        for table, storagepoint in self.scans:
+            self._endscan(table, storagepoint)
+        # Counted so readers can tell if a UsageSummary is out of date
+        if self.changed:
+            record = self.db['Metadata'].find_one(key='changes')
+            changes = 0 if record is None else int(record['value'])
+            self.db['Metadata'].upsert(dict(key='changes', value=str(changes + 1)), ['key'])
+        super(ProjectDataset, self).commit()
+        # Rows buffered in bulk mode are not in the database until flushed
+        if self.npending == 0:
+            self.summarise()
+
+    def rollback(self):
+        self.scans = {}
+        self.changed = set()
+        super(ProjectDataset, self).rollback()
+
+    def close(self):
+        super(ProjectDataset, self).close()
+        self.summarise()
+
+    def summarise(self):
+        """Write the summaries of changed quarters, if enabled"""
+        if self.summary:
+            for year, quarter in sorted(self.changed):
+                # Only an optimisation for readers, so do not stop an ingest
+                try:
+                    UsageSummary.write(self.dbfile, year, quarter)
+                except (IOError, OSError) as e:
+                    print("Could not write summary of {} {} for {}: {}".format(year, quarter, self.dbfile, e))
+        self.changed = set()
+
+    def _scanseries(self, table, startdate, enddate):
+        """
+        Reconstruct the total size and inodes of each user at every scan
+        between startdate and enddate from a delta encoded table. Returns a
+        DataFrame with columns user, scandate, size and inodes
+        """
+        params = dict(table=table, startdate=str(startdate), enddate=str(enddate))
+        scans = pd.read_sql_query(sqlalchemy.text("""SELECT storagepoint, scandate FROM ScanDate
+        WHERE tablename = :table AND scandate BETWEEN :startdate AND :enddate"""), self.db.executable, params=params)
+
+        series = []
+        for storagepoint, group in scans.groupby('storagepoint'):
+            scandates = sorted(group.scandate)
+            # Start from the keyframe at or before the first scan
+            record = self.db['ScanDate'].find_one(tablename=table, storagepoint=storagepoint, keyframe=True,
+                                                  scandate={'<=': scandates[0]}, order_by='-scandate')
+            where = "scandate BETWEEN :keyframe AND :enddate"
+            if table == 'GdataUsage':
+                where += " AND storagepoint = :storagepoint"
+            rows = pd.read_sql_query(sqlalchemy.text("SELECT folder, user, scandate, size, inodes FROM {} WHERE {}".format(table, where)),
+                                     self.db.executable,
+                                     params=dict(keyframe=str(record['scandate']), enddate=str(enddate), storagepoint=storagepoint))
+            if len(rows) == 0:
+                continue
+            # Each scan is reconstructed from its latest keyframe onwards, as a
+            # keyframe has no rows for folders which have gone
+            keyframes = sorted(str(r['scandate']) for r in self.db['ScanDate'].find(
+                tablename=table, storagepoint=storagepoint, keyframe=True,
+                scandate={'between': [str(record['scandate']), str(enddate)]}))
+            columns = sorted(set(rows.scandate) | set(scandates))
+            segments = pd.Series([max(k for k in keyframes if k <= c) for c in columns], index=columns)
+            totals = []
+            for field in ('size', 'inodes'):
+                # Carry the value of each folder forward to every scan until the next keyframe
+                wide = rows.pivot(index=['folder', 'user'], columns='scandate', values=field).reindex(columns=columns)
+                wide = wide.T.groupby(segments).ffill().T[scandates]
+                totals.append(wide.fillna(0).groupby(level='user').sum().stack().rename(field))
+            series.append(pd.concat(totals, axis=1))
+
+        if len(series) == 0:
+            return pd.DataFrame(columns=['user', 'scandate', 'size', 'inodes'])
+        series = pd.concat(series)
+        series.index.names = ['user', 'scandate']
+        return series.groupby(level=['user', 'scandate']).sum().reset_index()
 
     def getstartend(self, year, quarter, asdate=False):
         q = self.db['Quarter'].find_one(year=year, quarter=quarter)
@@ -129,6 +379,10 @@ class ProjectDataset(object):
     def getusershort(self, year, quarter, username):
         startdate, enddate = self.getstartend(year, quarter)
         user = self.db['User'].find_one(username=username)
+        if self.storagemode == 'delta':
+            series = self._scanseries('ShortUsage', startdate, enddate)
+            series = series[series.user == user['id']].sort_values('scandate')
+            return [self.date2date(date) for date in series.scandate], list(series['size'])
         qstring = "SELECT scandate, SUM(size) AS totsize FROM ShortUsage WHERE scandate between '{}' AND '{}' AND user={} GROUP BY scandate ORDER BY scandate".format(startdate,enddate,user['id'])
         q = self.db.query(qstring)
         if q is None:
@@ -160,25 +414,17 @@ class ProjectDataset(object):
         GROUP BY Name, Date 
         ORDER BY Date"""
 
-        # Pivot makes columns of all the individuals, rows are indexed by date
-        try:
-            df = pd.read_sql_query(qstring.format(namefield=name_sql,
-                                                  datafield=datafield,
-                                                  start=startdate,
-                                                  end=enddate),
-                                                  self.db.executable).pivot_table(index='Date',
-                                                                                  columns='Name',
-                                                                                  fill_value=0)
-        except:
+        records = self.db.executable.exec_driver_sql(qstring.format(namefield=name_sql,
+                                                                   datafield=datafield,
+                                                                   start=startdate,
+                                                                   end=enddate)).fetchall()
+        if len(records) == 0:
             print("No usage data available")
             return None
 
-        # Get rid of the totsize labels in the multiindex
-        df.columns = df.columns.get_level_values(1)
-        # Convert date index from labels to datetime objects 
-        df.index = pd.to_datetime(df.index, format="%Y-%m-%d")
-
-        return df
+        # Columns of all the individuals, rows are indexed by date
+        names, dates, values = zip(*records)
+        return densepivot(dates, names, values)
 
 
     def getstorage(self, year, quarter, storagept='short', datafield='size', namefield='user+name'):
@@ -209,29 +455,32 @@ class ProjectDataset(object):
         GROUP BY Name, Date
         ORDER BY Date"""
 
-        # Pivot makes columns of all the individuals, rows are indexed by date
-        try:
-            df = pd.read_sql_query(qstring.format(namefield=name_sql,datafield=datafield,table=table,start=startdate,end=enddate), self.db.executable).pivot_table(index='Date',columns='Name',fill_value=0)
-        except:
+        if self.storagemode == 'delta':
+            series = self._scanseries(table, startdate, enddate)
+            users = pd.read_sql_query("SELECT id, username, fullname FROM User", self.db.executable).set_index('id')
+            if namefield == 'user+name':
+                names = users.fullname + ' (' + users.username + ')'
+            else:
+                names = users.username
+            names, dates, values = names.reindex(series.user).values, series.scandate.values, series[datafield].values
+        else:
+            records = self.db.executable.exec_driver_sql(qstring.format(namefield=name_sql,datafield=datafield,table=table,start=startdate,end=enddate)).fetchall()
+            names, dates, values = zip(*records) if len(records) > 0 else ((), (), ())
+        if len(dates) == 0:
             print("No data available for {}".format(storagept))
             return None
-            
-        # Get rid of the totsize labels in the multiindex
-        df.columns = df.columns.get_level_values(1)
-        # Convert date index from labels to datetime objects 
-        df.index = pd.to_datetime(df.index, format="%Y-%m-%d")
-
-        # Make a new index from the beginning of the quarter
-        newidx = pd.date_range(startdate,df.index[-1])
-
-        # Reindex to beginning of quarter in case we're missing values from the beginning of the quarter
-        df = df.reindex(newidx, method='backfill')
 
-        return df
+        # Columns of all the individuals, rows are every day from the beginning of
+        # the quarter in case we're missing values from the beginning of the quarter
+        return densepivot(dates, names, values, startdate)
 
     def getusergdata(self, year, quarter, username):
         startdate, enddate = self.getstartend(year, quarter)
         user = self.db['User'].find_one(username=username)
+        if self.storagemode == 'delta':
+            series = self._scanseries('GdataUsage', startdate, enddate)
+            series = series[series.user == user['id']].sort_values('scandate')
+            return [self.date2date(date) for date in series.scandate], list(series['size'])
         qstring = "SELECT scandate, SUM(size) AS totsize FROM GdataUsage WHERE scandate between '{}' AND '{}' AND user={} GROUP BY scandate ORDER BY scandate".format(startdate,enddate,user['id'])
         q = self.db.query(qstring)
         if q is None:
@@ -244,6 +493,9 @@ class ProjectDataset(object):
 
     def getshortdates(self, year, quarter):
         startdate, enddate = self.getstartend(year, quarter)
+        if self.storagemode == 'delta':
+            q = self.db['ScanDate'].find(tablename='ShortUsage', scandate={'between': [startdate, enddate]}, order_by='scandate')
+            return sorted(set(self.date2date(record['scandate']) for record in q))
         qstring = "SELECT scandate FROM ShortUsage WHERE scandate between '{}' AND '{}' GROUP BY scandate ORDER BY scandate".format(startdate,enddate)
         q = self.db.query(qstring)
         if q is None:
@@ -255,8 +507,12 @@ class ProjectDataset(object):
 
     def getshortusers(self, year, quarter):
         startdate, enddate = self.getstartend(year, quarter)
-        qstring = "SELECT user FROM ShortUsage WHERE scandate between '{}' AND '{}' GROUP BY user ORDER BY SUM(size) desc".format(startdate,enddate)
-        q = self.db.query(qstring)
+        if self.storagemode == 'delta':
+            series = self._scanseries('ShortUsage', startdate, enddate).groupby('user')['size'].sum()
+            q = [dict(user=user) for user in series.sort_values(ascending=False).index]
+        else:
+            qstring = "SELECT user FROM ShortUsage WHERE scandate between '{}' AND '{}' GROUP BY user ORDER BY SUM(size) desc".format(startdate,enddate)
+            q = self.db.query(qstring)
         if q is None:
             return None
         users = []
@@ -322,6 +578,55 @@ class ProjectDataset(object):
         return float(q['grant']),float(q['igrant'])
 
 
+    def compact(self, before, resolution='weekly', dryrun=False):
+        """
+        Thin out the short and gdata scans dated before the date before. The
+        first and last scans of each quarter are kept, and with weekly
+        resolution the last scan of each week. getstorage fills the days
+        between the remaining scans. Returns the number of scans removed from
+        each table
+        """
+        if resolution not in ('weekly', 'quarterly'):
+            raise ValueError('Incorrect value of resolution: {} Valid values are "weekly" or "quarterly"'.format(resolution))
+        if self.storagemode == 'delta':
+            raise ValueError('Cannot compact delta encoded storage scans in {}'.format(self.dbfile))
+
+        removed = {}
+        with self.db as tx:
+            for table in ('ShortUsage', 'GdataUsage'):
+                if not table in tx:
+                    continue
+                q = tx.query("SELECT DISTINCT scandate FROM {} WHERE scandate < :before ORDER BY scandate".format(table),
+                             before=str(before))
+                scandates = [self.date2date(record['scandate']) for record in q]
+
+                keep = set()
+                quarters = {}; weeks = {}
+                for scandate in scandates:
+                    quarters.setdefault(datetoyearquarter(scandate), []).append(scandate)
+                    weeks[scandate.isocalendar()[:2]] = scandate
+                for dates in quarters.values():
+                    keep.update((dates[0], dates[-1]))
+                if resolution == 'weekly':
+                    keep.update(weeks.values())
+
+                drop = [scandate for scandate in scandates if scandate not in keep]
+                if not dryrun:
+                    for scandate in drop:
+                        tx.query("DELETE FROM {} WHERE scandate = :scandate".format(table), scandate=str(scandate))
+                removed[table] = len(drop)
+        return removed
+
+    def vacuum(self):
+        """Rebuild the database file to return the space freed by deleting rows"""
+        connection = self.db.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute('VACUUM')
+            cursor.close()
+        finally:
+            connection.close()
+
     def top_usage(self, year, quarter, storagepoint, measure='size', count=10, scale=1):
         """
         Return the top ``count`` users according to ``measure`` (either 'size'
@@ -342,4 +647,4 @@ class ProjectDataset(object):
         return self.getstorage(year, 
                                quarter, 
                                storagept=storagepoint, 
-                               datafield=measure).ix[-1].sort_values(ascending=False).head(count).divide(scale)
+                               datafield=measure).iloc[-1].sort_values(ascending=False).head(count).divide(scale)
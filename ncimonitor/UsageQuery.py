@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2019 ARC Centre of Excellence for Climate Extremes
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Lightweight read-only queries of the usage databases written by ProjectDataset,
+using only sqlite3 and the standard library, so they are quick to import and
+do not build dataframes.
+"""
+
+from __future__ import print_function
+
+import os
+import sqlite3
+
+from .DBcommon import sqlite_pragmas
+
+storage_tables = { 'short' : 'ShortUsage', 'gdata' : 'GdataUsage' }
+
+# System on which each storage point's grants are recorded
+storage_systems = { 'short' : 'raijin', 'gdata' : 'global' }
+
+def connect(dbfile, profile='read-only'):
+    """
+    Open a usage database read only, with the named SQLite tuning profile.
+    Raises IOError if it does not exist rather than creating an empty database
+    """
+    if dbfile.startswith('sqlite:///'):
+        dbfile = dbfile[len('sqlite:///'):]
+    if not os.path.exists(dbfile):
+        raise IOError('No such database: {}'.format(dbfile))
+    conn = sqlite3.connect('file:{}?mode=ro'.format(dbfile), uri=True)
+    for statement in sqlite_pragmas(profile):
+        conn.execute(statement)
+    return conn
+
+def has_table(conn, table):
+    q = conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table,))
+    return q.fetchone() is not None
+
+def getstartend(conn, year, quarter):
+    """Return start and end date strings of quarter, or (None, None) if not in database"""
+    if not has_table(conn, 'Quarter'):
+        return None, None
+    q = conn.execute("SELECT start_date, end_date FROM Quarter WHERE year=? AND quarter=?", (year, quarter))
+    record = q.fetchone()
+    if record is None:
+        return None, None
+    return record
+
+def getsystemstorage(conn, system, storagepoint, year, quarter):
+    """Return (grant, igrant) for storagepoint, or (None, None) if not in database"""
+    if not has_table(conn, 'SystemStorage'):
+        return None, None
+    if storagepoint == 'gdata':
+        # gdata grants are stored against the actual storage point, e.g. gdata1
+        q = conn.execute("SELECT storagepoint FROM SystemStorage WHERE system='global' AND year=? AND quarter=?", (year, quarter))
+        record = q.fetchone()
+        if record is None:
+            return None, None
+        storagepoint = record[0]
+    q = conn.execute("SELECT grant, igrant FROM SystemStorage WHERE system=? AND storagepoint=? AND year=? AND quarter=?",
+                     (system, storagepoint, year, quarter))
+    record = q.fetchone()
+    if record is None:
+        return None, None
+    return float(record[0]), float(record[1])
+
+def latest_storage(conn, year, quarter, storagepoint='short', measure='size'):
+    """
+    Return the date of the most recent scan of storagepoint in this quarter and
+    a list of (fullname, username, total) for each user in that scan, largest
+    first. Returns (None, []) if there is no data
+    """
+    if storagepoint not in storage_tables:
+        raise ValueError('Incorrect value of storagept: {} Valid values are "short" or "gdata"'.format(storagepoint))
+    if measure not in ('size', 'inodes'):
+        raise ValueError('Incorrect value of measure: {} Valid values are "inodes" or "size"'.format(measure))
+
+    table = storage_tables[storagepoint]
+
+    startdate, enddate = getstartend(conn, year, quarter)
+    if startdate is None or not has_table(conn, table):
+        return None, []
+
+    scandate = latest_scandate(conn, table, startdate, enddate)
+    if scandate is None:
+        return None, []
+
+    if storage_mode(conn) == 'delta':
+        return latest_storage_delta(conn, table, measure, scandate)
+
+    q = conn.execute("""SELECT User.fullname, User.username, SUM({table}.{measure}) AS total
+    FROM {table}
+    LEFT JOIN User ON {table}.user = User.id
+    WHERE scandate = ?
+    GROUP BY {table}.user
+    ORDER BY total DESC""".format(table=table, measure=measure), (scandate,))
+
+    return scandate, q.fetchall()
+
+def storage_mode(conn):
+    """'delta' if storage scans are delta encoded, otherwise 'full'"""
+    if not has_table(conn, 'Metadata'):
+        return 'full'
+    q = conn.execute("SELECT value FROM Metadata WHERE key='storage_mode'")
+    record = q.fetchone()
+    return 'full' if record is None else record[0]
+
+def changes(conn):
+    """Number of commits which changed the quarters or storage of the database"""
+    if not has_table(conn, 'Metadata'):
+        return 0
+    q = conn.execute("SELECT value FROM Metadata WHERE key='changes'")
+    record = q.fetchone()
+    return 0 if record is None else int(record[0])
+
+def latest_scandate(conn, table, startdate, enddate):
+    """Date of the most recent scan in table between startdate and enddate, or None"""
+    if storage_mode(conn) == 'delta':
+        q = conn.execute("SELECT MAX(scandate) FROM ScanDate WHERE tablename=? AND scandate BETWEEN ? AND ?",
+                         (table, startdate, enddate))
+    else:
+        q = conn.execute("SELECT MAX(scandate) FROM {} WHERE scandate BETWEEN ? AND ?".format(table), (startdate, enddate))
+    return q.fetchone()[0]
+
+def latest_storage_delta(conn, table, measure, scandate):
+    """
+    latest_storage for delta encoded scans. The latest value of each folder
+    since the last keyframe of its storage point is its value in the latest
+    scan
+    """
+    storagepoint = "{}.storagepoint".format(table) if table == 'GdataUsage' else "''"
+    q = conn.execute("""SELECT User.fullname, User.username, SUM({table}.{measure}) AS total
+    FROM {table}
+    JOIN (SELECT storagepoint, MAX(scandate) AS scandate FROM ScanDate
+          WHERE tablename=:table AND keyframe AND scandate <= :scandate
+          AND storagepoint IN (SELECT storagepoint FROM ScanDate WHERE tablename=:table AND scandate=:scandate)
+          GROUP BY storagepoint) AS keyframe
+    ON {storagepoint} = keyframe.storagepoint AND {table}.scandate BETWEEN keyframe.scandate AND :scandate
+    LEFT JOIN User ON {table}.user = User.id
+    WHERE NOT EXISTS (SELECT 1 FROM {table} AS later
+                      WHERE later.folder = {table}.folder AND later.user = {table}.user
+                      AND {later} later.scandate > {table}.scandate AND later.scandate <= :scandate)
+    AND NOT ({table}.size = 0 AND {table}.inodes = 0)
+    GROUP BY {table}.user
+    ORDER BY total DESC""".format(table=table, measure=measure, storagepoint=storagepoint,
+                                    later="later.storagepoint = {table}.storagepoint AND".format(table=table) if table == 'GdataUsage' else ''),
+                     dict(table=table, scandate=scandate))
+
+    return scandate, q.fetchall()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2019 ARC Centre of Excellence for Climate Extremes
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Small JSON summaries of the latest storage scans in a quarter, written next
+to a usage database when it is updated, e.g.
+
+    usage_xx00_2019.db
+    usage_xx00_2019.q1.summary.json
+
+A summary has the usage of every user in the latest scan of each storage
+point, by size and inodes, with the totals and grants, so nci_usage can
+answer without grouping a scan in the database. A summary is stale, and
+ignored, if the database has changed since it was written. Each commit of a
+ProjectDataset which changes a quarter, storage grant or scan increments a
+count of changes in its Metadata, which is saved in the summary, and the
+quarter dates and latest scan are checked too.
+"""
+
+from __future__ import print_function
+
+import datetime
+import glob
+import json
+import os
+
+from . import UsageQuery
+
+version = 2
+
+def dbpath(dbfile):
+    if dbfile.startswith('sqlite:///'):
+        dbfile = dbfile[len('sqlite:///'):]
+    return dbfile
+
+def summary_file(dbfile, quarter):
+    """Path of the summary of quarter for usage database dbfile"""
+    return '{}.{}.summary.json'.format(os.path.splitext(dbpath(dbfile))[0], quarter)
+
+def summary_files(dbfile):
+    """Paths of all the summaries of dbfile"""
+    return sorted(glob.glob('{}.q[1-4].summary.json'.format(os.path.splitext(dbpath(dbfile))[0])))
+
+def build(conn, year, quarter):
+    """Summary of quarter as a dict"""
+    startdate, enddate = UsageQuery.getstartend(conn, year, quarter)
+    summary = dict(version=version, year=str(year), quarter=quarter,
+                   startdate=startdate, enddate=enddate,
+                   changes=UsageQuery.changes(conn),
+                   created=datetime.datetime.now().isoformat(), storage={})
+    for storagepoint in sorted(UsageQuery.storage_tables):
+        grant, igrant = UsageQuery.getsystemstorage(conn, UsageQuery.storage_systems[storagepoint],
+                                                    storagepoint, year, quarter)
+        storage = dict(grant=grant, igrant=igrant)
+        for measure in ('size', 'inodes'):
+            scandate, usage = UsageQuery.latest_storage(conn, year, quarter, storagepoint, measure)
+            storage['scandate'] = scandate
+            storage[measure] = [list(row) for row in usage]
+            storage[measure + '_total'] = sum(value for _, _, value in usage)
+        summary['storage'][storagepoint] = storage
+    return summary
+
+def write(dbfile, year, quarter):
+    """
+    Write the summary of quarter for dbfile. It is written to a temporary file
+    and renamed, so readers never see a partial summary
+    """
+    conn = UsageQuery.connect(dbfile)
+    try:
+        # Read in one transaction, so the count of changes matches the scans
+        conn.execute('BEGIN')
+        summary = build(conn, year, quarter)
+    finally:
+        conn.close()
+    filename = summary_file(dbfile, quarter)
+    tmpfile = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(tmpfile, 'w') as f:
+        json.dump(summary, f)
+    os.replace(tmpfile, filename)
+    return filename
+
+def read(dbfile, year, quarter):
+    """Summary of quarter for dbfile, or None if there is none or it is unreadable"""
+    try:
+        with open(summary_file(dbfile, quarter)) as f:
+            summary = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if summary.get('version') != version or summary.get('year') != str(year) or summary.get('quarter') != quarter:
+        return None
+    return summary
+
+def lookup(conn, dbfile, year, quarter, storagepoint, measure):
+    """
+    Return (scandate, usage, grant, igrant) as nci_usage.project_storage does
+    from the summary of quarter, or None if it is missing or stale. Checking
+    the summary against conn only needs indexed lookups of the count of
+    changes, the quarter and latest scan date
+    """
+    summary = read(dbfile, year, quarter)
+    if summary is None or storagepoint not in summary['storage']:
+        return None
+    if UsageQuery.changes(conn) != summary['changes']:
+        return None
+    startdate, enddate = UsageQuery.getstartend(conn, year, quarter)
+    if (startdate, enddate) != (summary['startdate'], summary['enddate']):
+        return None
+    storage = summary['storage'][storagepoint]
+    scandate = None
+    if startdate is not None and UsageQuery.has_table(conn, UsageQuery.storage_tables[storagepoint]):
+        scandate = UsageQuery.latest_scandate(conn, UsageQuery.storage_tables[storagepoint], startdate, enddate)
+    if scandate != storage['scandate']:
+        return None
+    return scandate, [tuple(row) for row in storage[measure]], storage['grant'], storage['igrant']
+
+def latest(conn, dbfile, year, quarter, storagepoint, measure):
+    """
+    Return (scandate, usage, grant, igrant) for the latest scan of storagepoint
+    in quarter, from the summary if it is up to date, otherwise from conn
+    """
+    result = lookup(conn, dbfile, year, quarter, storagepoint, measure)
+    if result is None:
+        scandate, usage = UsageQuery.latest_storage(conn, year, quarter, storagepoint, measure)
+        grant, igrant = UsageQuery.getsystemstorage(conn, UsageQuery.storage_systems[storagepoint], storagepoint, year, quarter)
+        result = scandate, usage, grant, igrant
+    return result
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2019 ARC Centre of Excellence for Climate Extremes
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Full names of users, shared by all the usage and jobs databases. The password
+database is read once with getpwall and saved to a JSON cache file, which is
+reused until it is older than ttl seconds, so ingest does not make an NSS
+lookup for every new user of every database. Users missing from getpwall,
+which may not enumerate LDAP users, are looked up individually with getpwnam
+and the result, including not finding them, is added to the cache. Users
+added this way are saved by flush(), which the ingests call once per dump.
+
+The cache file is $NCIMONITOR_USERCACHE if set, otherwise
+~/.cache/ncimonitor/users.json. Setting NCIMONITOR_USERCACHE to an empty
+string keeps the cache in memory only.
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import pwd
+import time
+
+def default_path():
+    path = os.environ.get('NCIMONITOR_USERCACHE')
+    if path is None:
+        path = os.path.join(os.path.expanduser('~'), '.cache', 'ncimonitor', 'users.json')
+    return path or None
+
+class UserDirectory(object):
+
+    # Seconds before the cache is refreshed from the password database
+    ttl = 86400
+
+    def __init__(self, path=None, ttl=None):
+        self.path = path
+        if ttl is not None:
+            self.ttl = ttl
+        # Full name of each username, and usernames not in the password database
+        self.users = None
+        self.missing = set()
+        self.updated = None
+        # Users have been added since the cache file was saved
+        self.dirty = False
+
+    def load(self):
+        """Read the cache file, refreshing it if it is missing or stale"""
+        if self.path is not None:
+            try:
+                with open(self.path) as f:
+                    cache = json.load(f)
+                if time.time() - cache['updated'] < self.ttl:
+                    self.users = cache['users']
+                    self.missing = set(cache['missing'])
+                    self.updated = cache['updated']
+                    return
+            except (IOError, OSError, ValueError, KeyError):
+                pass
+        self.refresh()
+
+    def refresh(self):
+        """Reload all users from the password database and save the cache"""
+        self.users = dict((entry.pw_name, entry.pw_gecos) for entry in pwd.getpwall())
+        self.missing = set()
+        self.updated = time.time()
+        self.save()
+
+    def save(self):
+        """
+        Atomically replace the cache file. Users added to the file by other
+        processes since it was read are kept. Failing to write it is not an
+        error, the cache is then only kept in memory
+        """
+        self.dirty = False
+        if self.path is None:
+            return
+        try:
+            with open(self.path) as f:
+                cache = json.load(f)
+            # Only merge caches read from the same refresh of the password database
+            if cache['updated'] == self.updated:
+                for username, fullname in cache['users'].items():
+                    self.users.setdefault(username, fullname)
+                self.missing.update(set(cache['missing']) - set(self.users))
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+        tmpfile = '{}.{}.tmp'.format(self.path, os.getpid())
+        try:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(tmpfile, 'w') as f:
+                json.dump(dict(updated=self.updated, users=self.users, missing=sorted(self.missing)), f)
+            os.replace(tmpfile, self.path)
+        except (IOError, OSError):
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+
+    def flush(self):
+        """Save the cache if users have been added since it was last saved"""
+        if self.dirty:
+            self.save()
+
+    def fullname(self, username):
+        """Full name (gecos) of username, or None if there is no such user"""
+        if self.users is None or time.time() - self.updated >= self.ttl:
+            self.load()
+        if username in self.users:
+            return self.users[username]
+        if username in self.missing:
+            return None
+        try:
+            self.users[username] = pwd.getpwnam(username).pw_gecos
+        except KeyError:
+            self.missing.add(username)
+        self.dirty = True
+        return self.users.get(username)
+
+users = UserDirectory(default_path())
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2019 ARC Centre of Excellence for Climate Extremes
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Watch a directory for new dump files and ingest them as they are completed,
+for the --watch option of the make_*_DB tools. Uses inotify where available
+to pick up files as soon as they are closed, and otherwise polls, treating a
+file as complete once its size and modification time have not changed for a
+settle period.
+"""
+
+from __future__ import print_function
+
+import ctypes
+import ctypes.util
+import datetime
+import json
+import os
+import select
+import signal
+import struct
+import sys
+import time
+import traceback
+
+from .DBcommon import sniff
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+class INotify(object):
+    """
+    Minimal inotify interface using ctypes. Raises OSError if inotify is not
+    available
+    """
+
+    event = struct.Struct('iIII')
+
+    def __init__(self, directory):
+        libcname = ctypes.util.find_library('c')
+        if libcname is None:
+            raise OSError('No C library')
+        libc = ctypes.CDLL(libcname, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError('inotify not available')
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed on {}'.format(directory))
+
+    def read(self, timeout):
+        """Return names of files closed or moved into directory, waiting up to timeout seconds"""
+        names = []
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return names
+        try:
+            buffer = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return names
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, cookie, length = self.event.unpack_from(buffer, offset)
+            offset += self.event.size
+            names.append(os.fsdecode(buffer[offset:offset+length].rstrip(b'\0')))
+            offset += length
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+class Watcher(object):
+    """
+    Call ingest with the path of each new dump file in directory, oldest
+    first. If dumptype is given other types of dump are ignored. Files are
+    only ingested once, unless they are modified. Exceptions from ingest are
+    reported and the file skipped
+    """
+
+    def __init__(self, directory, ingest, dumptype=None, interval=10., settle=30., statusfile=None, inotify=True):
+        self.directory = directory
+        self.ingest = ingest
+        self.dumptype = dumptype
+        self.interval = interval
+        self.settle = settle
+        self.statusfile = statusfile
+        # (size, mtime) of files at the previous scan
+        self.sizes = {}
+        # (size, mtime) of files already ingested or ignored
+        self.seen = {}
+        self.inotify = None
+        if inotify:
+            try:
+                self.inotify = INotify(directory)
+            except OSError as e:
+                print("Polling {}: {}".format(directory, e))
+        self.started = datetime.datetime.now()
+        self.ingested = 0
+        self.errors = 0
+        self.lastfile = None
+        self.lasterror = None
+
+    def scan(self):
+        """Return (size, mtime) of regular files in directory"""
+        files = {}
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith('.') or not entry.is_file():
+                continue
+            info = entry.stat()
+            files[entry.path] = (info.st_size, info.st_mtime)
+        return files
+
+    def ready(self, closed=()):
+        """
+        Paths of new files which are complete, either because they have been
+        closed or have not changed for the settle period, oldest first
+        """
+        files = self.scan()
+        now = time.time()
+        ready = []
+        for path, (size, mtime) in files.items():
+            if self.seen.get(path) == (size, mtime):
+                continue
+            if path in closed or (self.sizes.get(path) == (size, mtime) and now - mtime >= self.settle):
+                ready.append((mtime, path))
+        self.sizes = files
+        return [path for mtime, path in sorted(ready)]
+
+    def run_once(self, closed=()):
+        """Ingest all complete files. Returns the number ingested"""
+        ningested = 0
+        for path in self.ready(closed):
+            try:
+                info = os.stat(path)
+            except OSError:
+                # Removed since scan
+                continue
+            self.seen[path] = (info.st_size, info.st_mtime)
+            if self.dumptype is not None:
+                dump = sniff(path)
+                if dump is None or dump[0] != self.dumptype:
+                    continue
+            try:
+                self.ingest(path)
+            except Exception as e:
+                self.errors += 1
+                self.lasterror = "{}: {}".format(path, e)
+                print("Error ingesting {}".format(path), file=sys.stderr)
+                traceback.print_exc()
+            else:
+                self.ingested += 1
+                ningested += 1
+                self.lastfile = path
+        self.writestatus()
+        return ningested
+
+    def status(self, state='running'):
+        return dict(state=state,
+                    pid=os.getpid(),
+                    directory=os.path.abspath(self.directory),
+                    dumptype=self.dumptype,
+                    inotify=self.inotify is not None,
+                    started=self.started.isoformat(),
+                    heartbeat=datetime.datetime.now().isoformat(),
+                    ingested=self.ingested,
+                    errors=self.errors,
+                    lastfile=self.lastfile,
+                    lasterror=self.lasterror)
+
+    def writestatus(self, state='running'):
+        """Atomically replace the status file, if there is one"""
+        if self.statusfile is None:
+            return
+        tmpfile = self.statusfile + '.tmp'
+        with open(tmpfile, 'w') as f:
+            json.dump(self.status(state), f, indent=1)
+        os.replace(tmpfile, self.statusfile)
+
+    def run(self):
+        """Watch until interrupted or terminated"""
+        def terminate(signum, frame):
+            sys.exit(0)
+        previous = signal.signal(signal.SIGTERM, terminate)
+        print("Watching {} for new dumps".format(self.directory))
+        try:
+            closed = ()
+            while True:
+                self.run_once(closed)
+                if self.inotify is not None:
+                    closed = set(os.path.join(self.directory, name) for name in self.inotify.read(self.interval))
+                else:
+                    time.sleep(self.interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            signal.signal(signal.SIGTERM, previous)
+            if self.inotify is not None:
+                self.inotify.close()
+            self.writestatus('stopped')
+
+def add_arguments(parser):
+    """Add the watch mode options to a make_*_DB argument parser"""
+    parser.add_argument("--watch", help="Keep running, ingesting new dump files as they appear in --directory", action='store_true')
+    parser.add_argument("--interval", help="Seconds between checks for new files in watch mode", type=float, default=10.)
+    parser.add_argument("--settle", help="Seconds a file must be unchanged before it is ingested, when inotify is not available",
+                        type=float, default=30.)
+    parser.add_argument("--status", help="Status file updated with a heartbeat in watch mode")
+    parser.add_argument("--poll", help="Poll for new files rather than using inotify", action='store_true')
+
+def watch(args, ingest, dumptype):
+    """Run a Watcher configured by the options added with add_arguments"""
+    Watcher(args.directory, ingest, dumptype,
+            interval=args.interval, settle=args.settle,
+            statusfile=args.status, inotify=not args.poll).run()
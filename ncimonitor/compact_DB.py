@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2019 ARC Centre of Excellence for Climate Extremes
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Compact the short and gdata scan history in usage databases, keeping every
+scan from the current and previous quarters and thinning older scans to
+weekly or end of quarter snapshots, e.g.
+
+    compact_DB /short/public/aph502/.data/usage_*.db
+"""
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import os
+import re
+import sys
+
+# Local imports
+from .UsageDataset import ProjectDataset
+from .DBcommon import datetoyearquarter, yearquartertodates
+from .Registry import registry
+
+def cutoff(today, keep):
+    """Start of the earliest of the keep most recent quarters up to today"""
+    start = today
+    for i in range(keep):
+        start, end = yearquartertodates(*datetoyearquarter(start))
+        if i < keep - 1:
+            start = start - datetime.timedelta(days=1)
+    return start
+
+def main(args):
+
+    if args.today is not None:
+        today = datetime.datetime.strptime(args.today, "%Y-%m-%d").date()
+    else:
+        today = datetime.date.today()
+
+    before = cutoff(today, args.keep)
+    print("Compacting scans before {} to {} resolution".format(before, args.resolution))
+
+    for dbfile in args.inputs:
+        if not os.path.exists(dbfile):
+            print("No such database: {}".format(dbfile))
+            continue
+        match = re.match(r'usage_(.+)_\d{4}\.db$', os.path.basename(dbfile))
+        project = match.group(1) if match else dbfile
+        size = os.path.getsize(dbfile)
+
+        url = 'sqlite:///'+dbfile
+        with registry.dataset(url, ProjectDataset, project, url) as db:
+            if db.storagemode == 'delta':
+                print("{}: delta encoded scans, skipping".format(dbfile))
+                continue
+            removed = db.compact(before, args.resolution, dryrun=args.dryrun)
+            if not args.dryrun and not args.novacuum and sum(removed.values()) > 0:
+                db.vacuum()
+        # Close to measure the compacted size
+        registry.close(url)
+
+        print("{}: removed {} scans, {:.1f} MB -> {:.1f} MB".format(
+                  dbfile,
+                  ', '.join('{} {}'.format(n, table) for table, n in removed.items()) or 'no',
+                  size / 1024.**2, os.path.getsize(dbfile) / 1024.**2))
+
+    registry.closeall()
+
+def parse_args(args):
+    """
+    Parse arguments given as list (args)
+    """
+    parser = argparse.ArgumentParser(description="Thin out old storage scans in usage databases")
+    parser.add_argument("-r","--resolution", help="Resolution of scans older than --keep quarters",
+                        choices=['weekly', 'quarterly'], default='weekly')
+    parser.add_argument("-k","--keep", help="Number of quarters, including the current quarter, to keep every scan",
+                        type=int, default=2)
+    parser.add_argument("--today", help="Compact as if today were this date (YYYY-MM-DD)")
+    parser.add_argument("--novacuum", help="Do not vacuum databases after compacting", action='store_true')
+    parser.add_argument("--dryrun", help="Report the scans which would be removed", action='store_true')
+    parser.add_argument("inputs", help="usage databases", nargs='+')
+
+    return parser.parse_args(args)
+
+def main_parse_args(args):
+    """
+    Call main with list of arguments. Callable from tests
+    """
+    # Must return so that check command return value is passed back to calling routine
+    # otherwise py.test will fail
+    return main(parse_args(args))
+
+def main_argv():
+    """
+    Call main and pass command line arguments. This is required for setup.py entry_points
+    """
+    main_parse_args(sys.argv[1:])
+
+if __name__ == "__main__":
+
+    main_argv()
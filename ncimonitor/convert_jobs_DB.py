@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2019 ARC Centre of Excellence for Climate Extremes
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Copy the jobs in an SQLite jobs database into a DuckDB/Parquet jobs dataset
+(see ParquetJobs), e.g.
+
+    convert_jobs_DB jobs.db duckdb:///jobs
+"""
+
+from __future__ import print_function
+
+import argparse
+import sys
+import time
+
+import pandas as pd
+
+# Local imports
+from .JobsDataset import JobsDataset, open_jobs, jobs_url
+from .Registry import registry
+
+def convert(source, target, chunksize=200000):
+    """
+    Add all the jobs of JobsDataset source to ParquetJobsDataset target, in
+    chunks of chunksize jobs. Returns the number of jobs
+    """
+    jobs = source.jobsource()
+    if jobs is None:
+        return 0
+
+    qstring = """SELECT Jobs.year, Jobs.jobid, Project.project, Queue.queue, User.username, User.fullname,
+    JobState.status, Jobs.jobname, Executable.path AS exe, Jobs.ctime, Jobs.mtime, Jobs.qtime, Jobs.stime,
+    Jobs.waitime, Jobs.maxwalltime, Jobs.maxmem, Jobs.ncpus, Jobs.walltime, Jobs.mem, Jobs.cputime,
+    Jobs.cpuutil, Jobs.exitstatus FROM {}
+    LEFT JOIN Project ON Jobs.project = Project.id
+    LEFT JOIN User ON Jobs.user = User.id
+    LEFT JOIN Queue ON Jobs.queue = Queue.id
+    LEFT JOIN JobState ON Jobs.status = JobState.id
+    LEFT JOIN Executable ON Jobs.exe = Executable.id""".format(jobs)
+
+    count = 0
+    for chunk in pd.read_sql_query(qstring, source.db.executable, chunksize=chunksize):
+        target.write(chunk)
+        count += len(chunk)
+    target.compact()
+    return count
+
+def main(args):
+
+    if not args.output.startswith('duckdb://'):
+        raise ValueError('Incorrect value of output: {} Must be a duckdb:/// URL'.format(args.output))
+
+    with registry.dataset(args.output, open_jobs, args.output) as target:
+        for database in args.inputs:
+            start = time.time()
+            url = jobs_url(database)
+            with registry.dataset(url, JobsDataset, url, profile='read-only') as source:
+                count = convert(source, target, args.chunksize)
+            print("{}: copied {} jobs in {:.1f} s".format(database, count, time.time() - start))
+
+    registry.closeall()
+
+def parse_args(args):
+    """
+    Parse arguments given as list (args)
+    """
+    parser = argparse.ArgumentParser(description="Copy SQLite jobs databases to a DuckDB/Parquet jobs dataset")
+    parser.add_argument("inputs", help="SQLite jobs databases", nargs='+')
+    parser.add_argument("output", help="Jobs dataset URL, e.g. duckdb:///jobs")
+    parser.add_argument("--chunksize", help="Number of jobs read at a time", type=int, default=200000)
+
+    return parser.parse_args(args)
+
+def main_parse_args(args):
+    """
+    Call main with list of arguments. Callable from tests
+    """
+    # Must return so that check command return value is passed back to calling routine
+    # otherwise py.test will fail
+    return main(parse_args(args))
+
+def main_argv():
+    """
+    Call main and pass command line arguments. This is required for setup.py entry_points
+    """
+    main_parse_args(sys.argv[1:])
+
+if __name__ == "__main__":
+
+    main_argv()
@@ -30,23 +30,33 @@ import re
 import gzip
 import shutil
 from .UsageDataset import *
-from .DBcommon import extract_num_unit, parse_size, mkdir, archive, parse_inodenum
-
-databases = {}
+from .DBcommon import extract_num_unit, parse_size, mkdir, archive, open_dump, add_archive_arguments, add_tuning_argument, parse_inodenum
+from .IngestStats import stats, add_arguments, instrument
+from . import Watcher
+from . import Pipeline
+from .DatasetBase import commitall, rollbackall
+from .Registry import registry
+
+# Datasets opened by this parser, shared with other modules through the registry
+databases = registry.handles()
 dbfileprefix = '.'
+# Extra arguments for ProjectDataset, e.g. bulk=True
+dbargs = {}
 verbose = False
+# Makes the database calls, see Pipeline
+writer = Pipeline.Inline()
 
 def parse_SU_file(filename):
 
     insystem = False; instorage = False; inuser = False
     
-    with open(filename) as f:
+    with open_dump(filename) as f:
 
         year = ''; quarter = ''
         for line in f:
             if line.startswith("%%%%%%%%%%%%%%%%%"):
                 # Grab date string
-                date = datetime.datetime.strptime(f.next().strip(os.linesep), "%a %b %d %H:%M:%S %Z %Y").date()
+                date = datetime.datetime.strptime(next(f).strip(os.linesep), "%a %b %d %H:%M:%S %Z %Y").date()
             elif line.startswith("Usage Report:") and "Compute" in line:
                 words = line.split()
                 project = words[2].split('=')[1]
@@ -55,43 +65,46 @@ def parse_SU_file(filename):
                 startdate, enddate = words[5].split('-')
                 startdate = datetime.datetime.strptime(startdate.strip('('),"%d/%m/%Y").date()
                 enddate = datetime.datetime.strptime(enddate.strip(')'),"%d/%m/%Y").date()
-                if not project in databases:
-                    dbfile = 'sqlite:///'+os.path.join(dbfileprefix,"usage_{}_{}.db".format(project,year))
-                    databases[project] = ProjectDataset(project,dbfile)
-                db = databases[project]
-                db.addquarter(year,quarter,startdate,enddate)
+                dbfile = 'sqlite:///'+os.path.join(dbfileprefix,"usage_{}_{}.db".format(project,year))
+                # Opened in the writer thread, which makes all the changes to its schema
+                db = writer.sync(databases.open, dbfile, ProjectDataset, project, dbfile, **dbargs)
+                # Commit once per file rather than once per row. The tables are created first
+                writer.call(db.begin)
+                writer.call(db.addquarter, year,quarter,startdate,enddate)
             elif line.startswith("Total Grant:"):
                 total = line.split(":")[1]
                 # Grant is stored in KSU, parse_size translates to SU, so divide by zero
-                db.addgrant(year,quarter,parse_size(total.upper(),u='SU')/1000.)
+                writer.call(db.addgrant, year,quarter,parse_size(total.upper(),u='SU')/1000.)
             elif line.startswith("System        Queue"):
                 insystem = True
-                f.next()
+                next(f)
             elif insystem:
                 try:
                     (system,queue,weight,usecpu,usewall,usesu,tmp,tmp,tmp) = line.strip(os.linesep).split() 
                 except:
                     insystem = False
                     continue
-                db.addsystemqueue(system,queue,weight)
+                writer.call(db.addsystemqueue, system,queue,weight)
                 if verbose: print('Add project usage ',date,system,queue,usecpu,usewall,usesu)
-                db.addprojectusage(date,system,queue,usecpu,usewall,usesu)
+                writer.call(db.addprojectusage, date,system,queue,usecpu,usewall,usesu)
+                stats.count('rows')
             elif line.startswith("Batch Queue Usage per User"):
                 inuser = True
                 # Gobble three lines
-                f.next(); f.next(); f.next()
+                next(f); next(f); next(f)
             elif inuser:
                 try:
                     (user,usecpu,usewall,usesu,tmp) = line.strip(os.linesep).split() 
                 except:
                     inuser = False
                     continue
-                db.adduser(user)
+                writer.call(db.adduser, user)
                 if verbose: print('Add usage ',date,user,usecpu,usewall,usesu)
-                db.adduserusage(date,user,usecpu,usewall,usesu)
+                writer.call(db.adduserusage, date,user,usecpu,usewall,usesu)
+                stats.count('rows')
             elif line.startswith("System    StoragePt"):
                 instorage = True
-                f.next()
+                next(f)
             elif instorage:
                 try:
                     (systemname,storagept,grant,tmp,tmp,igrant,tmp,tmp) = line.strip(os.linesep).split() 
@@ -99,21 +112,48 @@ def parse_SU_file(filename):
                     instorage = False
                     continue
                 print(year, quarter, systemname, storagept, grant.upper(), parse_size(grant.upper()))
-                db.addsystemstorage(systemname,storagept,year,quarter,parse_size(grant.upper()),parse_inodenum(igrant))
+                writer.call(db.addsystemstorage, systemname,storagept,year,quarter,parse_size(grant.upper()),parse_inodenum(igrant))
+                stats.count('rows')
 
+    # Wait for the writes to be committed before the dump is archived
+    writer.sync(commitall, databases)
 
 def main(args):
 
+    global writer
+
     verbose = args.verbose
 
-    for f in args.inputs:
+    dbargs['profile'] = args.tuning
+    dbargs['summary'] = not args.nosummary
+
+    def ingest(f):
         if verbose: print(f)
+        stats.count('files')
+        stats.count('bytes', os.path.getsize(f))
         try:
-            parse_SU_file(f);
+            with stats.timer('parse'):
+                parse_SU_file(f);
         except:
+            writer.abort(rollbackall, databases)
             raise
         else:
-            archive(f)
+            if not args.noarchive:
+                with stats.timer('archive'):
+                    archive(f, codec=args.codec, level=args.level)
+
+    writer = Pipeline.writer(args)
+    try:
+        with instrument(args):
+            for f in args.inputs:
+                ingest(f)
+            if args.watch:
+                Watcher.watch(args, ingest, 'SU')
+    finally:
+        # Anything called afterwards, e.g. rebuild_DB, writes inline
+        done, writer = writer, Pipeline.Inline()
+        done.close()
+        databases.close()
 
 def parse_args(args):
     """
@@ -122,9 +162,15 @@ def parse_args(args):
     parser = argparse.ArgumentParser(description="Parse usage dump files")
     parser.add_argument("-d","--directory", help="Specify directory to find dump files", default=".")
     parser.add_argument("-v","--verbose", help="Verbose output", action='store_true')
-    parser.add_argument("inputs", help="dumpfiles", nargs='+')
-
-    return parser.parse_args()
+    parser.add_argument("inputs", help="dumpfiles", nargs='*')
+    add_archive_arguments(parser)
+    add_tuning_argument(parser, 'online-write')
+    parser.add_argument("--nosummary", help="Do not write the summaries of the latest storage scans read by nci_usage", action='store_true')
+    Watcher.add_arguments(parser)
+    Pipeline.add_arguments(parser)
+    add_arguments(parser)
+
+    return parser.parse_args(args)
 
 def main_parse_args(args):
     """
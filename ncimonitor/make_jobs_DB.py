@@ -31,12 +31,22 @@ from string import Template
 import sys
 
 # Local imports
-from JobsDataset import *
-from DBcommon import extract_num_unit, parse_size, mkdir, archive, datetoyearquarter
-
-databases = {}
+from .JobsDataset import *
+from .DBcommon import extract_num_unit, parse_size, mkdir, archive, open_dump, add_archive_arguments, add_tuning_argument, datetoyearquarter
+from .IngestStats import stats, add_arguments, instrument
+from . import Watcher
+from . import Pipeline
+from .DatasetBase import commitall, rollbackall
+from .Registry import registry
+
+# Datasets opened by this parser, shared with other modules through the registry
+databases = registry.handles()
 dbfileprefix = '.'
+# Extra arguments for JobsDataset, e.g. bulk=True
+dbargs = {}
 verbose = False
+# Makes the database calls, see Pipeline
+writer = Pipeline.Inline()
 
 class DeltaTemplate(Template):
     delimiter = "%"
@@ -93,21 +103,99 @@ def strip_ml(text):
         return None
     return re.sub('<[^<]+?>', '', text)
 
+def size_to_bytes(sizestring):
+    return int(parse_size(sizestring.upper()))
+
+# Marks fields which every job must have
+REQUIRED = object()
+
+# The job attributes read from qstat json dumps, as (name, path, converter,
+# default). path is the attribute name, or (attribute, resource) for
+# Resource_List and resources_used. Missing attributes take the default, which
+# is not converted. Everything else in the dump is discarded as it is decoded
+jobfields = (
+    ('queue', 'queue', None, REQUIRED),
+    ('project', 'project', None, REQUIRED),
+    ('username', 'Job_Owner', lambda owner: owner.split('@')[0], REQUIRED),
+    ('status', 'job_state', None, REQUIRED),
+    ('jobname', 'Job_Name', None, REQUIRED),
+    ('jobprio', ('Resource_List', 'jobprio'), None, REQUIRED),
+    ('exe', 'executable', strip_ml, ''),
+    ('arguments', 'argument_list', strip_ml, ''),
+    ('submit_arguments', 'Submit_arguments', None, ''),
+    ('ctime', 'ctime', pbs_str_to_date, REQUIRED),
+    ('qtime', 'qtime', pbs_str_to_date, REQUIRED),
+    ('mtime', 'mtime', pbs_str_to_date, REQUIRED),
+    ('stime', 'stime', pbs_str_to_date, None),
+    ('maxwalltime', ('Resource_List', 'walltime'), walltime_to_seconds, REQUIRED),
+    ('maxmem', ('Resource_List', 'mem'), size_to_bytes, 0),
+    ('ncpus', ('Resource_List', 'ncpus'), None, None),
+    ('walltime', ('resources_used', 'walltime'), walltime_to_seconds, -1.),
+    ('mem', ('resources_used', 'mem'), size_to_bytes, 0),
+    ('cputime', ('resources_used', 'cput'), walltime_to_seconds, -1.),
+    # Use -999 to signify no exit status
+    ('exitstatus', 'Exit_status', None, -999),
+)
+
+# Every attribute and resource name in jobfields
+projected = frozenset(name for _, path, _, _ in jobfields
+                      for name in ((path,) if isinstance(path, str) else path))
+
+def project(pairs):
+    """
+    object_pairs_hook for json.load which keeps only the attributes in
+    jobfields. Objects with none of them, such as the dict of all jobs, are
+    kept whole
+    """
+    kept = {key: value for key, value in pairs if key in projected}
+    if len(kept) == 0:
+        return dict(pairs)
+    return kept
+
+def extract(info):
+    """Dict of the jobfields of info, a job decoded from a qstat json dump"""
+    job = {}
+    for name, path, converter, default in jobfields:
+        if isinstance(path, str):
+            attributes, key = info, path
+        else:
+            attributes, key = info.get(path[0], {}), path[1]
+        if key in attributes:
+            value = attributes[key]
+            job[name] = value if converter is None else converter(value)
+        elif default is REQUIRED:
+            raise KeyError(path)
+        else:
+            job[name] = default
+    return job
+
 def parse_qstat_json_dump(filename, dbfile, verbose=False):
 
-    db = JobsDataset("sqlite:///{}".format(dbfile))
+    # Opened in the writer thread, which makes all the changes to its schema
+    db = writer.sync(databases.open, jobs_url(dbfile), open_jobs, jobs_url(dbfile), **dbargs)
 
-    numrecords = db.getnumrecords()
+    numrecords = writer.sync(db.getnumrecords)
 
-    nentries = 0
+    nentries = 0; nskipped = 0
 
-    with open(filename) as f:
+    with open_dump(filename) as f:
 
-        data = json.load(f)
+        # Only decode the attributes which are stored, discarding the rest
+        # of each job, including the environment, as it is read
+        data = json.load(f, object_pairs_hook=project)
 
         if 'Jobs' in data:
             data = data['Jobs']
 
+        # Commit once per dump rather than once per job. The jobs tables of
+        # the years in the dump are created before the transaction starts
+        years = set(pbs_str_to_date(info['ctime']).year for jobid, info in data.items()
+                    if jobid != '_default' and 'ctime' in info)
+        writer.call(db.begin, [db.jobstable(year) for year in sorted(years)])
+
+        # Read what is stored of these jobs in a few queries, rather than one per job
+        writer.sync(db.loadindex, [jobid.split('.')[0] for jobid in data if jobid != '_default'])
+
         for jobid, info in data.items():
 
             if jobid == '_default': continue
@@ -116,14 +204,18 @@ def parse_qstat_json_dump(filename, dbfile, verbose=False):
                 # Strip off '.r-man2' suffix if it exists
                 jobid = jobid.split('.')[0]
 
-                # Must have
-                ctime = maybe_get_time(info, 'ctime', must=True)
-                qtime = maybe_get_time(info, 'qtime', must=True)
-                mtime = maybe_get_time(info, 'mtime', must=True)
+                job = extract(info)
+                ctime = job['ctime']
 
                 # Store all times as offset from creation time in seconds
-                qtime = (qtime - ctime).total_seconds()
-                mtime = (mtime - ctime).total_seconds()
+                qtime = (job['qtime'] - ctime).total_seconds()
+                mtime = (job['mtime'] - ctime).total_seconds()
+
+                # Finished jobs appear in many dumps, only store them again if changed
+                if db.unchanged(ctime.year, jobid, mtime, job['status']):
+                    nentries += 1; nskipped += 1
+                    stats.count('skipped')
+                    continue
 
                 """
                     B  Array job: at least one subjob has started.
@@ -141,7 +233,7 @@ def parse_qstat_json_dump(filename, dbfile, verbose=False):
                 """
 
                 # Put in some logic checking for job_state?
-                stime = maybe_get_time(info, 'stime')
+                stime = job['stime']
 
                 # Needed to calculate time in the queue
                 if stime is None:
@@ -155,66 +247,75 @@ def parse_qstat_json_dump(filename, dbfile, verbose=False):
                 # job started
                 waitime = (start - ctime).total_seconds()
 
-                # year = int(info['qtime'].split()[-1])
                 year = ctime.year
 
-                username = info['Job_Owner'].split('@')[0]
-
-                resources = info['Resource_List']
-                resources_used = info.get('resources_used',{})
-
-                maxwalltime = walltime_to_seconds(resources['walltime'])
-                walltime = walltime_to_seconds(resources_used.get('walltime', None))
-                maxmem = int(parse_size(resources.get('mem', '0b').upper()))
-                ncpus = resources.get('ncpus', None)
-                mem = int(parse_size(resources_used.get('mem', '0b').upper()))
-                cputime = walltime_to_seconds(resources_used.get('cput', None))
+                walltime = job['walltime']; ncpus = job['ncpus']
                 try:
-                    cpuutil = cputime/(walltime*ncpus)
+                    cpuutil = job['cputime']/(walltime*ncpus)
                 except ZeroDivisionError:
                     cpuutil = -1.
 
-                exe = strip_ml(info.get('executable', ''))
-                arglist = strip_ml(info.get('argument_list', ''))
-                subarglist = info.get('Submit_arguments', '')
-
-                # Use -999 to signify no exit status
-                exit_status =  info.get('Exit_status',-999)
-
+                record = (year, job['queue'], jobid, job['project'], job['username'],
+                          job['status'], job['jobname'], job['jobprio'], job['exe'], job['arguments'] + job['submit_arguments'],
+                          ctime, mtime, qtime, stime, waitime,
+                          job['maxwalltime'], job['maxmem'], ncpus,
+                          walltime, job['mem'], job['cputime'], cpuutil, job['exitstatus'])
                 if verbose:
-                    print(year, info['queue'], jobid, info['project'], username,
-                        info['job_state'], info['Job_Name'], resources['jobprio'], exe, arglist + subarglist,
-                        ctime, mtime, qtime, stime, waitime,
-                        maxwalltime, maxmem, ncpus,
-                        walltime, mem, cputime, cpuutil, exit_status)
-                db.addjob(year, info['queue'], jobid, info['project'], username,
-                        info['job_state'], info['Job_Name'], resources['jobprio'], exe, arglist + subarglist,
-                        ctime, mtime, qtime, stime, waitime,
-                        maxwalltime, maxmem, ncpus,
-                        walltime, mem, cputime, cpuutil, exit_status)
+                    print(*record)
+                writer.call(db.addjob, *record)
                 nentries += 1
+                stats.count('rows')
             except:
                 print("Error parsing {}".format(jobid))
                 print(info)
                 raise
                     
-    newrecords = db.getnumrecords() - numrecords
+    # Save the quantile sketches of newly finished jobs, and the daily rollups
+    writer.call(db.flushsketches)
+    writer.call(db.flushrollups)
+    writer.call(commitall, databases)
 
-    print("Found {} entries. Added {} new records, {} records updated or unchanged".format(nentries, newrecords, nentries - newrecords)) 
+    # Also waits for the dump to be committed before it is archived
+    newrecords = writer.sync(db.getnumrecords) - numrecords
+
+    print("Found {} entries. Added {} new records, {} records updated, {} finished and unchanged".format(
+              nentries, newrecords, nentries - newrecords - nskipped, nskipped)) 
 
 def main(args):
 
+    global writer
+
     verbose = args.verbose
 
-    for f in args.inputs:
+    dbargs['profile'] = args.tuning
+
+    def ingest(f):
         print("Reading dumpfile: {}".format(f))
+        stats.count('files')
+        stats.count('bytes', os.path.getsize(f))
         try:
-            parse_qstat_json_dump(f, args.database, verbose)
+            with stats.timer('parse'):
+                parse_qstat_json_dump(f, args.database, verbose)
         except:
+            writer.abort(rollbackall, databases)
             raise
         else:
-            archive(f)
-            pass
+            if not args.noarchive:
+                with stats.timer('archive'):
+                    archive(f, codec=args.codec, level=args.level)
+
+    writer = Pipeline.writer(args)
+    try:
+        with instrument(args):
+            for f in args.inputs:
+                ingest(f)
+            if args.watch:
+                Watcher.watch(args, ingest, 'jobs')
+    finally:
+        # Anything called afterwards, e.g. rebuild_DB, writes inline
+        done, writer = writer, Pipeline.Inline()
+        done.close()
+        databases.close()
 
 def parse_args(args):
     """
@@ -223,10 +324,15 @@ def parse_args(args):
     parser = argparse.ArgumentParser(description='Read PBS job information from qstat json file dumps and store in a database')
     parser.add_argument('-d','--directory', help='Specify directory to find dump files', default='.')
     parser.add_argument('-v','--verbose', help='Verbose output', action='store_true')
-    parser.add_argument('-db','--database', help='Verbose output', default='jobs.db')
-    parser.add_argument('inputs', help='dumpfiles', nargs='+')
-
-    return parser.parse_args()
+    parser.add_argument('-db','--database', help='Jobs database, an SQLite file or URL, e.g. duckdb:///jobs', default='jobs.db')
+    parser.add_argument('inputs', help='dumpfiles', nargs='*')
+    add_archive_arguments(parser)
+    add_tuning_argument(parser, 'online-write')
+    Watcher.add_arguments(parser)
+    Pipeline.add_arguments(parser)
+    add_arguments(parser)
+
+    return parser.parse_args(args)
 
 def main_parse_args(args):
     """
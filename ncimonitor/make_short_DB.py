@@ -28,17 +28,27 @@ import sys
 import re
 import shutil
 from .UsageDataset import *
-from .DBcommon import extract_num_unit, parse_size, mkdir, archive, datetoyearquarter
-
-databases = {}
+from .DBcommon import extract_num_unit, parse_size, mkdir, archive, open_dump, add_archive_arguments, add_tuning_argument, datetoyearquarter
+from .IngestStats import stats, add_arguments, instrument
+from . import Watcher
+from . import Pipeline
+from .DatasetBase import commitall, rollbackall
+from .Registry import registry
+
+# Datasets opened by this parser, shared with other modules through the registry
+databases = registry.handles()
 dbfileprefix = '.'
+# Extra arguments for ProjectDataset, e.g. bulk=True
+dbargs = {}
 verbose = False
+# Makes the database calls, see Pipeline
+writer = Pipeline.Inline()
 
 def parse_short_file(filename):
 
     db = None
     
-    with open(filename) as f:
+    with open_dump(filename) as f:
 
         # Need this loop to support old method of having multiple dumps per file
         while True:
@@ -47,48 +57,81 @@ def parse_short_file(filename):
                 for line in f:
                     if line.startswith("%%%%%%%%%%%%%%%%%"):
                         # Grab date string
-                        date = datetime.datetime.strptime(f.next().strip(os.linesep), "%a %b %d %H:%M:%S %Z %Y")
+                        date = datetime.datetime.strptime(next(f).strip(os.linesep), "%a %b %d %H:%M:%S %Z %Y")
                         year, quarter = datetoyearquarter(date)
                         # Gobble another line
-                        line = f.next()
+                        line = next(f)
                         break
                     else:
                         next
 
                 # Assume a certain structure ....
-                line = f.next()
+                line = next(f)
                 project = line.split()[4].strip(':')
-                if not project in databases:
-                    dbfile = 'sqlite:///'+os.path.join(dbfileprefix,"usage_{}_{}.db".format(project,date.year))
-                    databases[project] = ProjectDataset(project,dbfile)
-                db = databases[project]
+                dbfile = 'sqlite:///'+os.path.join(dbfileprefix,"usage_{}_{}.db".format(project,date.year))
+                # Opened in the writer thread, which makes all the changes to its schema
+                db = writer.sync(databases.open, dbfile, ProjectDataset, project, dbfile, **dbargs)
+                # Commit once per file rather than once per row. The tables are created first
+                writer.call(db.begin)
 
                 # Gobble the three header lines
-                line = f.next(); line = f.next(); line = f.next()
+                line = next(f); line = next(f); line = next(f)
 
                 for line in f:
                     try:
                         (folder,user,size,inodes,scandate) = line.strip(os.linesep).split() 
-                    except:
+                    except ValueError:
+                        # End of the dump
                         break
-                    db.adduser(user)
+                    writer.call(db.adduser, user)
                     if verbose: print('Adding short ',folder,user,size,inodes,scandate)
-                    db.addshortusage(folder,user,parse_size(size.upper()),inodes,scandate)
-            except:
+                    writer.call(db.addshortusage, folder,user,parse_size(size.upper()),inodes,scandate)
+                    stats.count('rows')
+            except StopIteration:
+                # End of the file. Any other error must reach ingest, so
+                # the file is rolled back rather than committed and archived
                 break
 
+    # Wait for the writes to be committed before the dump is archived
+    writer.sync(commitall, databases)
+
 def main(args):
 
+    global writer
+
     verbose = args.verbose
 
-    for f in args.inputs:
+    dbargs['profile'] = args.tuning
+    dbargs['summary'] = not args.nosummary
+    dbargs['delta'] = args.delta
+
+    def ingest(f):
         if verbose: print(f)
+        stats.count('files')
+        stats.count('bytes', os.path.getsize(f))
         try:
-            parse_short_file(f);
+            with stats.timer('parse'):
+                parse_short_file(f);
         except:
+            writer.abort(rollbackall, databases)
             raise
         else:
-            archive(f)
+            if not args.noarchive:
+                with stats.timer('archive'):
+                    archive(f, codec=args.codec, level=args.level)
+
+    writer = Pipeline.writer(args)
+    try:
+        with instrument(args):
+            for f in args.inputs:
+                ingest(f)
+            if args.watch:
+                Watcher.watch(args, ingest, 'short')
+    finally:
+        # Anything called afterwards, e.g. rebuild_DB, writes inline
+        done, writer = writer, Pipeline.Inline()
+        done.close()
+        databases.close()
 
 def parse_args(args):
     """
@@ -97,9 +140,16 @@ def parse_args(args):
     parser = argparse.ArgumentParser(description="Parse short file dumps")
     parser.add_argument("-d","--directory", help="Specify directory to find dump files", default=".")
     parser.add_argument("-v","--verbose", help="Verbose output", action='store_true')
-    parser.add_argument("inputs", help="dumpfiles", nargs='+')
-
-    return parser.parse_args()
+    parser.add_argument("inputs", help="dumpfiles", nargs='*')
+    add_archive_arguments(parser)
+    add_tuning_argument(parser, 'online-write')
+    parser.add_argument("--nosummary", help="Do not write the summaries of the latest storage scans read by nci_usage", action='store_true')
+    parser.add_argument("--delta", help="Only store folders which changed since the previous scan in new databases", action='store_true')
+    Watcher.add_arguments(parser)
+    Pipeline.add_arguments(parser)
+    add_arguments(parser)
+
+    return parser.parse_args(args)
 
 def main_parse_args(args):
     """
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2019 ARC Centre of Excellence for Climate Extremes
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Rank projects, or their users, by the risk of using up their SU grant this
+quarter, forecast from the current burn rate, e.g.
+
+    nciforecast -P w35 w40 --users --format csv
+
+Without -P every project with a usage database for the year is forecast
+"""
+
+from __future__ import print_function
+
+import argparse
+import csv
+import datetime
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+# Local imports
+from .UsageDataset import ProjectDataset, NotInDatabase
+from .DBcommon import datetoyearquarter, expand_projects, project_groups
+from .Forecast import forecast, rank
+from .nci_leaderboard import find_databases
+from .Registry import registry
+
+dbfileprefix = '/short/public/aph502/.data/'
+
+def project_su(project, year, quarter, byuser=False):
+    """
+    Read the quarter start and end dates, grant (KSU) and quarter to date
+    usage (KSU) of project, in total and of each user if byuser. Returns None
+    if there is no data. Can be called from any thread, as dataset connects
+    each thread separately
+    """
+    dbfile = os.path.join(dbfileprefix, 'usage_{}_{}.db'.format(project, year))
+    if not os.path.exists(dbfile):
+        print("No usage database for project {} in {}".format(project, year), file=sys.stderr)
+        return None
+
+    url = 'sqlite:///'+dbfile
+    with registry.dataset(url, ProjectDataset, project, url, profile='read-only') as db:
+        try:
+            startdate, enddate = db.getstartend(year, quarter, asdate=True)
+            dates, usage = db.getprojectsu(year, quarter)
+            if len(dates) == 0:
+                return None
+            total = pd.Series(usage, index=pd.to_datetime(dates), name=project)
+            users = None
+            if byuser:
+                users = db.getusage(year, quarter, namefield='user')
+                if users is not None:
+                    users = users / 1000.
+            return startdate, enddate, db.getgrant(year, quarter), total, users
+        except NotInDatabase:
+            return None
+
+def main(args):
+
+    if args.period is not None:
+        year, quarter = args.period.split(".")
+    else:
+        year, quarter = datetoyearquarter(datetime.datetime.now())
+
+    if args.project is not None:
+        projects = expand_projects(args.project)
+    else:
+        projects = sorted(find_databases(dbfileprefix, year))
+
+    with ThreadPoolExecutor(max_workers=max(1, args.threads)) as pool:
+        results = list(pool.map(lambda project: project_su(project, year, quarter, args.users), projects))
+    registry.closeall()
+    results = dict((project, result) for project, result in zip(projects, results) if result is not None)
+
+    if len(results) == 0:
+        print("No usage data available", file=sys.stderr)
+        return
+
+    # All projects share the same quarter
+    startdate, enddate = next(iter(results.values()))[:2]
+    grants = [grant for _, _, grant, _, _ in results.values()]
+
+    if args.users:
+        usage = pd.concat([users for _, _, _, _, users in results.values() if users is not None], axis=1,
+                          keys=[project for project, result in results.items() if result[4] is not None],
+                          names=['project', 'user'])
+        grants = [results[project][2] for project, user in usage.columns]
+    else:
+        usage = pd.concat([total for _, _, _, total, _ in results.values()], axis=1)
+        usage.columns.name = 'project'
+    grants = [float('nan') if grant is None else grant for grant in grants]
+
+    forecasts = rank(forecast(usage, grants, startdate, enddate, args.window))
+    if args.count is not None:
+        forecasts = forecasts.head(args.count)
+
+    if args.format == 'table':
+        table = forecasts.copy()
+        table['date'] = table['date'].dt.date
+        table['exhaustion'] = table['exhaustion'].dt.date
+        table['risk'] = table['risk'] * 100.
+        table.columns = ['Used (KSU)', 'Date', 'Rate (KSU/day)', 'Projected (KSU)', 'Grant (KSU)', 'Exhausted', 'Risk (%)']
+        print("Forecast to {} for {}.{}".format(enddate, year, quarter))
+        print(table.to_string(float_format='%.1f', na_rep='-'))
+        return
+
+    records = []
+    for record in forecasts.reset_index().to_dict('records'):
+        for field in ('date', 'exhaustion'):
+            record[field] = None if pd.isnull(record[field]) else record[field].date().isoformat()
+        for field in ('grant', 'risk'):
+            if pd.isnull(record[field]):
+                record[field] = None
+        records.append(record)
+
+    if args.format == 'json':
+        json.dump(dict(year=str(year), quarter=quarter, enddate=enddate.isoformat(), records=records), sys.stdout, indent=1)
+        print()
+    else:
+        writer = csv.DictWriter(sys.stdout, list(records[0]), delimiter=',' if args.format == 'csv' else '\t', lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(records)
+
+def parse_args(args):
+    """
+    Parse arguments given as list (args)
+    """
+    parser = argparse.ArgumentParser(description="Forecast SU usage and rank projects by risk of using up their grant")
+    parser.add_argument("-P","--project", nargs='+',
+                        help="Project(s) or group aliases ({}) to forecast, default all".format(', '.join(sorted(project_groups))))
+    parser.add_argument("-p","--period", help="Quarter to forecast, e.g. 2019.q1 (default: current quarter)")
+    parser.add_argument("-u","--users", help="Forecast each user of each project against the project grant", action='store_true')
+    parser.add_argument("-w","--window", help="Days of usage used to estimate the burn rate", type=int, default=14)
+    parser.add_argument("-n","--count", help="Only show the highest risk forecasts", type=int)
+    parser.add_argument("--threads", help="Number of databases to read concurrently", type=int, default=8)
+    parser.add_argument("--format", help="Output format", choices=['table', 'json', 'csv', 'tsv'], default='table')
+
+    return parser.parse_args(args)
+
+def main_parse_args(args):
+    """
+    Call main with list of arguments. Callable from tests
+    """
+    # Must return so that check command return value is passed back to calling routine
+    # otherwise py.test will fail
+    return main(parse_args(args))
+
+def main_argv():
+    """
+    Call main and pass command line arguments. This is required for setup.py entry_points
+    """
+    main_parse_args(sys.argv[1:])
+
+if __name__ == "__main__":
+
+    main_argv()
@@ -43,6 +43,7 @@ from getpass import getuser
 # from make_usage_db import *
 from ncimonitor.JobsDataset import *
 from ncimonitor.DBcommon import *
+from ncimonitor.Registry import registry
 
 plt.style.use('ggplot')
 
@@ -173,7 +174,7 @@ def main():
 
     parser = argparse.ArgumentParser(description="Show NCI job usage information")
 
-    parser.add_argument("-db","--database", help="Database file", default='jobs.db')
+    parser.add_argument("-db","--database", help="Jobs database, an SQLite file or URL, e.g. duckdb:///jobs", default='jobs.db')
     parser.add_argument("-u","--users", help="Limit information to specified users", action='append')
     parser.add_argument("-p","--period", help="Time period in year.quarter (e.g. 2015.q4)")
     parser.add_argument("-P","--project", help="Specify project id(s)", nargs='*')
@@ -184,6 +185,9 @@ def main():
     parser.add_argument("-v","--plotvar", help="Variable to plot", default='waittime')
     parser.add_argument("-g","--groupvar", help="Variable by which to group", default='queue')
     parser.add_argument("-s","--splitvar", help="Variable by which to split groups", default='ncpusbin')
+    parser.add_argument("-a","--aggfunc", help="Aggregation function applied to plotvar", choices=JobsDataset.aggfuncs, default='mean')
+    parser.add_argument("-q","--quantile", help="Plot this quantile of plotvar (e.g. 0.9) from the stored job sketches", type=float)
+    add_tuning_argument(parser, 'read-only')
     group = parser.add_mutually_exclusive_group()
     group.add_argument("--showtotal", help="Show the file usage limit", action='store_true')
     group.add_argument("-d","--delta", help="Show change in file system usage since beginning of time period", action='store_true')
@@ -191,53 +195,53 @@ def main():
     args = parser.parse_args()
     plot_by_user = False
 
+    startdate = enddate = None
     if args.period is not None:
         year, quarter = args.period.split(".")
-    else:
-        date = datetime.datetime.now()
-        year, quarter = datetoyearquarter(date)
+        startdate, enddate = yearquartertodates(year, quarter)
 
     use_full_name = not args.username
 
-    dbfile = 'sqlite:///'+os.path.join(args.database)
+    dbfile = jobs_url(args.database)
     try:
-        db = JobsDataset(dbfile)
+        db = registry.acquire(dbfile, open_jobs, dbfile, profile=args.tuning)
     except:
-        print("ERROR! You are not a member of this group: ",project)
+        print("ERROR! Could not open database: ",args.database)
     else:
 
-        df = db.getjobs()
-
-        if df.empty:
-            raise ValueError("No data returned for this query")
-
+        project = None
         if args.project:
-            project = []
-            for p in args.project:
-                if p == 'clex':
-                    project.extend(['w35', 'w40', 'w42', 'w48', 'w97', 'v45'])
-                elif p == 'mom':
-                    project.extend(['v45', 'e14', 'x77', 'g40'])
-                else:
-                    project.append(p)
-            project = set(project)
+            project = expand_projects(args.project)
             print(project)
-            df = df.loc[df.project.isin(project),]
-
-        users = None
-        if args.users is not None:
-            users = args.users
-            df = df.loc[df.username.isin(args.users),]
 
-        if df.empty:
+        if args.quantile is not None:
+            # Merge precomputed daily sketches rather than reading individual jobs
+            if args.users is not None:
+                raise ValueError("Quantiles are not available for individual users")
+            df = db.getquantiles(variable=args.plotvar, quantiles=[args.quantile],
+                                 by=[args.groupvar, args.splitvar],
+                                 startdate=startdate, enddate=enddate, projects=project)
+            if df is not None:
+                df = df[args.quantile].unstack(args.splitvar)
+                if args.splitvar == 'ncpusbin':
+                    df = df.reindex(columns=[l for l in JobsDataset.ncilabels if l in df.columns])
+        else:
+            # Filtering, binning and aggregation are all done in the database, so
+            # only the final (small) table is returned
+            df = db.aggregate(plotvar=args.plotvar, groupvar=args.groupvar, splitvar=args.splitvar,
+                              aggfunc=args.aggfunc, startdate=startdate, enddate=enddate,
+                              projects=project, users=args.users)
+
+        if df is None or df.empty:
             raise ValueError("No data left after applying variable choices")
 
-        # Add a binned job size column using cut
-        # pd.cut(df.ncpus,[0,1,2,16,128,1024,float("inf")])
-
-        pd.pivot_table(df, values=args.plotvar, index=args.groupvar, columns=args.splitvar).plot(kind='bar')
+        df.plot(kind='bar')
 
         if not args.noshow: plt.show()
 
+        registry.release(db)
+
+    registry.closeall()
+
 if __name__ == "__main__":
     main()
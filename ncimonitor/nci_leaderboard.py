@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2019 ARC Centre of Excellence for Climate Extremes
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+The users holding the most storage across the usage databases of all
+projects, from the latest scan of each project in a quarter, e.g.
+
+    nci_leaderboard --period 2019.q1 --gdata --count 20
+
+Databases are read concurrently, from their summaries where these are up
+to date (see UsageSummary), and each project's usage is merged into a heap
+of the largest count entries as it is read
+"""
+
+from __future__ import print_function
+
+import argparse
+import csv
+import datetime
+import glob
+import heapq
+import json
+import os
+import sqlite3
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Local imports
+from . import UsageQuery, UsageSummary
+from .DBcommon import datetoyearquarter, expand_projects, project_groups
+from .nci_usage import dbfileprefix
+
+def find_databases(directory, year, projects=None):
+    """Usage databases in directory for year, as a dict of path by project"""
+    suffix = '_{}.db'.format(year)
+    dbfiles = {}
+    for dbfile in glob.glob(os.path.join(glob.escape(directory), 'usage_*' + suffix)):
+        project = os.path.basename(dbfile)[len('usage_'):-len(suffix)]
+        if projects is None or project in projects:
+            dbfiles[project] = dbfile
+    return dbfiles
+
+def database_storage(dbfile, year, quarter, storagepoint, measure):
+    """
+    Return the scan date and a list of (fullname, username, total) for the
+    latest scan of storagepoint in dbfile. Opens its own connection so can be
+    called from any thread
+    """
+    conn = UsageQuery.connect(dbfile)
+    try:
+        return UsageSummary.latest(conn, dbfile, year, quarter, storagepoint, measure)[:2]
+    finally:
+        conn.close()
+
+def push(heap, entry, count):
+    """Add entry to heap, keeping only the largest count entries"""
+    if len(heap) < count:
+        heapq.heappush(heap, entry)
+    elif entry > heap[0]:
+        heapq.heapreplace(heap, entry)
+
+def leaderboard(dbfiles, year, quarter, storagepoint='short', measure='size', count=10, threads=8, byuser=False):
+    """
+    Top count entries of storagepoint usage over the databases of dbfiles, a
+    dict of path by project, as a list of (value, username, fullname,
+    projects, scandate), largest first. Entries are the usage of a user in
+    one project, or if byuser the total of a user over all projects, with
+    projects a comma separated list
+    """
+    heap = []
+    # value, fullname, projects and latest scandate of each user
+    users = {}
+
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+        futures = dict((pool.submit(database_storage, dbfile, year, quarter, storagepoint, measure), project)
+                       for project, dbfile in dbfiles.items())
+        for future in as_completed(futures):
+            project = futures[future]
+            try:
+                scandate, usage = future.result()
+            except (IOError, sqlite3.Error) as e:
+                print("Could not read usage of project {}: {}".format(project, e), file=sys.stderr)
+                continue
+            if scandate is None:
+                continue
+            for fullname, username, value in usage:
+                if byuser:
+                    total = users.setdefault(username, [0., fullname, set(), scandate])
+                    total[0] += value
+                    total[2].add(project)
+                    total[3] = max(total[3], scandate)
+                else:
+                    push(heap, (value, username, fullname, project, scandate), count)
+
+    for username, (value, fullname, projects, scandate) in users.items():
+        push(heap, (value, username, fullname, ','.join(sorted(projects)), scandate), count)
+
+    return sorted(heap, key=lambda entry: (-entry[0], entry[1], entry[3]))
+
+def records(storagepoint, entries, measure):
+    return [dict(rank=rank, storagepoint=storagepoint, measure=measure, username=username, fullname=fullname,
+                 projects=projects, scandate=scandate, value=value)
+            for rank, (value, username, fullname, projects, scandate) in enumerate(entries, 1)]
+
+def print_table(storagepoint, entries, measure):
+    if measure == 'inodes':
+        name = "{} inodes".format(storagepoint)
+        values = ['%i' % value for value, _, _, _, _ in entries]
+    else:
+        name = "{} (GB)".format(storagepoint)
+        values = ['%.0f' % (value / 1024.**3) for value, _, _, _, _ in entries]
+    rows = [('Rank', 'Name', 'Projects', name)]
+    rows += [(str(rank), '{} ({})'.format(fullname, username), projects, value)
+             for rank, ((_, username, fullname, projects, _), value) in enumerate(zip(entries, values), 1)]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print('  '.join([row[0].rjust(widths[0]), row[1].ljust(widths[1]), row[2].ljust(widths[2]), row[3].rjust(widths[3])]))
+
+def main(args):
+
+    if args.period is not None:
+        year, quarter = args.period.split(".")
+    else:
+        year, quarter = datetoyearquarter(datetime.datetime.now())
+
+    projects = None
+    if args.project is not None:
+        projects = expand_projects(args.project)
+
+    dbfiles = find_databases(args.directory, year, projects)
+    if len(dbfiles) == 0:
+        print("No usage databases for {} in {}".format(year, args.directory), file=sys.stderr)
+        return
+
+    storagepoints = []
+    if args.gdata:
+        storagepoints.append('gdata')
+    if args.short:
+        storagepoints.append('short')
+    if not (args.gdata or args.short):
+        storagepoints = ['short', 'gdata']
+
+    allrecords = []
+    for storagepoint in storagepoints:
+        entries = leaderboard(dbfiles, year, quarter, storagepoint, args.measure, args.count, args.threads, args.byuser)
+        if len(entries) == 0:
+            print("No data available for {}".format(storagepoint), file=sys.stderr)
+            continue
+        if args.format == 'table':
+            print_table(storagepoint, entries, args.measure)
+        else:
+            allrecords.extend(records(storagepoint, entries, args.measure))
+
+    if args.format == 'json':
+        json.dump(dict(year=str(year), quarter=quarter, databases=len(dbfiles), records=allrecords), sys.stdout, indent=1)
+        print()
+    elif args.format in ('csv', 'tsv'):
+        fields = ['rank', 'storagepoint', 'scandate', 'measure', 'username', 'fullname', 'projects', 'value']
+        writer = csv.DictWriter(sys.stdout, fields, delimiter=',' if args.format == 'csv' else '\t', lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(allrecords)
+
+def parse_args(args):
+    """
+    Parse arguments given as list (args)
+    """
+    parser = argparse.ArgumentParser(description="Report the users with the most storage over all projects")
+    parser.add_argument("-d","--directory", help="Directory of usage databases", default=dbfileprefix)
+    parser.add_argument("-P","--project", nargs='+',
+                        help="Only these project(s) or group aliases ({}), default all".format(', '.join(sorted(project_groups))))
+    parser.add_argument("-p","--period", help="Quarter to report, e.g. 2019.q1, default current quarter")
+    parser.add_argument("--count", help="Number of users to report", default=10, type=int)
+    parser.add_argument("--short", help="Report /short", action='store_true')
+    parser.add_argument("--gdata", help="Report gdata", action='store_true')
+    parser.add_argument("--measure", choices=['size','inodes'], default='size')
+    parser.add_argument("--byuser", help="Total each user over all their projects", action='store_true')
+    parser.add_argument("--threads", help="Number of databases to read concurrently", default=8, type=int)
+    parser.add_argument("--format", choices=['table', 'json', 'csv', 'tsv'], default='table',
+                        help="Output format. Values are in bytes or inodes for json, csv and tsv")
+
+    return parser.parse_args(args)
+
+def main_parse_args(args):
+    """
+    Call main with list of arguments. Callable from tests
+    """
+    # Must return so that check command return value is passed back to calling routine
+    # otherwise py.test will fail
+    return main(parse_args(args))
+
+def main_argv():
+    """
+    Call main and pass command line arguments. This is required for setup.py entry_points
+    """
+    main_parse_args(sys.argv[1:])
+
+if __name__ == "__main__":
+
+    main_argv()
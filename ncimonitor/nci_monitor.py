@@ -43,6 +43,7 @@ from getpass import getuser
 # from make_usage_db import *
 from ncimonitor.UsageDataset import *
 from ncimonitor.DBcommon import *
+from ncimonitor.Registry import registry
 
 plt.style.use('ggplot')
 
@@ -265,6 +266,7 @@ def main():
     parser.add_argument("--username", help="Show username rather than full name in plot legend", action='store_true')
     parser.add_argument("-n","--num", help="Show only top num users where appropriate", type=int, default=None)
     parser.add_argument("-c","--cutoff", help="Show only users whose storage exceeds cutoff", type=float, default=None)
+    add_tuning_argument(parser, 'read-only')
     group = parser.add_mutually_exclusive_group()
     group.add_argument("--showtotal", help="Show the file usage limit", action='store_true')
     group.add_argument("-d","--delta", help="Show change in file system usage since beginning of time period", action='store_true')
@@ -310,7 +312,7 @@ def main():
 
         dbfile = 'sqlite:///'+os.path.join(dbfileprefix,"usage_{}_{}.db".format(project,year))
         try:
-            db = ProjectDataset(project,dbfile)
+            db = registry.acquire(dbfile, ProjectDataset, project, dbfile, profile=args.tuning)
         except:
             print("ERROR! You are not a member of this group: ",project)
             continue
@@ -346,5 +348,9 @@ def main():
     
             if not args.noshow: plt.show()
 
+            registry.release(db)
+
+    registry.closeall()
+
 if __name__ == "__main__":
     main()
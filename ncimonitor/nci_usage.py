@@ -20,21 +20,138 @@ from __future__ import print_function
 
 import datetime
 import argparse
+import csv
+import json
 import os
-from .UsageDataset import ProjectDataset
-from .DBcommon import datetoyearquarter
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from . import UsageQuery, UsageSummary
+from .DBcommon import datetoyearquarter, expand_projects, project_groups
 
 bytes_to_gbytes = 1024**3
 
+dbfileprefix = '/short/public/aph502/.data/'
+
+def storage_system(storagepoint):
+    return UsageQuery.storage_systems.get(storagepoint, 'raijin')
+
+def project_storage(project, year, quarter, storagepoint, measure):
+    """
+    Return the scan date and usage of each user in project from the most recent
+    scan of storagepoint in this quarter, and the project grant and inode grant.
+    Read from the summary written by the ingest if it is up to date, otherwise
+    from the database. Opens its own connection so can be called from any thread
+    """
+    dbfile = os.path.join(dbfileprefix, 'usage_{}_{}.db'.format(project, year))
+    try:
+        conn = UsageQuery.connect(dbfile)
+    except IOError:
+        print("No usage database for project {} in {}".format(project, year), file=sys.stderr)
+        return None, [], None, None
+
+    try:
+        return UsageSummary.latest(conn, dbfile, year, quarter, storagepoint, measure)
+    finally:
+        conn.close()
+
+def default_projects(year):
+    """
+    Projects to report when none are given: $PROJECT if it is set, otherwise
+    every project with a usage database for year
+    """
+    if os.environ.get('PROJECT'):
+        return [os.environ['PROJECT']]
+    # Imported here as nci_leaderboard uses dbfileprefix from this module
+    from .nci_leaderboard import find_databases
+    return sorted(find_databases(dbfileprefix, year))
+
+def combine_storage(results, measure):
+    """
+    Sum usage over projects for each user (users can be members of more than
+    one project) and the grants for the relevant measure. Returns the most
+    recent scan date, a list of (name, username, total) largest first and
+    the total grant
+    """
+    totals = {}; names = {}; grant = 0.; scandates = []
+    for scandate, usage, pgrant, pigrant in results:
+        if scandate is None:
+            continue
+        scandates.append(scandate)
+        for fullname, username, value in usage:
+            totals[username] = totals.get(username, 0.) + value
+            names[username] = fullname
+        if pgrant is not None:
+            grant += pgrant if measure == 'size' else pigrant
+    if len(scandates) == 0:
+        return None, [], grant
+    usage = sorted(((names[u], u, v) for u, v in totals.items()), key=lambda r: (-r[2], r[1]))
+    return max(scandates), usage, grant
+
+def print_table(storagepoint, usage, grant, args):
+    """
+    Print the top users and total as a table, laid out as pandas would print
+    it, without the time it takes to import pandas
+    """
+    if args.measure == 'inodes':
+        name = "{} inodes ".format(storagepoint)
+        scale = 1
+        format_ = '%i'.__mod__
+    else:
+        if args.percent:
+            name = "{}".format(storagepoint)
+        else:
+            name = "{} (GB)".format(storagepoint)
+        scale = 1024 ** 3 # 1 GB
+        format_ = '%.0f'.__mod__
+
+    if args.percent:
+        format_ = "{0:.0f} %".format
+        scale = grant / 100.
+        if scale == 0:
+            print("No grant available for {}".format(storagepoint))
+            return
+
+    rows = [('{} ({})'.format(f, u), value) for f, u, value in usage[:args.count]]
+    rows.append(('TOTAL', sum(value for _, _, value in usage)))
+    rows = [(label, format_(value / scale)) for label, value in rows]
+
+    width = max(len(label) for label, _ in rows + [('Name', '')])
+    valuewidth = max(len(value) for _, value in rows + [('', name)])
+    print(' ' * width + '  ' + name.rjust(valuewidth))
+    print('Name'.ljust(width) + '  ' + ' ' * valuewidth)
+    for label, value in rows:
+        print(label.ljust(width) + '  ' + value.rjust(valuewidth))
+
+def report_records(storagepoint, scandate, usage, grant, args):
+    """
+    Top users and total for a storage point as a list of dicts, with the
+    value in bytes or inodes, and as a percentage of grant if requested
+    """
+    records = []
+    total = sum(value for _, _, value in usage)
+    rows = list(usage[:args.count]) + [(None, 'TOTAL', total)]
+    for fullname, username, value in rows:
+        record = dict(storagepoint=storagepoint, scandate=scandate, measure=args.measure,
+                      username=username, fullname=fullname, value=value)
+        if args.percent:
+            record['percent'] = 100. * value / grant if grant else None
+        records.append(record)
+    return records
+
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--project', '-P', default=os.environ['PROJECT'])
+    parser.add_argument('--project', '-P', default=None, nargs='+',
+                        help='Project(s) or group aliases ({}) to report. Defaults to $PROJECT, or every '
+                             'project with a usage database if it is not set'.format(', '.join(sorted(project_groups))))
     parser.add_argument('--period', '-p', type=str)
     parser.add_argument('--count', default=10, type=int)
     parser.add_argument('--percent', default=False, action='store_true')
     parser.add_argument('--short', action='store_true')
     parser.add_argument('--gdata', action='store_true')
     parser.add_argument('--measure', choices=['size','inodes'], default='size')
+    parser.add_argument('--threads', default=8, type=int, help='Number of databases to read concurrently')
+    parser.add_argument('--format', choices=['table', 'json', 'csv', 'tsv'], default='table',
+                        help='Output format. Values are in bytes or inodes for json, csv and tsv')
 
     args = parser.parse_args()
 
@@ -43,8 +160,12 @@ def main():
     else:
         year, quarter = datetoyearquarter(datetime.datetime.now())
 
-    path = 'sqlite:////short/public/aph502/.data/usage_%s_%s.db'%(args.project, year)
-    db = ProjectDataset(args.project, path)
+    if args.project is not None:
+        projects = expand_projects(args.project)
+    else:
+        projects = default_projects(year)
+    if not projects:
+        parser.error('No project given with -P or $PROJECT, and no usage databases for {} in {}'.format(year, dbfileprefix))
 
     storagepoints = []
     if args.gdata:
@@ -54,41 +175,37 @@ def main():
     if not (args.gdata or args.short):
         storagepoints = ['short', 'gdata']
 
-    for storagepoint in storagepoints:
-
-        if args.measure == 'inodes':
-            name = "{} inodes ".format(storagepoint)
-            scale = 1
-            format_ = '%i'
-        else:
-            if args.percent:
-                name = "{}".format(storagepoint)
-            else:
-                name = "{} (GB)".format(storagepoint)
-            scale = 1024 ** 3 # 1 GB
-            format_ = '%.0f'
-
-        if args.percent:
-            system = 'raijin'
-            if storagepoint == 'gdata':
-                system = 'global'
+    # Read every project and storage point at once, so total time is that of
+    # the slowest database rather than the sum over all of them
+    with ThreadPoolExecutor(max_workers=max(1, args.threads)) as pool:
+        results = { (project, storagepoint) : pool.submit(project_storage, project, year, quarter, storagepoint, args.measure)
+                    for storagepoint in storagepoints for project in projects }
 
-            format_ = "{0:.0f} %".format
-            grant, igrant = db.getsystemstorage(system, storagepoint, year, quarter)
+    records = []
+    for storagepoint in storagepoints:
 
-            if args.measure == 'size':
-                scale = grant / 100.
-            elif args.measure == 'inodes':
-                scale = igrant / 100.
+        scandate, usage, grant = combine_storage([results[(project, storagepoint)].result() for project in projects],
+                                                 args.measure)
 
-        df = db.getstorage(year, quarter, storagept=storagepoint, datafield=args.measure)
-        usertotal = df.ix[-1]
-        total = sum(usertotal)
+        if scandate is None:
+            print("No data available for {}".format(storagepoint), file=sys.stderr)
+            continue
 
-        report = usertotal.sort_values(ascending=False).head(args.count)
-        report.at['TOTAL'] = total
+        if args.format == 'table':
+            print_table(storagepoint, usage, grant, args)
+        else:
+            records.extend(report_records(storagepoint, scandate, usage, grant, args))
 
-        print(report.divide(scale).to_frame(name).to_string(float_format=format_))
+    if args.format == 'json':
+        json.dump(dict(projects=projects, year=str(year), quarter=quarter, records=records), sys.stdout, indent=1)
+        print()
+    elif args.format in ('csv', 'tsv'):
+        fields = ['storagepoint', 'scandate', 'measure', 'username', 'fullname', 'value']
+        if args.percent:
+            fields.append('percent')
+        writer = csv.DictWriter(sys.stdout, fields, delimiter=',' if args.format == 'csv' else '\t', lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(records)
 
 if __name__ == '__main__':
     main()
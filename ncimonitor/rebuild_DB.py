@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+
+"""
+Copyright 2019 ARC Centre of Excellence for Climate Extremes
+
+author: Aidan Heerdegen <aidan.heerdegen@anu.edu.au>
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Rebuild the usage_{project}_{year}.db and jobs databases from scratch from an
+archive of dump files, e.g.
+
+    rebuild_DB -d /short/public/aph502/.data/archive --dbdir /short/public/aph502/.data
+
+The type, project and date of each dump are read from its contents, and the
+dumps for each project are parsed in date order into new databases using bulk
+mode, with a worker process per project. Once all databases have been built
+they replace the existing databases. Ingest should not be running at the same
+time, databases which are open for writing are not replaced.
+"""
+
+from __future__ import print_function
+
+import argparse
+import contextlib
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+
+# Local imports
+from . import make_SU_DB, make_short_DB, make_gdata_DB, make_jobs_DB
+from . import UsageSummary
+from .DBcommon import sniff, add_tuning_argument
+
+usage_parsers = { 'SU' : (make_SU_DB, 'parse_SU_file'),
+                  'short' : (make_short_DB, 'parse_short_file'),
+                  'gdata' : (make_gdata_DB, 'parse_gdata_file') }
+
+def scan(directory):
+    """
+    Find dumps in directory and its subdirectories. Returns a list of qstat
+    json dumps in the order they were archived, and a dict of (dumptype,
+    filepath) for each project in date order
+    """
+    jobs = []; usage = {}
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for filename in filenames:
+            filepath = os.path.join(dirpath, filename)
+            dump = sniff(filepath)
+            if dump is None:
+                continue
+            dumptype, project, date = dump
+            if dumptype == 'jobs':
+                # No date in qstat dumps, but archive time follows dump time
+                jobs.append((os.path.getmtime(filepath), filepath))
+            else:
+                usage.setdefault(project, []).append((date, dumptype, filepath))
+    jobs = [filepath for mtime, filepath in sorted(jobs)]
+    for project in usage:
+        usage[project] = [(dumptype, filepath) for date, dumptype, filepath in sorted(usage[project])]
+    return jobs, usage
+
+@contextlib.contextmanager
+def quiet(verbose):
+    """The parsers are chatty"""
+    if verbose:
+        yield
+    else:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            yield
+
+def build_project(project, dumps, builddir, tuning='bulk-load', verbose=False, delta=False):
+    """
+    Parse dumps for project into new databases in builddir. Run in a worker
+    process. Returns the names of the databases
+    """
+    for module, parser in usage_parsers.values():
+        module.databases.clear()
+        module.dbfileprefix = builddir
+        # The parsers share each usage database through the registry, so
+        # all open it with the same arguments
+        module.dbargs = dict(bulk=True, profile=tuning, delta=delta, summary=True)
+
+    with quiet(verbose):
+        for dumptype, filepath in dumps:
+            module, parser = usage_parsers[dumptype]
+            getattr(module, parser)(filepath)
+
+    dbfiles = set()
+    for module, parser in usage_parsers.values():
+        for db in module.databases.values():
+            dbfiles.add(os.path.basename(db.dbfile))
+        module.databases.close()
+
+    print("{}: {} dumps, built {}".format(project, len(dumps), ' '.join(sorted(dbfiles))))
+    return sorted(dbfiles)
+
+def build_jobs(dumps, builddir, dbname, tuning='bulk-load', verbose=False):
+    """
+    Parse qstat json dumps into a new jobs database in builddir. Run in a
+    worker process. Returns the name of the database
+    """
+    make_jobs_DB.databases.clear()
+    make_jobs_DB.dbargs = dict(bulk=True, profile=tuning)
+
+    dbfile = os.path.join(builddir, dbname)
+    with quiet(verbose):
+        for filepath in dumps:
+            make_jobs_DB.parse_qstat_json_dump(filepath, dbfile, verbose)
+
+    make_jobs_DB.databases.close()
+
+    print("jobs: {} dumps, built {}".format(len(dumps), dbname))
+    return [dbname]
+
+def swap(builddir, dbdir, dbnames):
+    """
+    Replace databases in dbdir with the newly built databases. Databases with a
+    write ahead log are in use and are not replaced. Returns the names of any
+    databases not replaced
+    """
+    skipped = []
+    for dbname in dbnames:
+        dbfile = os.path.join(dbdir, dbname)
+        if os.path.exists(dbfile + '-wal'):
+            print("{} is in use, not replaced".format(dbfile))
+            skipped.append(dbname)
+            continue
+        os.replace(os.path.join(builddir, dbname), dbfile)
+        # Summaries of the old database are stale
+        for summary in UsageSummary.summary_files(dbfile):
+            os.remove(summary)
+        for summary in UsageSummary.summary_files(os.path.join(builddir, dbname)):
+            os.replace(summary, os.path.join(dbdir, os.path.basename(summary)))
+    return skipped
+
+def main(args):
+
+    jobs, usage = scan(args.directory)
+
+    if args.projects is not None:
+        usage = dict((project, dumps) for project, dumps in usage.items() if project in args.projects)
+    if args.nojobs:
+        jobs = []
+
+    print("Found {} qstat dumps and {} usage dumps for {} projects".format(
+              len(jobs), sum(len(dumps) for dumps in usage.values()), len(usage)))
+
+    if args.dryrun:
+        for project in sorted(usage):
+            for dumptype, filepath in usage[project]:
+                print(project, dumptype, filepath)
+        for filepath in jobs:
+            print('jobs', filepath)
+        return
+
+    # Build in the same directory, so the new databases can be moved into place
+    # atomically
+    builddir = tempfile.mkdtemp(prefix='.rebuild_', dir=args.dbdir)
+
+    try:
+        pool = multiprocessing.Pool(args.processes, maxtasksperchild=1)
+        try:
+            results = []
+            if len(jobs) > 0:
+                results.append(pool.apply_async(build_jobs, (jobs, builddir, args.database, args.tuning, args.verbose)))
+            for project in sorted(usage):
+                results.append(pool.apply_async(build_project, (project, usage[project], builddir, args.tuning, args.verbose, args.delta)))
+            # Re-raises any exception from the workers
+            dbnames = [dbname for result in results for dbname in result.get()]
+        finally:
+            pool.close()
+            pool.join()
+    except:
+        shutil.rmtree(builddir)
+        raise
+
+    skipped = swap(builddir, args.dbdir, dbnames)
+
+    if len(skipped) > 0:
+        print("Rebuilt databases which were not replaced are in {}".format(builddir))
+    else:
+        shutil.rmtree(builddir)
+
+def parse_args(args):
+    """
+    Parse arguments given as list (args)
+    """
+    parser = argparse.ArgumentParser(description="Rebuild usage and jobs databases from archived dump files")
+    parser.add_argument("-d","--directory", help="Directory of archived dump files", default="archive")
+    parser.add_argument("--dbdir", help="Directory containing the databases to replace", default=".")
+    parser.add_argument("-db","--database", help="Name of jobs database", default="jobs.db")
+    parser.add_argument("-p","--projects", help="Only rebuild databases for these projects", nargs='+')
+    parser.add_argument("--nojobs", help="Do not rebuild the jobs database", action='store_true')
+    parser.add_argument("-n","--processes", help="Number of worker processes (default: number of CPUs)", type=int)
+    add_tuning_argument(parser, 'bulk-load')
+    parser.add_argument("--delta", help="Only store folders which changed since the previous scan", action='store_true')
+    parser.add_argument("--dryrun", help="List the dumps which would be read, in order", action='store_true')
+    parser.add_argument("-v","--verbose", help="Verbose output", action='store_true')
+
+    return parser.parse_args(args)
+
+def main_parse_args(args):
+    """
+    Call main with list of arguments. Callable from tests
+    """
+    # Must return so that check command return value is passed back to calling routine
+    # otherwise py.test will fail
+    return main(parse_args(args))
+
+def main_argv():
+    """
+    Call main and pass command line arguments. This is required for setup.py entry_points
+    """
+    main_parse_args(sys.argv[1:])
+
+if __name__ == "__main__":
+
+    main_argv()
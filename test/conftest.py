@@ -0,0 +1,17 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import pytest
+
+from ncimonitor import UserDirectory
+
+@pytest.fixture(scope='session')
+def usercache(tmp_path_factory):
+    return str(tmp_path_factory.mktemp('usercache').joinpath('users.json'))
+
+@pytest.fixture(autouse=True)
+def isolate_usercache(usercache, monkeypatch):
+    """Keep the user cache of the tests out of ~/.cache"""
+    monkeypatch.setenv('NCIMONITOR_USERCACHE', usercache)
+    monkeypatch.setattr(UserDirectory.users, 'path', usercache)
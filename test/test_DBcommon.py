@@ -9,6 +9,7 @@ from numpy.testing import assert_array_equal, assert_array_almost_equal
 from numpy import arange
 
 import os
+import sqlite3
 
 from ncimonitor.DBcommon import *
 
@@ -40,3 +41,84 @@ def test_parse_numbers_with_units():
     assert(parse_size('10B')==10)
     assert(parse_size('10SU',u='SU')==10)
     assert(parse_size('10.0 SU',u='SU')==10)
+
+    with pytest.raises(ValueError):
+        parse_size('MB')
+
+def test_yearquartertodates():
+
+    assert(yearquartertodates(2019, 'q1') == (datetime.date(2019,1,1), datetime.date(2019,3,31)))
+    assert(yearquartertodates('2020', 'q1') == (datetime.date(2020,1,1), datetime.date(2020,3,31)))
+    assert(yearquartertodates(2019, 'q4') == (datetime.date(2019,10,1), datetime.date(2019,12,31)))
+    for month in range(1,13):
+        date = datetime.date(2019, month, 15)
+        start, end = yearquartertodates(*datetoyearquarter(date))
+        assert(start <= date <= end)
+
+def test_expand_projects():
+
+    assert(expand_projects(['xx00']) == ['xx00'])
+    assert(expand_projects(['clex']) == project_groups['clex'])
+    # Projects in more than one group, or also given by name, appear once
+    assert(expand_projects(['xx00', 'clex', 'w35', 'mom']) ==
+           ['xx00', 'w35', 'w40', 'w42', 'w48', 'w97', 'v45', 'e14', 'x77', 'g40'])
+
+def test_archive(tmpdir):
+
+    dump = tmpdir.join('short_2019-01-01.dump')
+    dump.write('line one\nline two\n')
+
+    archive(str(dump), codec='gzip', level=1)
+
+    archived = tmpdir.join('archive', 'short_2019-01-01.dump.gz')
+    assert(not dump.check())
+    assert(archived.check())
+
+    # Archives can be read directly
+    with open_dump(str(archived)) as f:
+        assert(f.readlines() == ['line one\n', 'line two\n'])
+
+    # and are not archived again when they are re-ingested
+    archive(str(archived))
+    assert(archived.check())
+
+def test_sqlite_pragmas():
+
+    assert(sqlite_pragmas(None) == [])
+    assert(sqlite_pragmas('none') == [])
+    assert(sqlite_pragmas('online-write')[0] == 'PRAGMA journal_mode=WAL')
+    with pytest.raises(ValueError):
+        sqlite_pragmas('fast')
+
+# Values each profile's PRAGMAs read back as from SQLite
+profile_settings = {
+    'bulk-load' : dict(journal_mode='memory', synchronous=0, cache_size=-262144, temp_store=2),
+    'online-write' : dict(journal_mode='wal', synchronous=1, cache_size=-65536, temp_store=2, busy_timeout=10000),
+    'read-only' : dict(query_only=1, cache_size=-65536, temp_store=2, busy_timeout=10000),
+    }
+
+@pytest.mark.parametrize("profile", list(sqlite_profiles))
+def test_sqlite_profiles(tmpdir, profile):
+    from ncimonitor import DatasetBase, UsageQuery
+
+    dbfile = str(tmpdir.join('test.db'))
+    db = DatasetBase.connect('sqlite:///'+dbfile)
+    db['Test'].insert(dict(value=1))
+    db.close()
+
+    if profile == 'read-only':
+        conn = UsageQuery.connect(dbfile, profile)
+        settings = dict((name, conn.execute('PRAGMA {}'.format(name)).fetchone()[0]) for name in profile_settings[profile])
+        with pytest.raises(sqlite3.OperationalError):
+            conn.execute('INSERT INTO Test (value) VALUES (2)')
+        conn.close()
+    else:
+        db = DatasetBase.connect('sqlite:///'+dbfile, profile)
+        with db as tx:
+            tx['Test'].insert(dict(value=2))
+        with db.engine.connect() as conn:
+            settings = dict((name, conn.exec_driver_sql('PRAGMA {}'.format(name)).scalar()) for name in profile_settings[profile])
+        assert(len(db['Test']) == 2)
+        db.close()
+
+    assert(settings == profile_settings[profile])
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import pytest
+import datetime
+import json
+import numpy as np
+import pandas as pd
+
+from numpy.testing import assert_array_equal, assert_array_almost_equal
+
+from ncimonitor.Forecast import burnrate, forecast, rank
+from ncimonitor.UsageDataset import ProjectDataset
+from ncimonitor import nci_forecast
+
+def test_forecast():
+    startdate = datetime.date(1984, 7, 1)
+    enddate = datetime.date(1984, 9, 30)
+    dates = pd.date_range(startdate, periods=30)
+    days = np.arange(30.)
+
+    usage = pd.DataFrame({ 'steady' : 15. * (days + 1),
+                           'idle' : np.zeros(30),
+                           # Recently started using 100 a day
+                           'spike' : np.where(days < 20, 0., 100. * (days - 19)),
+                           # Only reported on the first three days
+                           'early' : np.where(days < 3, 5. * (days + 1), np.nan),
+                           # Already over grant
+                           'over' : 50. * (days + 1) },
+                         index=dates, columns=['steady', 'idle', 'spike', 'early', 'over'])
+
+    last, lastday, rate = burnrate(usage, startdate, window=7)
+    assert_array_almost_equal(rate, [15., 0., 100., 5., 50.])
+    assert_array_equal(lastday, [29, 29, 29, 2, 29])
+
+    grant = [1000., 1000., 1000., float('nan'), 1000.]
+    f = forecast(usage, grant, startdate, enddate, window=7)
+    assert_array_almost_equal(f.projected, [450. + 15. * 62, 0., 1000. + 100. * 62, 15. + 5. * 89, 1500. + 50. * 62])
+    assert( f.loc['steady', 'exhaustion'] == pd.Timestamp(1984, 9, 5) )
+    assert( f.loc['spike', 'exhaustion'] == pd.Timestamp(1984, 7, 30) )
+    assert( f.loc['over', 'exhaustion'] == pd.Timestamp(1984, 7, 20) )
+    assert( pd.isnull(f.loc['idle', 'exhaustion']) and pd.isnull(f.loc['early', 'exhaustion']) )
+    assert( f.loc['early', 'date'] == pd.Timestamp(1984, 7, 3) )
+
+    assert( list(rank(f).index) == ['spike', 'over', 'steady', 'idle', 'early'] )
+
+def test_main(tmpdir, monkeypatch, capsys):
+    for p, project in enumerate(('xx00', 'yy00')):
+        db = ProjectDataset(project, 'sqlite:///'+str(tmpdir.join('usage_{}_1984.db'.format(project))))
+        db.addquarter(1984, 'q3', datetime.date(1984, 7, 1), datetime.date(1984, 9, 30))
+        db.addgrant(1984, 'q3', 1000.)
+        db.addsystemqueue('raijin', 'normal', 1.)
+        for day in range(1, 11):
+            db.addprojectusage(datetime.date(1984, 7, day), 'raijin', 'normal', 0., 0., 10.*(p+1)*day)
+        db.commit()
+        db.close()
+    monkeypatch.setattr(nci_forecast, 'dbfileprefix', str(tmpdir))
+
+    # All the projects with a database unless some are given
+    nci_forecast.main_parse_args(['-p', '1984.q3', '--format', 'json'])
+    records = json.loads(capsys.readouterr().out)['records']
+    assert( [record['project'] for record in records] == ['yy00', 'xx00'] )
+
+    nci_forecast.main_parse_args(['-p', '1984.q3', '--format', 'json', '-P', 'xx00'])
+    records = json.loads(capsys.readouterr().out)['records']
+    assert( [record['project'] for record in records] == ['xx00'] )
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import pytest
+import json
+import time
+
+from ncimonitor.IngestStats import IngestStats
+
+def test_timers(tmpdir):
+    stats = IngestStats()
+
+    # Nothing is recorded unless enabled
+    with stats.timer('parse'):
+        stats.count('rows')
+    assert(len(stats.timers) == 0 and len(stats.counters) == 0)
+
+    stats.enabled = True
+    for i in range(3):
+        with stats.timer('parse'):
+            time.sleep(0.01)
+            with stats.timer('upsert'):
+                time.sleep(0.02)
+            stats.count('rows', 10)
+
+    assert(stats.counters['rows'] == 30)
+    assert(stats.timers['parse'][0] == 3)
+    assert(stats.timers['upsert'][0] == 3)
+    # Time in nested phases is not counted against the enclosing phase
+    assert(0.03 <= stats.timers['parse'][1] < 0.06)
+    assert(stats.timers['upsert'][1] >= 0.06)
+
+    metrics = str(tmpdir.join('metrics.json'))
+    stats.write_json(metrics)
+    with open(metrics) as f:
+        data = json.load(f)
+    assert(data['counters']['rows'] == 30)
+    assert(data['phases']['upsert']['calls'] == 3)
+    assert('upsert' in stats.summary())
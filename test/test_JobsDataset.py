@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import pytest
+import sys
+import pandas as pd
+
+from numpy.testing import assert_array_equal, assert_array_almost_equal
+
+import os
+
+from ncimonitor.JobsDataset import *
+
+import datetime
+
+@pytest.fixture(scope='session')
+def db():
+    dbfile = "sqlite:///:memory:"
+    return JobsDataset(dbfile)
+
+def test_addjob(db):
+    ctime = datetime.datetime(1984, 7, 1, 9, 0, 0)
+    jobid = 1000
+    for project in ('xx00', 'yy00'):
+        for username in ('wxs1984', 'bxb1984'):
+            for queue in ('normal', 'express'):
+                for ncpus in (1, 2, 16, 48, 256, 2048):
+                    for status in ('F', 'R'):
+                        jobid += 1
+                        waitime = float(jobid % 97)
+                        walltime = float(jobid % 13)
+                        db.addjob(ctime.year, queue, str(jobid), project, username,
+                                  status, 'job{}'.format(jobid), 0, '/bin/true', '',
+                                  ctime, 10., 1., 2., waitime,
+                                  3600., 1024, ncpus,
+                                  walltime, 512, walltime*ncpus, 1., 0)
+                        ctime += datetime.timedelta(hours=13)
+
+    assert(db.getnumrecords() == jobid - 1000)
+
+    # Re-adding a job updates rather than duplicates it
+    db.addjob(1984, 'normal', '1001', 'xx00', 'wxs1984',
+              'F', 'job1001', 0, '/bin/true', '',
+              datetime.datetime(1984, 7, 1, 9, 0, 0), 10., 1., 2., 1001. % 97,
+              3600., 1024, 1,
+              1001. % 13, 512, (1001. % 13), 1., 0)
+    assert(db.getnumrecords() == jobid - 1000)
+
+@pytest.mark.parametrize('aggfunc', ['mean', 'median', 'count', 'sum'])
+def test_aggregate(db, aggfunc):
+    jobs = db.getjobs()
+
+    for groupvar, splitvar in (('queue', 'ncpusbin'), ('project', 'username'), ('ncpusbin', 'queue')):
+        expected = pd.pivot_table(jobs, values='waittime', index=groupvar, columns=splitvar,
+                                  aggfunc=aggfunc, observed=True)
+        df = db.aggregate('waittime', groupvar, splitvar, aggfunc=aggfunc)
+        assert_array_equal(df.index.astype(str), expected.index.astype(str))
+        assert_array_equal(df.columns.astype(str), expected.columns.astype(str))
+        assert_array_almost_equal(df.values, expected.values)
+
+def test_aggregate_filters(db):
+    jobs = db.getjobs(status=None)
+    startdate = datetime.date(1984, 7, 10); enddate = datetime.date(1984, 7, 31)
+    jobs = jobs.loc[(pd.to_datetime(jobs.ctime) >= pd.Timestamp(startdate)) &
+                    (pd.to_datetime(jobs.ctime) < pd.Timestamp(enddate + datetime.timedelta(days=1))) &
+                    jobs.project.isin(['yy00']) & jobs.username.isin(['bxb1984'])]
+
+    expected = pd.pivot_table(jobs, values='walltime', index='status', columns='ncpusbin',
+                              aggfunc='sum', observed=True)
+    df = db.aggregate('walltime', 'status', 'ncpusbin', aggfunc='sum', status=None,
+                      startdate=startdate, enddate=enddate, projects=['yy00'], users=['bxb1984'])
+    assert_array_equal(df.index, expected.index)
+    assert_array_almost_equal(df.values, expected.values)
+
+    # Single grouping variable returns a series
+    counts = db.aggregate('waittime', 'queue', None, aggfunc='count')
+    assert(counts.sum() == len(db.getjobs()))
+
+    with pytest.raises(ValueError):
+        db.aggregate('jobname', 'queue', 'ncpusbin')
+    with pytest.raises(ValueError):
+        db.aggregate('waittime', 'queue', 'ncpusbin', aggfunc='max')
+
+def test_getquantiles(db):
+    db.flushsketches()
+    jobs = db.getjobs()
+
+    df = db.getquantiles('waittime', quantiles=(0.5, 0.9), by=('queue', 'ncpusbin'))
+    expected = jobs.groupby(['queue', 'ncpusbin'], observed=True).waittime
+    counts = expected.count()
+    for key, row in df.iterrows():
+        # Each finished job is only counted once, however many times it is added
+        assert(row['count'] == counts[key])
+        for q in (0.5, 0.9):
+            assert(abs(row[q] - expected.get_group(key).quantile(q, interpolation='lower')) <= 0.02 * row[q] + 1)
+
+    df = db.getquantiles('walltime', quantiles=(0.5,), by=('project',),
+                         startdate=datetime.date(1984, 7, 1), enddate=datetime.date(1984, 7, 15))
+    assert(df['count'].sum() == len(jobs.loc[pd.to_datetime(jobs.ctime) < pd.Timestamp(1984, 7, 16)]))
+
+    with pytest.raises(ValueError):
+        db.getquantiles('mem')
+
+def test_ddsketch():
+    from ncimonitor.QuantileSketch import DDSketch
+    a = DDSketch(); b = DDSketch()
+    for v in range(1000):
+        a.add(float(v))
+        b.add(float(v + 1000))
+    a.merge(DDSketch.from_json(b.to_json()))
+    assert(a.count == 2000)
+    for q in (0.01, 0.5, 0.9, 0.99):
+        assert(abs(a.quantile(q) - q * 1999) <= 0.01 * q * 1999 + 1)
+    assert(a.quantile(0.) == 0.)
+    assert(a.quantile(1.) == 1999.)
+
+def addjobs(db, years, status='F'):
+    for year in years:
+        for i in range(5):
+            ctime = datetime.datetime(year, 12, 30, 9, 0, 0) + datetime.timedelta(hours=13*i)
+            db.addjob(ctime.year, 'normal', '{}{}'.format(year, i), 'xx00', 'wxs1984',
+                      status, 'job', 0, '/bin/true', '',
+                      ctime, 10., 1., 2., 60.,
+                      3600., 1024, 16,
+                      100., 512, 1600., 1., 0)
+
+def test_partitions(tmpdir):
+    db = JobsDataset('sqlite:///'+str(tmpdir.join('jobs.db')))
+    addjobs(db, (1984, 1985))
+    assert(db.partitions() == [1984, 1985, 1986])
+    assert(db.getnumrecords() == 10)
+    assert(len(db.getjobs()) == 10)
+
+    # Only the years covering the dates are read
+    assert(db.jobsource('1985-01-01', '1985-12-31') == 'Jobs_1985 AS Jobs')
+    assert(db.jobsource('1987-01-01', '1987-12-31') is None)
+    assert(len(db.getjobs('1985-01-01', '1985-12-31 23:59:59')) == 5)
+    assert(db.getjobs('1987-01-01', '1987-12-31') is None)
+    counts = db.aggregate('waittime', 'queue', None, aggfunc='count',
+                          startdate=datetime.date(1985, 1, 1), enddate=datetime.date(1985, 12, 31))
+    assert(counts['normal'] == 5)
+
+def test_migrate(tmpdir):
+    db = JobsDataset('sqlite:///'+str(tmpdir.join('jobs.db')))
+    addjobs(db, (1984, 1985), status='R')
+    # Put the jobs in a single Jobs table, as older versions did
+    with db.db as tx:
+        for year in db.partitions():
+            tx['Jobs'].insert_many([dict((c, row[c]) for c in db.jobcolumns) for row in tx[db.jobstable(year)].all()])
+            tx[db.jobstable(year)].drop()
+    assert(db.partitions() == [] and db.haslegacy())
+    assert(db.getnumrecords() == 10)
+    assert(len(db.getjobs('1985-01-01', '1985-12-31 23:59:59', status=None)) == 5)
+
+    # Adding a job moves the jobs into yearly tables
+    db = JobsDataset('sqlite:///'+str(tmpdir.join('jobs.db')))
+    addjobs(db, (1985,))
+    assert(db.partitions() == [1984, 1985, 1986] and not db.haslegacy())
+    assert(db.getnumrecords() == 10)
+    assert(len(db.getjobs()) == 5)
+    assert(len(db.getjobs(status=None)) == 10)
+
+def test_jobindex(tmpdir):
+    db = JobsDataset('sqlite:///'+str(tmpdir.join('jobs.db')))
+    addjobs(db, (1984,), status='R')
+    addjobs(db, (1984,), status='F')
+
+    db.loadindex(['1984{}'.format(i) for i in range(5)] + ['1984999'])
+    assert(len(db.jobindex) == 5)
+    year, mtime = 1984, 10.
+    assert(db.unchanged(year, '19840', mtime, 'F'))
+    # Changed, not finished or not stored
+    assert(not db.unchanged(year, '19840', 20., 'F'))
+    assert(not db.unchanged(year, '19840', mtime, 'R'))
+    assert(not db.unchanged(year, '1984999', mtime, 'F'))
+
+    # Chunks of jobids
+    db.indexchunk = 2
+    db.loadindex(['1984{}'.format(i) for i in range(5)])
+    assert(len(db.jobindex) == 5)
+
+def test_getdaily(db):
+    db.flushrollups()
+    jobs = db.getjobs()
+    jobs = jobs.assign(day=jobs.ctime.str[:10])
+
+    df = db.getdaily(by=('day', 'queue'))
+    variables = ['waittime', 'walltime', 'cputime', 'mem']
+    expected = jobs.groupby(['day', 'queue'])[variables].agg(['count', 'mean', 'std', 'sum'])
+    assert_array_equal(df.jobs, expected['waittime']['count'])
+    for variable in variables:
+        for stat in ('mean', 'std', 'sum'):
+            assert_array_almost_equal(df['{}_{}'.format(variable, stat)], expected[variable][stat])
+
+    # Each job is counted once, in its latest state, however many times it is added
+    df = db.getdaily(by=('project', 'status'), status=None, projects=['xx00'], users=['wxs1984'],
+                     startdate=datetime.date(1984, 7, 1), enddate=datetime.date(1984, 7, 31))
+    assert(list(df.index) == [('xx00', 'F'), ('xx00', 'R')])
+    assert(df.jobs.sum() == 24)
+
+    df = db.getdaily(by=('project',))
+    coretime = jobs.walltime * jobs.ncpus
+    for project, group in jobs.groupby('project'):
+        assert_array_almost_equal(df.loc[project, 'cpuefficiency'], group.cputime.sum() / coretime[group.index].sum())
+        assert_array_almost_equal(df.loc[project, 'weightedwaittime'],
+                                  (group.waittime * coretime[group.index]).sum() / coretime[group.index].sum())
+
+    with pytest.raises(ValueError):
+        db.getdaily(by=('jobname',))
+
+def test_rollups(tmpdir):
+    db = JobsDataset('sqlite:///'+str(tmpdir.join('jobs.db')))
+    addjobs(db, (1984,), status='R')
+    db.flushrollups(); db.commit()
+    # Jobs move from running to finished as they change state
+    addjobs(db, (1984,), status='F')
+    db.addjob(1984, 'normal', '19849', 'xx00', 'wxs1984', 'Q', 'job', 0, '/bin/true', '',
+              datetime.datetime(1984, 12, 31), 10., 1., -1., 60., 3600., 1024, 16, -1., 0, -1., -1., 0)
+    db.flushrollups(); db.commit()
+    df = db.getdaily(by=('status',), status=None)
+    assert(df.jobs.to_dict() == {'F': 5, 'Q': 1})
+    # Missing values are not counted
+    assert(df.loc['Q', 'waittime_mean'] == 60. and pd.isnull(df.loc['Q', 'walltime_mean']))
+
+    # Rollups rebuilt from the jobs, as for databases from before they were kept
+    incremental = db.getdaily(by=db.dailyfields, status=None)
+    db.db['JobDaily'].drop()
+    db = JobsDataset('sqlite:///'+str(tmpdir.join('jobs.db')))
+    addjobs(db, (1985,))
+    db.flushrollups(); db.commit()
+    df = db.getdaily(by=db.dailyfields, status=None)
+    pd.testing.assert_frame_equal(df.loc[df.index.get_level_values('day') < '1985-12'], incremental)
+    assert(df.jobs.sum() == 11)
+
+def test_rollback(tmpdir):
+    db = JobsDataset('sqlite:///'+str(tmpdir.join('jobs.db')))
+    db.begin()
+    addjobs(db, (1984,))
+    db.rollback()
+    assert(db.jobindex == {})
+
+    # A dump retried after a rollback counts its jobs once
+    db.begin()
+    addjobs(db, (1984,))
+    db.flushsketches(); db.flushrollups(); db.commit()
+    assert(db.getnumrecords() == 5)
+    assert(db.getquantiles('waittime', by=('queue',))['count'].sum() == 5)
+    assert(db.getdaily(by=('queue',)).jobs.sum() == 5)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import pytest
+import datetime
+import os
+import pandas as pd
+
+from numpy.testing import assert_array_equal, assert_array_almost_equal
+
+duckdb = pytest.importorskip('duckdb')
+
+from ncimonitor.JobsDataset import JobsDataset, open_jobs
+from ncimonitor.ParquetJobs import ParquetJobsDataset
+from ncimonitor import convert_jobs_DB
+
+def addjobs(db):
+    ctime = datetime.datetime(1984, 7, 1, 9, 0, 0)
+    jobid = 1000
+    for project in ('xx00', 'yy00'):
+        for username in ('wxs1984', 'bxb1984'):
+            for queue in ('normal', 'express'):
+                for ncpus in (1, 2, 16, 48, 256, 2048):
+                    for status in ('F', 'R'):
+                        jobid += 1
+                        waitime = float(jobid % 97)
+                        walltime = float(jobid % 13)
+                        db.addjob(ctime.year, queue, str(jobid), project, username,
+                                  status, 'job{}'.format(jobid), 0, '/bin/true', '',
+                                  ctime, 10., 1., 2., waitime,
+                                  3600., 1024, ncpus,
+                                  walltime, 512, walltime*ncpus, 1., 0)
+                        ctime += datetime.timedelta(hours=13)
+    db.commit()
+
+@pytest.fixture(scope='module')
+def dbs(tmpdir_factory):
+    sqlite = JobsDataset('sqlite:///'+str(tmpdir_factory.mktemp('sqlite').join('jobs.db')))
+    parquet = open_jobs('duckdb:///'+str(tmpdir_factory.mktemp('parquet')))
+    addjobs(sqlite)
+    addjobs(parquet)
+    return sqlite, parquet
+
+def sortjobs(jobs):
+    jobs = jobs.assign(ctime=pd.to_datetime(jobs.ctime), ncpusbin=jobs.ncpusbin.astype(str))
+    return jobs.sort_values('jobname').reset_index(drop=True)
+
+def test_open_jobs(dbs):
+    sqlite, parquet = dbs
+    assert( isinstance(parquet, ParquetJobsDataset) )
+    assert( parquet.partitions() == [1984] )
+    assert( parquet.getnumrecords() == sqlite.getnumrecords() == 96 )
+    assert( sorted(parquet.getusers()) == sorted(sqlite.getusers()) )
+    assert( parquet.getuser('wxs1984')['fullname'] == sqlite.getuser('wxs1984')['fullname'] )
+
+def test_getjobs(dbs):
+    sqlite, parquet = dbs
+    for status in ('F', None):
+        expected = sortjobs(sqlite.getjobs(status=status))
+        jobs = sortjobs(parquet.getjobs(status=status))
+        pd.testing.assert_frame_equal(jobs, expected, check_dtype=False)
+    assert( len(parquet.getjobs('1984-07-10', '1984-07-31')) == len(sqlite.getjobs('1984-07-10', '1984-07-31')) )
+    assert( parquet.getjobs('1987-01-01', '1987-12-31') is None )
+
+@pytest.mark.parametrize('aggfunc', ['mean', 'median', 'count', 'sum'])
+def test_aggregate(dbs, aggfunc):
+    sqlite, parquet = dbs
+    for groupvar, splitvar in (('queue', 'ncpusbin'), ('project', 'username'), ('ncpusbin', 'queue'), ('queue', None)):
+        expected = sqlite.aggregate('waittime', groupvar, splitvar, aggfunc=aggfunc)
+        df = parquet.aggregate('waittime', groupvar, splitvar, aggfunc=aggfunc)
+        assert_array_equal(df.index, expected.index)
+        assert_array_almost_equal(df.values, expected.values)
+
+    kwargs = dict(aggfunc=aggfunc, status=None, startdate=datetime.date(1984, 7, 10), enddate=datetime.date(1984, 7, 31),
+                  projects=['yy00'], users=['bxb1984'])
+    expected = sqlite.aggregate('walltime', 'status', 'ncpusbin', **kwargs)
+    df = parquet.aggregate('walltime', 'status', 'ncpusbin', **kwargs)
+    assert_array_equal(df.columns, expected.columns)
+    assert_array_almost_equal(df.values, expected.values)
+
+    with pytest.raises(ValueError):
+        parquet.aggregate('jobname', 'queue', 'ncpusbin')
+
+def test_getquantiles(dbs):
+    sqlite, parquet = dbs
+    jobs = parquet.getjobs()
+    df = parquet.getquantiles('waittime', quantiles=(0.5, 0.9), by=('queue', 'ncpusbin'))
+    expected = jobs.groupby(['queue', 'ncpusbin'], observed=True).waittime
+    counts = expected.count()
+    for key, row in df.iterrows():
+        assert( row['count'] == counts[key] )
+        for q in (0.5, 0.9):
+            values = expected.get_group(key)
+            assert( values.quantile(q, interpolation='lower') <= row[q] <= values.quantile(q, interpolation='higher') )
+
+    df = parquet.getquantiles('walltime', quantiles=(0.5,), by=('project',),
+                              startdate=datetime.date(1984, 7, 1), enddate=datetime.date(1984, 7, 15))
+    assert( df['count'].sum() == len(jobs.loc[pd.to_datetime(jobs.ctime) < pd.Timestamp(1984, 7, 16)]) )
+
+def test_getdaily(dbs):
+    sqlite, parquet = dbs
+    sqlite.flushrollups()
+    for by, status in ((('day', 'queue'), 'F'), (('project', 'username', 'ncpusbin', 'status'), None)):
+        expected = sqlite.getdaily(by=by, status=status)
+        df = parquet.getdaily(by=by, status=status)
+        assert_array_equal(df.index, expected.index)
+        pd.testing.assert_frame_equal(df, expected, check_dtype=False)
+
+    kwargs = dict(startdate=datetime.date(1984, 7, 10), enddate=datetime.date(1984, 7, 31), projects=['yy00'], users=['bxb1984'])
+    pd.testing.assert_frame_equal(parquet.getdaily(by=('queue',), **kwargs), sqlite.getdaily(by=('queue',), **kwargs), check_dtype=False)
+
+def test_versions(tmpdir):
+    db = ParquetJobsDataset('duckdb:///'+str(tmpdir))
+    db.maxdeltas = 3
+
+    def addjob(jobid, status, mtime):
+        ctime = datetime.datetime(1984, 7, 1, 9, 0, 0)
+        db.addjob(1984, 'normal', jobid, 'xx00', 'wxs1984', status, 'job', 0, '/bin/true', '',
+                  ctime, mtime, 1., 2., 60., 3600., 1024, 16, 100., 512, 1600., 1., 0)
+
+    addjob('1', 'R', 10.); addjob('2', 'R', 10.)
+    # Uncommitted jobs are read, and discarded by rollback
+    assert( db.getnumrecords() == 2 )
+    db.rollback()
+    assert( db.getnumrecords() == 0 )
+
+    addjob('1', 'R', 10.); addjob('2', 'R', 10.)
+    db.commit()
+    addjob('1', 'F', 20.)
+    db.commit()
+    # Only the latest version of a job is read
+    assert( db.getnumrecords() == 2 )
+    assert( sorted(db.getjobs(status=None).status) == ['F', 'R'] )
+    assert( len(db.files(1984)) == 2 )
+
+    db.loadindex(['1', '2', '3'])
+    assert( db.unchanged(1984, '1', 20., 'F') )
+    assert( not db.unchanged(1984, '2', 10., 'R') )
+
+    # The deltas are merged once there are maxdeltas of them
+    addjob('2', 'F', 30.)
+    db.commit()
+    assert( [os.path.basename(f) for f in db.files(1984)] == ['base.parquet'] )
+    assert( len(db.getjobs()) == 2 )
+    db.loadindex(['1', '2'])
+    assert( db.unchanged(1984, '2', 30., 'F') )
+
+    db.close()
+    db = ParquetJobsDataset('duckdb:///'+str(tmpdir))
+    assert( db.getnumrecords() == 2 )
+
+def test_convert(tmpdir, dbs):
+    sqlite, parquet = dbs
+    output = 'duckdb:///'+str(tmpdir.join('converted'))
+    convert_jobs_DB.main_parse_args([sqlite.dbfile[len('sqlite:///'):], output])
+    db = open_jobs(output)
+    assert( [os.path.basename(f) for f in db.files(1984)] == ['base.parquet'] )
+    pd.testing.assert_frame_equal(sortjobs(db.getjobs(status=None)), sortjobs(sqlite.getjobs(status=None)), check_dtype=False)
+
+    with pytest.raises(ValueError):
+        convert_jobs_DB.main_parse_args([sqlite.dbfile[len('sqlite:///'):], 'sqlite:///'+str(tmpdir.join('jobs.db'))])
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import pytest
+import threading
+
+from ncimonitor.Pipeline import Inline, Writer
+from ncimonitor.UsageDataset import ProjectDataset
+from ncimonitor import make_short_DB
+
+dump = """%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+Tue Jan 01 06:00:00 UTC 2019
+%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%%
+/short usage for project xx00:
+
+Folder                                   User               Size     Inodes Scandate
+----------------------------------------------------------------------------------------
+xx00/aaa000                              aaa000          1.00GB        100 2019-01-01
+xx00/aaa000/run                          aaa000          2.00GB         50 2019-01-01
+xx00/bbb001                              bbb001        512.00MB         10 2019-01-01
+
+"""
+
+def test_writer():
+    writer = Writer(maxsize=2, batchsize=3)
+    calls = []
+    for i in range(10):
+        writer.call(calls.append, i)
+    # Calls are made in order, in the writer thread
+    assert( writer.sync(threading.current_thread) is writer.thread )
+    assert( calls == list(range(10)) )
+    assert( writer.sync(len, calls) == 10 )
+    writer.close()
+    assert( not writer.thread.is_alive() )
+
+def fail():
+    raise KeyError('failed')
+
+def test_writer_error():
+    writer = Writer(batchsize=2)
+    calls = []
+    writer.call(calls.append, 1)
+    writer.call(fail)
+    writer.call(calls.append, 2)
+    # The error is raised in the caller, and calls after it are skipped
+    with pytest.raises(KeyError):
+        writer.sync(calls.append, 3)
+    assert( calls == [1] )
+
+    # Aborting runs the cleanup and the writer can be used again
+    writer.abort(calls.append, 'rollback')
+    assert( calls == [1, 'rollback'] )
+    writer.call(calls.append, 4)
+    writer.close()
+    assert( calls == [1, 'rollback', 4] )
+
+def test_inline():
+    writer = Inline()
+    calls = []
+    writer.call(calls.append, 1)
+    assert( writer.sync(threading.current_thread) is threading.current_thread() )
+    with pytest.raises(KeyError):
+        writer.call(fail)
+    writer.abort(calls.append, 'rollback')
+    writer.close()
+    assert( calls == [1, 'rollback'] )
+
+# The schema is not changed inside the writer's transaction, see Pipeline
+@pytest.mark.filterwarnings("error::RuntimeWarning")
+@pytest.mark.parametrize("pipeline", [False, True])
+def test_ingest(tmpdir, pipeline):
+    dumpfile = tmpdir.join('short_2019-01-01.dump')
+    dumpfile.write(dump)
+
+    make_short_DB.dbfileprefix = str(tmpdir)
+    make_short_DB.databases.clear()
+    args = ['--noarchive', str(dumpfile)]
+    if pipeline:
+        args.append('--pipeline')
+    make_short_DB.main_parse_args(args)
+    make_short_DB.databases.clear()
+
+    # Back to writing inline once main returns
+    assert( isinstance(make_short_DB.writer, Inline) )
+
+    db = ProjectDataset('xx00', 'sqlite:///'+str(tmpdir.join('usage_xx00_2019.db')))
+    rows = sorted((row['folder'], row['size']) for row in db.db['ShortUsage'].all())
+    assert( rows == [('xx00/aaa000', 1024**3), ('xx00/aaa000/run', 2 * 1024**3), ('xx00/bbb001', 512 * 1024**2)] )
+    assert( sorted(row['username'] for row in db.db['User'].all()) == ['aaa000', 'bbb001'] )
+
+@pytest.mark.parametrize("pipeline", [False, True])
+def test_ingest_error(tmpdir, pipeline):
+    make_short_DB.dbfileprefix = str(tmpdir)
+    make_short_DB.databases.clear()
+
+    # An earlier dump already in the database
+    tmpdir.mkdir('ok').join('short_2019-01-01.dump').write(dump)
+    make_short_DB.main_parse_args(['--noarchive', str(tmpdir.join('ok', 'short_2019-01-01.dump'))])
+    make_short_DB.databases.clear()
+    dbfile = str(tmpdir.join('usage_xx00_2019.db'))
+
+    dumpfile = tmpdir.join('short_2019-01-02.dump')
+    # A malformed size after the first row of a later scan
+    dumpfile.write(dump.replace('2019-01-01', '2019-01-02').replace('2.00GB', '2.00GB!x').replace('512.00MB', 'MB'))
+
+    args = [str(dumpfile)]
+    if pipeline:
+        args.append('--pipeline')
+    with pytest.raises(ValueError):
+        make_short_DB.main_parse_args(args)
+    make_short_DB.databases.clear()
+
+    # Nothing from the file is committed, and it is not archived
+    assert( dumpfile.check() and not tmpdir.join('archive').check() )
+    db = ProjectDataset('xx00', 'sqlite:///'+dbfile)
+    assert( sorted(set(str(row['scandate']) for row in db.db['ShortUsage'].all())) == ['2019-01-01'] )
+    db.close()
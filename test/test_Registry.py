@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import pytest
+import os
+
+from ncimonitor.Registry import Registry, key
+from ncimonitor.UsageDataset import ProjectDataset
+from ncimonitor import make_SU_DB, make_short_DB
+
+class Dataset(object):
+    def __init__(self, name, profile=None):
+        self.name = name
+        self.closed = False
+    def close(self):
+        self.closed = True
+
+def test_key(tmpdir):
+    with tmpdir.as_cwd():
+        assert( key('sqlite:///usage.db') == 'sqlite:///' + os.path.join(str(tmpdir), 'usage.db') )
+    assert( key('sqlite:///:memory:') == 'sqlite:///:memory:' )
+    assert( key('duckdb:///jobs') == 'duckdb:///jobs' )
+
+def test_acquire():
+    registry = Registry(maxidle=1)
+    a = registry.acquire('a', Dataset, 'a')
+    # The same dataset for the same URL and arguments, defaults included
+    assert( registry.acquire('a', Dataset, 'a', profile=None) is a )
+    assert( registry.references('a') == 2 )
+    # which cannot be opened again with others
+    with pytest.raises(ValueError):
+        registry.acquire('a', Dataset, 'other')
+    with pytest.raises(ValueError):
+        registry.acquire('a', Dataset, 'a', profile='read-only')
+    assert( registry.references('a') == 2 )
+    registry.release(a)
+    registry.release(a)
+    # Idle, but kept open
+    assert( registry.references('a') == 0 and registry.get('a') is a and not a.closed )
+
+    # Least recently used idle datasets are closed once more than maxidle are idle
+    with registry.dataset('b', Dataset, 'b') as b:
+        assert( registry.datasets() == [a, b] )
+    assert( a.closed and not b.closed )
+    assert( registry.get('a') is None and registry.get('b') is b )
+
+    # An explicit close closes an unused dataset now, and one in use when
+    # its last user releases it
+    registry.close('b')
+    assert( b.closed and registry.get('b') is None )
+    c = registry.acquire('c', Dataset, 'c')
+    registry.acquire('c', Dataset, 'c')
+    registry.close('c')
+    registry.release(c)
+    assert( not c.closed and registry.get('c') is c )
+    registry.release(c)
+    assert( c.closed and registry.get('c') is None )
+
+    # Closing all closes datasets in use
+    d = registry.acquire('d', Dataset, 'd')
+    registry.closeall()
+    assert( d.closed and registry.datasets() == [] )
+
+def test_fork():
+    registry = Registry()
+    a = registry.acquire('a', Dataset, 'a')
+    # As in a child process, which must not use or close the parent's datasets
+    registry.pid = -1
+    assert( registry.get('a') is None )
+    assert( registry.acquire('a', Dataset, 'a') is not a )
+    registry.closeall()
+    assert( not a.closed )
+
+def test_handles():
+    registry = Registry()
+    first = registry.handles(); second = registry.handles()
+    a = first.open('a', Dataset, 'a')
+    assert( first.open('a', Dataset, 'a') is a )
+    assert( second.open('a', Dataset, 'a') is a )
+    assert( registry.references('a') == 2 )
+    with pytest.raises(ValueError):
+        first.open('a', Dataset, 'a', profile='read-only')
+    assert( len(first) == 1 and first.values() == [a] )
+
+    first.clear()
+    assert( registry.references('a') == 1 and len(first) == 0 )
+    first.open('a', Dataset, 'a')
+
+    # Closing by one module leaves the dataset open for the others
+    second.close()
+    assert( not a.closed and len(second) == 0 and first.values() == [a] )
+    assert( registry.references('a') == 1 )
+    # until the last of them closes it
+    first.close()
+    assert( a.closed and len(first) == 0 and registry.get('a') is None )
+
+def test_parsers_share(tmpdir):
+    # All the usage parsers open the same dataset for a usage database
+    url = 'sqlite:///'+str(tmpdir.join('usage_xx00_2019.db'))
+    db = make_SU_DB.databases.open(url, ProjectDataset, 'xx00', url)
+    assert( make_short_DB.databases.open(url, ProjectDataset, 'xx00', url) is db )
+    # A parser needing other arguments for the same database cannot share it
+    with pytest.raises(ValueError):
+        make_short_DB.databases.open(url, ProjectDataset, 'xx00', url, delta=True)
+    make_SU_DB.databases.close()
+    assert( make_short_DB.databases.values() == [db] )
+    make_short_DB.databases.close()
+    assert( len(make_SU_DB.databases) == 0 and len(make_short_DB.databases) == 0 )
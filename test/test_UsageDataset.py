@@ -185,3 +185,177 @@ def test_getusage(db):
     assert(dp['Big Brother (bxb1984)'].sum() == 1228500)
 
         
+
+def test_bulk(tmpdir):
+    project = 'xx00'
+    db = ProjectDataset(project, 'sqlite:///'+str(tmpdir.join('bulk.db')), bulk=True)
+    db.bulk_rows = 3
+
+    db.adduser('wxs1984', 'Winston Smith')
+    date = datetime.date(1984, 7, 1)
+    for i in range(5):
+        db.addshortusage('folder{}'.format(i), 'wxs1984', 10*i, i, date)
+    # Later rows replace earlier ones, including those already flushed
+    db.addshortusage('folder0', 'wxs1984', 1000, 1, date)
+    db.addshortusage('folder4', 'wxs1984', 2000, 1, date)
+    db.close()
+
+    db = ProjectDataset(project, 'sqlite:///'+str(tmpdir.join('bulk.db')))
+    sizes = dict((r['folder'], r['size']) for r in db.db['ShortUsage'].all())
+    assert( sizes == {'folder0': 1000., 'folder1': 10., 'folder2': 20., 'folder3': 30., 'folder4': 2000.} )
+    assert( db.db['ShortUsage'].has_index(['scandate', 'folder', 'user']) )
+
+def test_compact(tmpdir):
+    project = 'xx00'
+    db = ProjectDataset(project, 'sqlite:///'+str(tmpdir.join('compact.db')))
+    db.adduser('wxs1984', 'Winston Smith')
+    db.addquarter(1984, 'q1', datetime.date(1984, 1, 1), datetime.date(1984, 3, 31))
+    db.addquarter(1984, 'q2', datetime.date(1984, 4, 1), datetime.date(1984, 6, 30))
+
+    date = datetime.date(1984, 1, 1)
+    while date < datetime.date(1984, 5, 1):
+        db.addshortusage('folder', 'wxs1984', date.toordinal(), 1, date)
+        date = date + datetime.timedelta(days=1)
+
+    before = db.getstorage(1984, 'q1')
+    removed = db.compact(datetime.date(1984, 4, 1))
+    db.vacuum()
+
+    # First and last scan of the quarter, and the last scan of each week, are kept
+    dates = db.getshortdates(1984, 'q1')
+    assert( removed['ShortUsage'] == 91 - len(dates) )
+    assert( dates[0] == datetime.date(1984, 1, 1) and dates[-1] == datetime.date(1984, 3, 31) )
+    assert( all(date.weekday() == 6 for date in dates[1:-1]) )
+    # More recent scans are untouched
+    assert( len(db.getshortdates(1984, 'q2')) == 30 )
+
+    # getstorage still has a value for every day, and is unchanged on the days kept
+    after = db.getstorage(1984, 'q1')
+    assert( (after.index == before.index).all() )
+    kept = pd.to_datetime(dates)
+    assert( (after.loc[kept] == before.loc[kept]).all().all() )
+
+def test_delta(tmpdir):
+    project = 'xx00'
+    full = ProjectDataset(project, 'sqlite:///'+str(tmpdir.join('full.db')))
+    delta = ProjectDataset(project, 'sqlite:///'+str(tmpdir.join('delta.db')), delta=True)
+    assert( full.storagemode == 'full' and delta.storagemode == 'delta' )
+
+    for db in (full, delta):
+        db.adduser('wxs1984', 'Winston Smith')
+        db.adduser('bxb1984', 'Big Brother')
+        db.addquarter(1984, 'q1', datetime.date(1984, 1, 1), datetime.date(1984, 3, 31))
+        db.addquarter(1984, 'q2', datetime.date(1984, 4, 1), datetime.date(1984, 6, 30))
+
+        date = datetime.date(1984, 3, 1)
+        for day in range(60):
+            db.begin()
+            # Unchanged, growing every tenth day, removed after 20 days and added after 40 days
+            db.addshortusage('static', 'wxs1984', 1e6, 10, date)
+            db.addshortusage('growing', 'bxb1984', 1e6*(day//10), 10, date)
+            if day < 20:
+                db.addshortusage('removed', 'wxs1984', 5e5, 5, date)
+            if day > 40:
+                db.addshortusage('added', 'bxb1984', 2e6, 20, date)
+            db.addgdatausage('gdata1', 'static', 'wxs1984', 3e6, 30, date)
+            db.commit()
+            date = date + datetime.timedelta(days=1)
+
+    # Far fewer rows are stored
+    assert( len(delta.db['ShortUsage']) < len(full.db['ShortUsage']) / 4 )
+    assert( len(delta.db['GdataUsage']) < len(full.db['GdataUsage']) / 4 )
+
+    for year, quarter in ((1984, 'q1'), (1984, 'q2')):
+        assert( delta.getshortdates(year, quarter) == full.getshortdates(year, quarter) )
+        assert( delta.getshortusers(year, quarter) == full.getshortusers(year, quarter) )
+        for storagept in ('short', 'gdata'):
+            for datafield in ('size', 'inodes'):
+                expected = full.getstorage(year, quarter, storagept=storagept, datafield=datafield)
+                actual = delta.getstorage(year, quarter, storagept=storagept, datafield=datafield)
+                assert( (actual.index == expected.index).all() )
+                assert_array_equal(actual[expected.columns].values, expected.values)
+        for user in ('wxs1984', 'bxb1984'):
+            assert( delta.getusershort(year, quarter, user) == full.getusershort(year, quarter, user) )
+            assert( delta.getusergdata(year, quarter, user) == full.getusergdata(year, quarter, user) )
+
+    # Continues from the stored state when reopened
+    delta.close()
+    delta = ProjectDataset(project, 'sqlite:///'+str(tmpdir.join('delta.db')), delta=True)
+    for db in (full, delta):
+        db.begin()
+        db.addshortusage('static', 'wxs1984', 1e6, 10, date)
+        db.addshortusage('growing', 'bxb1984', 9e6, 10, date)
+        db.commit()
+    assert( delta.getusershort(1984, 'q2', 'bxb1984') == full.getusershort(1984, 'q2', 'bxb1984') )
+
+    with pytest.raises(ValueError):
+        delta.compact(datetime.date(1984, 4, 1))
+
+def test_densepivot():
+    dates = ['1984-07-03', '1984-07-03', '1984-07-05', '1984-07-08', '1984-07-08']
+    names = ['Winston Smith (wxs1984)', 'Big Brother (bxb1984)', 'Winston Smith (wxs1984)',
+             'Big Brother (bxb1984)', "O'Brien (ogb1984)"]
+    values = [1., 2., 3., 4., 5.]
+
+    expected = pd.DataFrame(dict(Name=names, Date=dates, totsize=values)).pivot_table(index='Date', columns='Name', fill_value=0)
+    expected.columns = expected.columns.get_level_values(1)
+    expected.index = pd.to_datetime(expected.index, format="%Y-%m-%d")
+    pd.testing.assert_frame_equal(densepivot(dates, names, values), expected)
+
+    expected = expected.reindex(pd.date_range('1984-07-01', '1984-07-08'), method='backfill')
+    df = densepivot(dates, names, values, '1984-07-01')
+    pd.testing.assert_frame_equal(df, expected)
+    assert_array_equal(df['Big Brother (bxb1984)'].values, [2., 2., 2., 0., 0., 4., 4., 4.])
+
+def test_delta_keyframe(tmpdir):
+    project = 'xx00'
+    full = ProjectDataset(project, 'sqlite:///'+str(tmpdir.join('full.db')))
+    delta = ProjectDataset(project, 'sqlite:///'+str(tmpdir.join('delta.db')), delta=True)
+
+    for db in (full, delta):
+        db.adduser('wxs1984', 'Winston Smith')
+        db.addquarter(1984, 'q1', datetime.date(1984, 1, 1), datetime.date(1984, 3, 31))
+        date = datetime.date(1984, 1, 1)
+        for day in range(45):
+            db.begin()
+            db.addshortusage('static', 'wxs1984', 1e6, 10, date)
+            # Removed on the day of the second keyframe
+            if day < delta.keyframe_days:
+                db.addshortusage('removed', 'wxs1984', 5e7, 50, date)
+            db.addgdatausage('gdata1', 'static', 'wxs1984', 3e6, 30, date)
+            db.commit()
+            date = date + datetime.timedelta(days=1)
+
+    keyframes = [r['scandate'] for r in delta.db['ScanDate'].find(tablename='ShortUsage', keyframe=True)]
+    assert( [str(k) for k in keyframes] == ['1984-01-01', '1984-01-29'] )
+
+    assert( delta.getshortusers(1984, 'q1') == full.getshortusers(1984, 'q1') )
+    for datafield in ('size', 'inodes'):
+        expected = full.getstorage(1984, 'q1', storagept='short', datafield=datafield)
+        actual = delta.getstorage(1984, 'q1', storagept='short', datafield=datafield)
+        assert_array_equal(actual[expected.columns].values, expected.values)
+    assert( delta.getusershort(1984, 'q1', 'wxs1984') == full.getusershort(1984, 'q1', 'wxs1984') )
+
+def test_online_write(tmpdir, capsys):
+    from ncimonitor import UsageQuery
+    dbfile = str(tmpdir.join('usage_xx00_2019.db'))
+    db = ProjectDataset('xx00', 'sqlite:///'+dbfile, profile='online-write')
+    db.begin()
+    db.addquarter(2019, 'q1', datetime.date(2019,1,1), datetime.date(2019,3,31))
+    db.commit()
+    assert( db.db.query('PRAGMA journal_mode').next()['journal_mode'] == 'wal' )
+
+    # Readers leave the journal alone, and say nothing, while it is being written
+    reader = ProjectDataset('xx00', 'sqlite:///'+dbfile, profile='read-only')
+    assert( reader.getstartend(2019, 'q1') == (datetime.date(2019,1,1), datetime.date(2019,3,31)) )
+    reader.close()
+    assert( capsys.readouterr() == ('', '') )
+    assert( db.db.query('PRAGMA journal_mode').next()['journal_mode'] == 'wal' )
+    db.close()
+
+    # Written with WAL, but left with a rollback journal for read only users
+    assert( not os.path.exists(dbfile + '-wal') )
+    conn = UsageQuery.connect(dbfile)
+    assert( conn.execute('PRAGMA journal_mode').fetchone()[0] == 'delete' )
+    assert( UsageQuery.getstartend(conn, 2019, 'q1') == ('2019-01-01', '2019-03-31') )
+    conn.close()
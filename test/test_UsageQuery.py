@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import pytest
+import sys
+
+from numpy.testing import assert_array_equal, assert_array_almost_equal
+
+import os
+
+from ncimonitor.UsageDataset import *
+from ncimonitor import UsageQuery
+
+import datetime
+
+@pytest.fixture(scope='module', params=[False, True], ids=['full', 'delta'])
+def dbfile(tmpdir_factory, request):
+    dbfile = str(tmpdir_factory.mktemp('usage').join('usage_xx00_1984.db'))
+    db = ProjectDataset('xx00', 'sqlite:///'+dbfile, delta=request.param)
+    db.addquarter(1984, 'q3', datetime.date(1984, 7, 1), datetime.date(1984, 9, 30))
+    db.addsystemstorage('raijin', 'short', 1984, 'q3', 1e12, 1e6)
+    db.addsystemstorage('global', 'gdata1', 1984, 'q3', 2e12, 2e6)
+    for i, (user, fullname) in enumerate((('wxs1984', 'Winston Smith'), ('bxb1984', 'Big Brother'), ('ogb1984', "O'Brien"))):
+        db.adduser(user, fullname)
+        for day in range(1, 30, 7):
+            scandate = datetime.date(1984, 7, day).isoformat()
+            for folder in ('a', 'b'):
+                db.addshortusage(folder, user, 1e6*(i+1)*day, 10*(i+1), scandate)
+                db.addgdatausage('gdata1', folder, user, 1e7*(3-i)*day, 20*(i+1), scandate)
+            db.commit()
+    return dbfile
+
+def test_latest_storage(dbfile):
+    db = ProjectDataset('xx00', 'sqlite:///'+dbfile)
+    conn = UsageQuery.connect(dbfile)
+
+    for storagepoint in ('short', 'gdata'):
+        for measure in ('size', 'inodes'):
+            expected = db.getstorage(1984, 'q3', storagept=storagepoint, datafield=measure).iloc[-1]
+            scandate, usage = UsageQuery.latest_storage(conn, 1984, 'q3', storagepoint, measure)
+            assert(scandate == '1984-07-29')
+            assert([value for _, _, value in usage] == sorted(expected.values, reverse=True))
+            for fullname, username, value in usage:
+                assert(expected['{} ({})'.format(fullname, username)] == value)
+
+    assert(UsageQuery.getsystemstorage(conn, 'raijin', 'short', 1984, 'q3') == db.getsystemstorage('raijin', 'short', 1984, 'q3'))
+    assert(UsageQuery.getsystemstorage(conn, 'global', 'gdata', 1984, 'q3') == (2e12, 2e6))
+
+    # No data for a quarter which is not in the database
+    assert(UsageQuery.latest_storage(conn, 1984, 'q4') == (None, []))
+
+    with pytest.raises(IOError):
+        UsageQuery.connect(dbfile + '.missing')
+
+@pytest.mark.parametrize('bulk', [False, True], ids=['online', 'bulk'])
+def test_summary(tmpdir, bulk):
+    from ncimonitor import UsageSummary, nci_usage
+
+    dbfile = str(tmpdir.join('usage_xx00_1984.db'))
+    db = ProjectDataset('xx00', 'sqlite:///'+dbfile, bulk=bulk, summary=True)
+    db.addquarter(1984, 'q3', datetime.date(1984, 7, 1), datetime.date(1984, 9, 30))
+    db.addsystemstorage('raijin', 'short', 1984, 'q3', 1e12, 1e6)
+    for i, user in enumerate(('wxs1984', 'bxb1984')):
+        db.adduser(user, user.upper())
+        db.addshortusage('a', user, 1e6*(i+1), 10*(i+1), '1984-07-01')
+    db.commit()
+    if bulk:
+        # Buffered rows are summarised once they are written
+        assert( not os.path.exists(UsageSummary.summary_file(dbfile, 'q3')) )
+        db.close()
+    assert( UsageSummary.summary_files(dbfile) == [UsageSummary.summary_file(dbfile, 'q3')] )
+
+    conn = UsageQuery.connect(dbfile)
+    for storagepoint in ('short', 'gdata'):
+        for measure in ('size', 'inodes'):
+            scandate, usage = UsageQuery.latest_storage(conn, 1984, 'q3', storagepoint, measure)
+            grant, igrant = UsageQuery.getsystemstorage(conn, nci_usage.storage_system(storagepoint), storagepoint, 1984, 'q3')
+            assert( UsageSummary.lookup(conn, dbfile, 1984, 'q3', storagepoint, measure) == (scandate, usage, grant, igrant) )
+    assert( UsageSummary.lookup(conn, dbfile, 1984, 'q4', 'short', 'size') is None )
+
+    # A scan added without writing a summary makes it stale
+    db = ProjectDataset('xx00', 'sqlite:///'+dbfile)
+    db.addshortusage('a', 'wxs1984', 5e6, 50, '1984-07-08')
+    db.commit()
+    assert( UsageSummary.lookup(conn, dbfile, 1984, 'q3', 'short', 'size') is None )
+
+    # as do a changed grant and a scan ingested again, which leave the quarter
+    # and latest scan date the same
+    db = ProjectDataset('xx00', 'sqlite:///'+dbfile, summary=True)
+    db.addsystemstorage('raijin', 'short', 1984, 'q3', 1e12, 1e6)
+    db.commit()
+    assert( UsageSummary.lookup(conn, dbfile, 1984, 'q3', 'short', 'size') is not None )
+    db = ProjectDataset('xx00', 'sqlite:///'+dbfile)
+    db.addsystemstorage('raijin', 'short', 1984, 'q3', 2e12, 1e6)
+    db.commit()
+    assert( UsageSummary.lookup(conn, dbfile, 1984, 'q3', 'short', 'size') is None )
+    db = ProjectDataset('xx00', 'sqlite:///'+dbfile, summary=True)
+    db.addshortusage('a', 'wxs1984', 5e6, 50, '1984-07-08')
+    db.commit()
+    assert( UsageSummary.lookup(conn, dbfile, 1984, 'q3', 'short', 'size')[2] == 2e12 )
+    db = ProjectDataset('xx00', 'sqlite:///'+dbfile)
+    db.addshortusage('a', 'wxs1984', 6e6, 60, '1984-07-08')
+    db.commit()
+    assert( UsageSummary.lookup(conn, dbfile, 1984, 'q3', 'short', 'size') is None )
+    conn.close()
+
+    nci_usage.dbfileprefix = str(tmpdir)
+    scandate, usage, grant, igrant = nci_usage.project_storage('xx00', 1984, 'q3', 'short', 'size')
+    assert( scandate == '1984-07-08' and usage[0][1:] == ('wxs1984', 6e6) and grant == 2e12 )
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import pytest
+import json
+import os
+import pwd
+
+from ncimonitor.UserDirectory import UserDirectory
+
+def test_userdirectory(tmpdir, monkeypatch):
+    path = str(tmpdir.join('users.json'))
+    root = pwd.getpwuid(0)
+
+    directory = UserDirectory(path)
+    assert( directory.fullname(root.pw_name) == root.pw_gecos )
+    assert( directory.fullname('nosuchuser1984') is None )
+
+    # Users looked up individually are only saved when flushed
+    with open(path) as f:
+        assert( 'nosuchuser1984' not in json.load(f)['missing'] )
+    directory.flush()
+    with open(path) as f:
+        cache = json.load(f)
+    assert( cache['users'][root.pw_name] == root.pw_gecos )
+    assert( cache['missing'] == ['nosuchuser1984'] )
+
+    # A fresh cache file is used without reading the password database
+    def fail(*args):
+        raise AssertionError('password database read')
+    monkeypatch.setattr(pwd, 'getpwall', fail)
+    monkeypatch.setattr(pwd, 'getpwnam', fail)
+    directory = UserDirectory(path)
+    assert( directory.fullname(root.pw_name) == root.pw_gecos )
+    assert( directory.fullname('nosuchuser1984') is None )
+
+    # A stale cache is refreshed
+    directory = UserDirectory(path, ttl=0)
+    with pytest.raises(AssertionError):
+        directory.fullname(root.pw_name)
+
+    # Without a cache file
+    monkeypatch.undo()
+    directory = UserDirectory()
+    assert( directory.fullname(root.pw_name) == root.pw_gecos )
+    assert( sorted(os.listdir(str(tmpdir))) == ['users.json'] )
+
+def test_userdirectory_merge(tmpdir, monkeypatch):
+    path = str(tmpdir.join('users.json'))
+    monkeypatch.setattr(pwd, 'getpwall', lambda: [])
+
+    # Two ingests sharing a cache file both keep the users they looked up
+    first = UserDirectory(path)
+    first.load()
+    second = UserDirectory(path)
+    second.load()
+    assert( first.fullname('nosuchuser1984') is None )
+    assert( second.fullname('nosuchuser1985') is None )
+    first.flush()
+    second.flush()
+    with open(path) as f:
+        assert( json.load(f)['missing'] == ['nosuchuser1984', 'nosuchuser1985'] )
+
+    # Unless the password database was read again in between
+    third = UserDirectory(path, ttl=0)
+    third.load()
+    assert( third.fullname('nosuchuser1986') is None )
+    third.flush()
+    with open(path) as f:
+        assert( json.load(f)['missing'] == ['nosuchuser1986'] )
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import json
+import os
+
+from ncimonitor.Watcher import Watcher
+from ncimonitor.UsageDataset import ProjectDataset
+from ncimonitor import make_short_DB
+
+def write_dump(path, storage='/short'):
+    with open(path, 'w') as f:
+        print('%' * 72, file=f)
+        print('Mon Jan 07 00:00:00 UTC 2019', file=f)
+        print('%' * 72, file=f)
+        print('{} usage for project xx00:'.format(storage), file=f)
+
+def test_watcher(tmpdir):
+    ingested = []
+    status = str(tmpdir.join('status.json'))
+    indir = tmpdir.mkdir('in')
+    watcher = Watcher(str(indir), ingested.append, dumptype='short', settle=0,
+                      statusfile=status, inotify=False)
+
+    write_dump(str(indir.join('short.dump')))
+    write_dump(str(indir.join('gdata1.dump')))
+    indir.join('SU.dump').write('Usage Report: Project=xx00 Compute\n')
+
+    # Files must be unchanged between two scans before they are ingested
+    assert( watcher.run_once() == 0 )
+    assert( watcher.run_once() == 1 )
+    assert( ingested == [str(indir.join('short.dump'))] )
+
+    # and are only ingested once
+    assert( watcher.run_once() == 0 )
+
+    with open(status) as f:
+        data = json.load(f)
+    assert( data['state'] == 'running' )
+    assert( data['ingested'] == 1 )
+
+    # Files closed by the writer are ingested immediately
+    write_dump(str(indir.join('short2.dump')))
+    assert( watcher.run_once(closed=[str(indir.join('short2.dump'))]) == 1 )
+
+def test_watcher_errors(tmpdir):
+    def ingest(path):
+        raise ValueError('Bad dump')
+    watcher = Watcher(str(tmpdir), ingest, settle=0, inotify=False)
+    write_dump(str(tmpdir.join('short.dump')))
+    watcher.run_once()
+    assert( watcher.run_once() == 0 )
+    assert( watcher.errors == 1 )
+    assert( 'Bad dump' in watcher.lasterror )
+
+def test_watcher_bad_dump(tmpdir):
+    from test_Pipeline import dump
+    make_short_DB.dbfileprefix = str(tmpdir)
+    make_short_DB.databases.clear()
+    indir = tmpdir.mkdir('in')
+    watcher = Watcher(str(indir), lambda path: make_short_DB.main_parse_args(['--noarchive', path]),
+                      dumptype='short', settle=0, inotify=False)
+
+    # A malformed size is reported, and the following dump still ingested
+    indir.join('short_2019-01-01.dump').write(dump.replace('512.00MB', 'MB'))
+    os.utime(str(indir.join('short_2019-01-01.dump')), (0, 0))
+    indir.join('short_2019-01-02.dump').write(dump.replace('2019-01-01', '2019-01-02'))
+    watcher.run_once()
+    assert( watcher.run_once() == 1 )
+    make_short_DB.databases.clear()
+    assert( watcher.errors == 1 and 'MB' in watcher.lasterror )
+    assert( watcher.lastfile == str(indir.join('short_2019-01-02.dump')) )
+
+    db = ProjectDataset('xx00', 'sqlite:///'+str(tmpdir.join('usage_xx00_2019.db')))
+    assert( sorted(set(str(row['scandate']) for row in db.db['ShortUsage'].all())) == ['2019-01-02'] )
+    db.close()
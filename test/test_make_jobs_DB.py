@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import pytest
+import datetime
+import json
+
+from ncimonitor.make_jobs_DB import project, extract
+
+dump = """
+{
+    "timestamp": 1552349137,
+    "Jobs": {
+        "1234.r-man2": {
+            "Job_Name": "thoughtcrime",
+            "Job_Owner": "wxs1984@raijin1",
+            "job_state": "F",
+            "queue": "normal",
+            "ctime": "Tue Mar 12 09:45:37 2019",
+            "qtime": "Tue Mar 12 09:45:37 2019",
+            "mtime": "Tue Mar 12 10:45:37 2019",
+            "stime": "Tue Mar 12 09:55:37 2019",
+            "project": "xx00",
+            "Exit_status": 0,
+            "Resource_List": { "jobprio": 10, "mem": "2gb", "ncpus": 16, "walltime": "02:00:00", "place": "free" },
+            "resources_used": { "cput": "08:00:00", "mem": "1gb", "walltime": "00:50:00", "vmem": "3gb" },
+            "Variable_List": { "PBS_O_HOME": "/home/wxs1984", "PATH": "/bin" }
+        },
+        "1235.r-man2": {
+            "Job_Name": "doublethink",
+            "Job_Owner": "bxb1984@raijin1",
+            "job_state": "Q",
+            "queue": "express",
+            "ctime": "Tue Mar 12 09:45:37 2019",
+            "qtime": "Tue Mar 12 09:45:37 2019",
+            "mtime": "Tue Mar 12 09:45:37 2019",
+            "project": "xx00",
+            "Resource_List": { "jobprio": 0, "walltime": "00:10:00" }
+        }
+    }
+}
+"""
+
+def test_project():
+    data = json.loads(dump, object_pairs_hook=project)
+    assert( data['timestamp'] == 1552349137 )
+    info = data['Jobs']['1234.r-man2']
+    assert( 'Variable_List' not in info )
+    assert( sorted(info['Resource_List']) == ['jobprio', 'mem', 'ncpus', 'walltime'] )
+    assert( sorted(info['resources_used']) == ['cput', 'mem', 'walltime'] )
+
+    job = extract(info)
+    assert( job['username'] == 'wxs1984' )
+    assert( job['stime'] == datetime.datetime(2019, 3, 12, 9, 55, 37) )
+    assert( job['maxwalltime'] == 7200. and job['walltime'] == 3000. and job['cputime'] == 28800. )
+    assert( job['maxmem'] == 2*1024**3 and job['mem'] == 1024**3 )
+    assert( job['exitstatus'] == 0 and job['exe'] == '' )
+
+    # Defaults for jobs which have not run
+    job = extract(data['Jobs']['1235.r-man2'])
+    assert( job['stime'] is None and job['walltime'] == -1. and job['maxmem'] == 0 and job['ncpus'] is None )
+    assert( job['exitstatus'] == -999 )
+
+    with pytest.raises(KeyError):
+        extract(dict(queue='normal'))
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import pytest
+import datetime
+import json
+
+from ncimonitor.UsageDataset import ProjectDataset
+from ncimonitor import nci_leaderboard
+
+@pytest.fixture(scope='module')
+def directory(tmpdir_factory):
+    directory = tmpdir_factory.mktemp('usage')
+    for p, project in enumerate(('xx00', 'yy00', 'zz00')):
+        db = ProjectDataset(project, 'sqlite:///'+str(directory.join('usage_{}_1984.db'.format(project))),
+                            summary=(project != 'zz00'))
+        db.addquarter(1984, 'q3', datetime.date(1984, 7, 1), datetime.date(1984, 9, 30))
+        for i, user in enumerate(('wxs1984', 'bxb1984', 'ogb1984')):
+            db.adduser(user, user.upper())
+            for day in (1, 8):
+                scandate = datetime.date(1984, 7, day).isoformat()
+                db.addshortusage('a', user, 1e9*(i+1)*(p+2)*day, 10*(i+1), scandate)
+                db.addgdatausage('gdata1', 'a', user, 1e9*(3-i), 20, scandate)
+            db.commit()
+        db.close()
+    # Not a usage database of this year
+    directory.join('usage_xx00_1985.db').write('')
+    return directory
+
+def test_find_databases(directory):
+    assert( sorted(nci_leaderboard.find_databases(str(directory), 1984)) == ['xx00', 'yy00', 'zz00'] )
+    assert( list(nci_leaderboard.find_databases(str(directory), 1984, ['yy00'])) == ['yy00'] )
+
+def test_leaderboard(directory):
+    dbfiles = nci_leaderboard.find_databases(str(directory), 1984)
+
+    entries = nci_leaderboard.leaderboard(dbfiles, 1984, 'q3', 'short', 'size', count=2, threads=2)
+    assert( [(value, username, projects) for value, username, _, projects, _ in entries] ==
+            [(96e9, 'ogb1984', 'zz00'), (72e9, 'ogb1984', 'yy00')] )
+    assert( entries[0][4] == '1984-07-08' )
+
+    # The count largest of all the users' entries
+    entries = nci_leaderboard.leaderboard(dbfiles, 1984, 'q3', 'short', 'size', count=100)
+    assert( len(entries) == 9 and [entry[0] for entry in entries] == sorted((entry[0] for entry in entries), reverse=True) )
+
+    entries = nci_leaderboard.leaderboard(dbfiles, 1984, 'q3', 'gdata', 'size', count=1, byuser=True)
+    assert( [(value, username, projects) for value, username, _, projects, _ in entries] ==
+            [(9e9, 'wxs1984', 'xx00,yy00,zz00')] )
+
+    assert( nci_leaderboard.leaderboard(dbfiles, 1984, 'q4', 'short') == [] )
+
+def test_main(directory, capsys):
+    nci_leaderboard.main_parse_args(['-d', str(directory), '-p', '1984.q3', '--short', '--byuser',
+                                     '--measure', 'inodes', '--format', 'json', '--count', '1'])
+    output = json.loads(capsys.readouterr().out)
+    assert( output['databases'] == 3 )
+    assert( [(r['rank'], r['username'], r['value']) for r in output['records']] == [(1, 'ogb1984', 90.)] )
+
+    nci_leaderboard.main_parse_args(['-d', str(directory), '-p', '1984.q3', '-P', 'xx00'])
+    lines = capsys.readouterr().out.splitlines()
+    assert( lines[0].split() == ['Rank', 'Name', 'Projects', 'short', '(GB)'] )
+    assert( lines[1].split()[:3] == ['1', 'OGB1984', '(ogb1984)'] )
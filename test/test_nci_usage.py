@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import pytest
+import argparse
+import datetime
+
+from ncimonitor.UsageDataset import ProjectDataset
+from ncimonitor import nci_usage
+
+@pytest.fixture(scope='module')
+def directory(tmpdir_factory):
+    directory = tmpdir_factory.mktemp('usage')
+    # wxs1984 is a member of both projects
+    members = { 'xx00' : ('wxs1984', 'bxb1984'), 'yy00' : ('wxs1984', 'ogb1984') }
+    for p, project in enumerate(sorted(members)):
+        db = ProjectDataset(project, 'sqlite:///'+str(directory.join('usage_{}_1984.db'.format(project))))
+        db.addquarter(1984, 'q3', datetime.date(1984, 7, 1), datetime.date(1984, 9, 30))
+        db.addsystemstorage('raijin', 'short', 1984, 'q3', 100e9*(p+1), 1000*(p+1))
+        for i, user in enumerate(members[project]):
+            db.adduser(user, user.upper())
+            db.addshortusage('a', user, 10e9*(i+1)*(p+1), 10*(i+1), '1984-07-0{}'.format(p+1))
+        db.commit()
+        db.close()
+    return directory
+
+def test_project_storage(directory, monkeypatch):
+    monkeypatch.setattr(nci_usage, 'dbfileprefix', str(directory))
+
+    assert( nci_usage.project_storage('xx00', 1984, 'q3', 'short', 'size') ==
+            ('1984-07-01', [('BXB1984', 'bxb1984', 20e9), ('WXS1984', 'wxs1984', 10e9)], 100e9, 1000.) )
+
+    # A project without a database
+    assert( nci_usage.project_storage('zz00', 1984, 'q3', 'short', 'size') == (None, [], None, None) )
+
+def test_default_projects(directory, monkeypatch):
+    monkeypatch.setattr(nci_usage, 'dbfileprefix', str(directory))
+
+    monkeypatch.setenv('PROJECT', 'yy00')
+    assert( nci_usage.default_projects(1984) == ['yy00'] )
+    # Every project with a database when $PROJECT is not set
+    monkeypatch.delenv('PROJECT')
+    assert( nci_usage.default_projects(1984) == ['xx00', 'yy00'] )
+    assert( nci_usage.default_projects(1985) == [] )
+
+def test_combine_storage(directory, monkeypatch):
+    monkeypatch.setattr(nci_usage, 'dbfileprefix', str(directory))
+
+    results = [nci_usage.project_storage(project, 1984, 'q3', 'short', 'size') for project in ('xx00', 'yy00', 'zz00')]
+    scandate, usage, grant = nci_usage.combine_storage(results, 'size')
+    # Latest scan of any project, and a user's usage summed over their projects
+    assert( scandate == '1984-07-02' )
+    assert( usage == [('OGB1984', 'ogb1984', 40e9), ('WXS1984', 'wxs1984', 30e9), ('BXB1984', 'bxb1984', 20e9)] )
+    assert( grant == 300e9 )
+
+    # Percentages are of the combined grant
+    args = argparse.Namespace(count=10, measure='size', percent=True)
+    records = nci_usage.report_records('short', scandate, usage, grant, args)
+    assert( [(r['username'], r['percent']) for r in records] ==
+            [('ogb1984', pytest.approx(40./3)), ('wxs1984', 10.), ('bxb1984', pytest.approx(20./3)), ('TOTAL', 30.)] )
+
+    results = [nci_usage.project_storage(project, 1984, 'q3', 'short', 'inodes') for project in ('xx00', 'yy00')]
+    scandate, usage, grant = nci_usage.combine_storage(results, 'inodes')
+    # Ties are in order of username
+    assert( usage == [('BXB1984', 'bxb1984', 20.), ('OGB1984', 'ogb1984', 20.), ('WXS1984', 'wxs1984', 20.)] )
+    assert( grant == 3000 )
+
+    # No data if no project has a database
+    assert( nci_usage.combine_storage([(None, [], None, None)], 'size') == (None, [], 0.) )